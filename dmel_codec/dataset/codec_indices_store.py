@@ -0,0 +1,119 @@
+import json
+import os
+import numpy as np
+import torch
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=False)
+
+INDICES_FILE_NAME = "indices.bin"
+INDEX_FILE_NAME = "index.json"
+SUPPORTED_DTYPES = {"uint8": np.uint8, "uint16": np.uint16}
+
+
+class CodecIndicesStoreWriter:
+    def __init__(self, store_dir: str, codebook_num: int, dtype: str = "uint8"):
+        """
+            Write the fsq indices of a cutset to a flat binary file and a json index keyed by cut id
+            store_dir: output directory, indices.bin and index.json are written into it
+            codebook_num: number of codebooks of the codec
+            dtype: uint8 or uint16, uint8 is enough when every codebook size <= 256
+        """
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}, please use one of {list(SUPPORTED_DTYPES)}")
+
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.codebook_num = codebook_num
+        self.dtype = dtype
+        self.max_value = np.iinfo(SUPPORTED_DTYPES[dtype]).max
+        self.items = {}
+        self.num_frames = 0
+        self.file = open(os.path.join(store_dir, INDICES_FILE_NAME), "wb")
+
+    def write(self, cut_id: str, indices: torch.Tensor):
+        """
+            indices: [T, codebook_num]
+        """
+        assert indices.ndim == 2 and indices.shape[1] == self.codebook_num, \
+            f"indices must be [T, {self.codebook_num}], got {tuple(indices.shape)}"
+        if cut_id in self.items:
+            raise ValueError(f"Duplicate cut id: {cut_id}")
+
+        indices = indices.detach().cpu()
+        if indices.numel() > 0 and (indices.min() < 0 or indices.max() > self.max_value):
+            raise ValueError(f"indices of {cut_id} are out of the {self.dtype} range")
+
+        self.file.write(indices.numpy().astype(SUPPORTED_DTYPES[self.dtype]).tobytes())
+        self.items[cut_id] = [self.num_frames, indices.shape[0]]
+        self.num_frames += indices.shape[0]
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        with open(os.path.join(self.store_dir, INDEX_FILE_NAME), "w") as f:
+            json.dump(
+                {
+                    "dtype": self.dtype,
+                    "codebook_num": self.codebook_num,
+                    "num_frames": self.num_frames,
+                    "items": self.items,
+                },
+                f,
+            )
+        log.info(f"Wrote {len(self.items)} cuts, {self.num_frames} frames to {self.store_dir}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CodecIndicesStore:
+    def __init__(self, store_dir: str):
+        """
+            Read only view of a store written by CodecIndicesStoreWriter
+            the binary file is memory mapped lazily, so the store can be pickled to dataloader workers
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), "r") as f:
+            index = json.load(f)
+
+        self.dtype = index["dtype"]
+        self.codebook_num = index["codebook_num"]
+        self.num_frames = index["num_frames"]
+        self.items = index["items"]
+        self._indices = None
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = np.memmap(
+                os.path.join(self.store_dir, INDICES_FILE_NAME),
+                dtype=SUPPORTED_DTYPES[self.dtype],
+                mode="r",
+                shape=(self.num_frames, self.codebook_num),
+            )
+        return self._indices
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_indices"] = None
+        return state
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, cut_id: str):
+        return cut_id in self.items
+
+    def __getitem__(self, cut_id: str) -> torch.Tensor:
+        """
+            return: [T, codebook_num], long
+        """
+        if cut_id not in self.items:
+            raise KeyError(f"Cut {cut_id} is not in the codec indices store {self.store_dir}")
+        offset, length = self.items[cut_id]
+        return torch.from_numpy(self.indices[offset : offset + length].astype(np.int64))
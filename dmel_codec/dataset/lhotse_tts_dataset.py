@@ -1,12 +1,17 @@
+import glob
 import logging
+import os
 import sys
 from torch.utils.data import DataLoader, Dataset
 from lhotse import CutSet
-from lhotse.dataset import DynamicBucketingSampler
+from lhotse.dataset import DynamicBucketingSampler, IterableDatasetWrapper, make_worker_init_fn
 from lightning import LightningDataModule
 from dmel_codec.utils.logger import RankedLogger
-from lhotse import CutSet
+from dmel_codec.dataset.codec_indices_store import CodecIndicesStore
+from dmel_codec.dataset.pcm_store import PCMStore
+from concurrent.futures import ThreadPoolExecutor
 import librosa
+import numpy as np
 import torch
 import warnings
 
@@ -14,36 +19,116 @@ log = RankedLogger(__name__, rank_zero_only=False)
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
 class LhotseTTSDataset(Dataset):
+    def __init__(
+        self,
+        codec_indices_dir: str | None = None,
+        pcm_store_dir: str | None = None,
+        num_load_threads: int = 1,
+        codec_indices_from_cuts: bool = False,
+    ):
+        """
+            codec_indices_dir: None or a store written by extract_codec_indices.py,
+                if set the batch carries the pre-extracted audio_ids instead of the audios
+            pcm_store_dir: None or a store written by extract_pcm_store.py, the audio of a cut is sliced from the
+                memory mapped shards instead of decoded with librosa, cuts missing from the store are still decoded
+            num_load_threads: the cuts of a batch are loaded by this many threads
+            codec_indices_from_cuts: read the audio_ids from the codec_indices field of the cuts,
+                attached by export_shar.py, instead of a codec indices store
+        """
+        super().__init__()
+        self.codec_indices_store = (
+            CodecIndicesStore(codec_indices_dir) if codec_indices_dir is not None else None
+        )
+        self.pcm_store = PCMStore(pcm_store_dir) if pcm_store_dir is not None else None
+        self.codec_indices_from_cuts = codec_indices_from_cuts
+        self.num_load_threads = num_load_threads
+        self._executor = None
+
+    def __getstate__(self):
+        # the thread pool can not be pickled to dataloader workers, every worker creates its own
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def load_audio(self, cut) -> torch.Tensor:
+        """
+            return: [T], peak normalized to 0.95 (same with bigvgan)
+        """
+        if (
+            self.pcm_store is not None
+            and cut.id in self.pcm_store
+            and cut.sampling_rate == self.pcm_store.sample_rate
+        ):
+            # normalized before writing
+            return self.pcm_store[cut.id]
+
+        if cut.recording.sources[0].type != "file":
+            # e.g. the in memory audio of shar cuts, already at cut.sampling_rate
+            audio = cut.load_audio().mean(axis=0)
+            return torch.FloatTensor(librosa.util.normalize(audio) * 0.95)
+
+        audio, _ = librosa.load(
+            cut.recording.sources[0].source,
+            sr=cut.sampling_rate,
+            mono=True,
+            offset=cut.start,
+            duration=cut.duration,
+        )
+        audio = librosa.util.normalize(audio) * 0.95
+        return torch.FloatTensor(audio)
+
+    def load_audios(self, cuts: CutSet) -> list[torch.Tensor]:
+        cuts = list(cuts)
+        if self.num_load_threads <= 1 or len(cuts) <= 1:
+            return [self.load_audio(cut) for cut in cuts]
+        if self._executor is None:
+            # soundfile reads and the soxr resampling of librosa release the gil
+            self._executor = ThreadPoolExecutor(max_workers=self.num_load_threads)
+        return list(self._executor.map(self.load_audio, cuts))
 
     def __getitem__(self, cuts: CutSet):
         cuts = cuts.sort_by_duration(ascending=False)
+        if self.codec_indices_store is not None or self.codec_indices_from_cuts:
+            return self.get_audio_ids_item(cuts)
 
-        # same with bigvgan
-        text_list = []
-        audio_list = []
-        audio_lens = []
-        audio_paths = []
-        for cut in cuts:
-            text = cut.supervisions[0].text
-            audio_path = cut.recording.sources[0].source
-            audio, _ = librosa.load(
-                audio_path, sr=cut.sampling_rate, mono=True, offset=cut.start, duration=cut.duration
-            )
-            audio = librosa.util.normalize(audio) * 0.95
-            audio = torch.FloatTensor(audio)
-            audio_list.append(audio)
-            audio_lens.append(audio.shape[0])
-            audio_paths.append(audio_path)
-            text_list.append(text)
-
+        audio_list = self.load_audios(cuts)
         return {
-            "text": text_list,
+            "text": [cut.supervisions[0].text for cut in cuts],
             "audios": audio_list,
-            "audio_lengths": torch.tensor(audio_lens, dtype=torch.int32),
-            "audio_paths": audio_paths,
+            "audio_lengths": torch.tensor([audio.shape[0] for audio in audio_list], dtype=torch.int32),
+            "audio_paths": [self.get_audio_path(cut) for cut in cuts],
+            "cut_ids": [cut.id for cut in cuts],
         }
 
+    @staticmethod
+    def get_audio_path(cut):
+        source = cut.recording.sources[0]
+        return source.source if source.type == "file" else cut.recording.id
+
+    def get_audio_ids(self, cut) -> torch.Tensor:
+        """
+            return: [T, codebook_num], long
+        """
+        if self.codec_indices_from_cuts:
+            return torch.from_numpy(cut.load_custom("codec_indices").astype(np.int64))
+        return self.codec_indices_store[cut.id]
+
+    def get_audio_ids_item(self, cuts: CutSet):
+        # no audio io and no codec encoding, the indices are read from the memory mapped store or the shar shards
+        return {
+            "text": [cut.supervisions[0].text for cut in cuts],
+            "audio_ids": [self.get_audio_ids(cut) for cut in cuts], # list of [T, codebook_num]
+            "cut_ids": [cut.id for cut in cuts],
+        }
+
+    def collate_item(self, item):
+        # collate_fn of a DataLoader with batch_size=None, which passes the single item of an iterable dataset
+        return self.collate_fn([item])
+
     def collate_fn(self, batch):
+        if "audio_ids" in batch[0]:
+            return batch[0]
+
         audio_list = batch[0]["audios"]
         audio_lens = batch[0]["audio_lengths"]
         max_length = max(audio_lens)
@@ -62,6 +147,7 @@ class LhotseTTSDataset(Dataset):
             "audios": audios,
             "audio_lengths": audio_lens.reshape(1, -1),
             "audio_paths": batch[0]["audio_paths"],
+            "cut_ids": batch[0]["cut_ids"],
         }
 
 
@@ -82,6 +168,24 @@ class LhotseDataModule(LightningDataModule):
         test_num_workers: str | None = None,
         pin_memory: bool = False,
         world_size: int | None = None,
+
+        # pre-extracted codec indices, Optional
+        train_codec_indices_dir: str | None = None,
+        val_codec_indices_dir: str | None = None,
+        test_codec_indices_dir: str | None = None,
+
+        # pre-decoded pcm shards, Optional
+        train_pcm_store_dir: str | None = None,
+        val_pcm_store_dir: str | None = None,
+        test_pcm_store_dir: str | None = None,
+        num_load_threads: int = 1,
+
+        # sequentially read shar shards of the train cutset written by export_shar.py, Optional
+        train_shar_dir: str | None = None,
+        shar_codec_indices: bool = False,
+        shuffle_buffer_size: int = 10000,
+        bucket_buffer_size: int = 100000,
+        shar_seed: int = 42,
     ):
         """
         stage: fit, validate, test, required=True
@@ -97,6 +201,27 @@ class LhotseDataModule(LightningDataModule):
 
         test_cuts_path: str | None = None
             note: test cutset path
+
+        train_codec_indices_dir, val_codec_indices_dir, test_codec_indices_dir: str | None = None
+            note: codec indices store written by extract_codec_indices.py, the dataset reads audio_ids instead of audios
+
+        train_pcm_store_dir, val_pcm_store_dir, test_pcm_store_dir: str | None = None
+            note: pcm store written by extract_pcm_store.py, the audios are sliced from it instead of decoded every epoch
+
+        num_load_threads: int = 1
+            note: threads decoding the cuts of a batch inside every dataloader worker
+
+        train_shar_dir: str | None = None
+            note: used instead of train_cuts_path, every rank and dataloader worker streams its own subset of the
+                  shards in a shuffled order, the cuts are shuffled again in a buffer of shuffle_buffer_size cuts
+            note: the train dataloader repeats the shards forever, the training length is set by trainer.max_steps
+
+        bucket_buffer_size: int = 100000
+            note: for train_shar_dir, cuts buffered by the bucketing sampler to estimate the duration buckets,
+                  independent of shuffle_buffer_size, the same as the sampler of train_cuts_path by default
+
+        shar_codec_indices: bool = False
+            note: read the codec_indices field of the shards as audio_ids, the audio shards are not read
         """
         super().__init__()
 
@@ -133,6 +258,18 @@ class LhotseDataModule(LightningDataModule):
             self._set_up_test_dataset()
 
     def train_dataloader(self):
+        if self.hparams.train_shar_dir is not None:
+            rank = self.trainer.global_rank if self.trainer is not None else 0
+            return DataLoader(
+                # the sampler runs inside the workers, each on the shards assigned to it
+                dataset=IterableDatasetWrapper(self.train_dataset, self.train_sampler),
+                batch_size=None,
+                num_workers=self.hparams.train_num_workers,
+                pin_memory=self.hparams.pin_memory,
+                collate_fn=self.train_dataset.collate_item,
+                worker_init_fn=make_worker_init_fn(rank=rank, world_size=self.hparams.world_size or 1),
+            )
+
         return DataLoader(
             dataset=self.train_dataset,
             sampler=self.train_sampler,
@@ -161,7 +298,9 @@ class LhotseDataModule(LightningDataModule):
 
     # check train hparams and load train filelist if train filelist is not None
     def _train_stage_hparams_check(self):
-        assert self.hparams.train_cuts_path is not None, "train_cuts_path must be provided"
+        assert (
+            self.hparams.train_cuts_path is not None or self.hparams.train_shar_dir is not None
+        ), "train_cuts_path or train_shar_dir must be provided"
         assert self.hparams.train_max_durations is not None, "train_max_durations must be provided"
         assert self.hparams.train_num_workers is not None, "train_num_workers must be provided"
 
@@ -179,8 +318,16 @@ class LhotseDataModule(LightningDataModule):
 
     # load train dataset
     def _set_up_train_dataset(self):
+        if self.hparams.train_shar_dir is not None:
+            self._set_up_train_shar_dataset()
+            return
+
         train_cut = CutSet.from_jsonl_lazy(self.hparams.train_cuts_path)
-        self.train_dataset = LhotseTTSDataset()
+        self.train_dataset = LhotseTTSDataset(
+            codec_indices_dir=self.hparams.train_codec_indices_dir,
+            pcm_store_dir=self.hparams.train_pcm_store_dir,
+            num_load_threads=self.hparams.num_load_threads,
+        )
         self.train_sampler = DynamicBucketingSampler(
             train_cut,
             max_duration=self.hparams.train_max_durations,
@@ -191,10 +338,52 @@ class LhotseDataModule(LightningDataModule):
         )
         log.info(f"train_sampler: {self.train_sampler}")
 
+    # stream train dataset from shar shards
+    def _set_up_train_shar_dataset(self):
+        field = "codec_indices" if self.hparams.shar_codec_indices else "recording"
+        fields = {
+            name: sorted(glob.glob(os.path.join(self.hparams.train_shar_dir, f"{name}.*")))
+            for name in ["cuts", field]
+        }
+        num_readers = (self.hparams.world_size or 1) * max(self.hparams.train_num_workers, 1)
+        if len(fields["cuts"]) < num_readers:
+            log.warning(
+                f"{len(fields['cuts'])} shar shards for {num_readers} dataloader workers, some workers get no data"
+            )
+
+        train_cut = CutSet.from_shar(
+            fields=fields,
+            split_for_dataloading=True, # unique shards for every rank and worker
+            shuffle_shards=True,
+            stateful_shuffle=True, # a new shard order every pass
+            seed=self.hparams.shar_seed,
+        ).repeat(preserve_id=True)
+        self.train_dataset = LhotseTTSDataset(
+            num_load_threads=self.hparams.num_load_threads,
+            codec_indices_from_cuts=self.hparams.shar_codec_indices,
+        )
+        # the shards are already split across ranks, so every sampler sees a single rank
+        self.train_sampler = DynamicBucketingSampler(
+            train_cut,
+            max_duration=self.hparams.train_max_durations,
+            shuffle=True,
+            drop_last=False,
+            world_size=1,
+            rank=0,
+            buffer_size=self.hparams.bucket_buffer_size,
+            shuffle_buffer_size=self.hparams.shuffle_buffer_size,
+            seed="randomized", # seeded per worker by make_worker_init_fn
+        )
+        log.info(f"train_sampler: {self.train_sampler}, shards: {len(fields['cuts'])}")
+
     # load val dataset
     def _set_up_val_dataset(self):
         val_cut = CutSet.from_jsonl_lazy(self.hparams.val_cuts_path)
-        self.val_dataset = LhotseTTSDataset()
+        self.val_dataset = LhotseTTSDataset(
+            codec_indices_dir=self.hparams.val_codec_indices_dir,
+            pcm_store_dir=self.hparams.val_pcm_store_dir,
+            num_load_threads=self.hparams.num_load_threads,
+        )
         self.val_sampler = DynamicBucketingSampler(
             val_cut,
             max_duration=self.hparams.val_max_durations,
@@ -207,7 +396,11 @@ class LhotseDataModule(LightningDataModule):
     # load test dataset
     def _set_up_test_dataset(self):
         test_cut = CutSet.from_jsonl_lazy(self.hparams.test_cuts_path)
-        self.test_dataset = LhotseTTSDataset()
+        self.test_dataset = LhotseTTSDataset(
+            codec_indices_dir=self.hparams.test_codec_indices_dir,
+            pcm_store_dir=self.hparams.test_pcm_store_dir,
+            num_load_threads=self.hparams.num_load_threads,
+        )
         self.test_sampler = DynamicBucketingSampler(
             test_cut,
             max_duration=self.hparams.test_max_durations,
@@ -0,0 +1,157 @@
+import json
+import os
+import numpy as np
+import torch
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=False)
+
+INDEX_FILE_NAME = "index.json"
+SUPPORTED_DTYPES = {"int16": np.int16, "float16": np.float16}
+INT16_SCALE = 32767.0
+
+
+def shard_file_name(shard_id: int):
+    return f"pcm-{shard_id:05d}.bin"
+
+
+class PCMStoreWriter:
+    def __init__(
+        self,
+        store_dir: str,
+        sample_rate: int,
+        dtype: str = "int16",
+        shard_samples: int = 2 ** 28,
+    ):
+        """
+            Write the decoded audio of a cutset to flat pcm shards and a json index keyed by cut id
+            store_dir: output directory, pcm-xxxxx.bin and index.json are written into it
+            sample_rate: every cut is written at this rate
+            dtype: int16 or float16, both are 2 bytes per sample, int16 keeps more precision for audio in [-1, 1]
+            shard_samples: a new shard is started once the current one holds this many samples, a cut never spans shards
+        """
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}, please use one of {list(SUPPORTED_DTYPES)}")
+
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.sample_rate = sample_rate
+        self.dtype = dtype
+        self.shard_samples = shard_samples
+        self.items = {}
+        self.shards = [] # number of samples of every shard
+        self.file = None
+        self.num_samples = 0
+
+    def next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(os.path.join(self.store_dir, shard_file_name(len(self.shards))), "wb")
+        self.shards.append(0)
+
+    def write(self, cut_id: str, audio: torch.Tensor | np.ndarray):
+        """
+            audio: [T] float in [-1, 1]
+        """
+        if cut_id in self.items:
+            raise ValueError(f"Duplicate cut id: {cut_id}")
+        if isinstance(audio, torch.Tensor):
+            audio = audio.detach().float().cpu().numpy()
+        audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+
+        if self.dtype == "int16":
+            pcm = np.round(np.clip(audio, -1.0, 1.0) * INT16_SCALE).astype(np.int16)
+        else:
+            pcm = audio.astype(np.float16)
+
+        if self.file is None or (self.shards[-1] > 0 and self.shards[-1] + pcm.shape[0] > self.shard_samples):
+            self.next_shard()
+        self.file.write(pcm.tobytes())
+        self.items[cut_id] = [len(self.shards) - 1, self.shards[-1], pcm.shape[0]]
+        self.shards[-1] += pcm.shape[0]
+        self.num_samples += pcm.shape[0]
+
+    def close(self):
+        if self.file is not None and self.file.closed:
+            return
+        if self.file is not None:
+            self.file.close()
+        with open(os.path.join(self.store_dir, INDEX_FILE_NAME), "w") as f:
+            json.dump(
+                {
+                    "dtype": self.dtype,
+                    "sample_rate": self.sample_rate,
+                    "shards": self.shards,
+                    "items": self.items,
+                },
+                f,
+            )
+        log.info(
+            f"Wrote {len(self.items)} cuts, {self.num_samples / self.sample_rate / 3600:.2f} hours "
+            f"in {len(self.shards)} shards to {self.store_dir}"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PCMStore:
+    def __init__(self, store_dir: str):
+        """
+            Read only view of a store written by PCMStoreWriter
+            the shards are memory mapped lazily, so the store can be pickled to dataloader workers
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), "r") as f:
+            index = json.load(f)
+
+        self.dtype = index["dtype"]
+        self.sample_rate = index["sample_rate"]
+        self.shards = index["shards"]
+        self.items = index["items"]
+        self._pcm = [None] * len(self.shards)
+
+    def shard(self, shard_id: int):
+        if self._pcm[shard_id] is None:
+            self._pcm[shard_id] = np.memmap(
+                os.path.join(self.store_dir, shard_file_name(shard_id)),
+                dtype=SUPPORTED_DTYPES[self.dtype],
+                mode="r",
+                shape=(self.shards[shard_id],),
+            )
+        return self._pcm[shard_id]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pcm"] = [None] * len(self.shards)
+        return state
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, cut_id: str):
+        return cut_id in self.items
+
+    def get_pcm(self, cut_id: str, start: int = 0, length: int | None = None) -> np.ndarray:
+        """
+            zero copy view of the stored samples of a cut, no file read happens until the samples are touched
+            start, length: optional sub range in samples
+            return: [length], int16 or float16
+        """
+        if cut_id not in self.items:
+            raise KeyError(f"Cut {cut_id} is not in the pcm store {self.store_dir}")
+        shard_id, offset, num_samples = self.items[cut_id]
+        length = num_samples - start if length is None else min(length, num_samples - start)
+        return self.shard(shard_id)[offset + start : offset + start + max(length, 0)]
+
+    def __getitem__(self, cut_id: str) -> torch.Tensor:
+        """
+            return: [T], float32 in [-1, 1]
+        """
+        pcm = self.get_pcm(cut_id)
+        if self.dtype == "int16":
+            return torch.from_numpy(pcm.astype(np.float32) / INT16_SCALE)
+        return torch.from_numpy(pcm.astype(np.float32))
@@ -1,3 +1,4 @@
+import json
 import logging
 import sys
 import os
@@ -9,7 +10,9 @@ from dmel_codec.utils.logger import RankedLogger
 from time import time
 from tqdm import tqdm
 from lhotse.supervision import SupervisionSegment
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import random
+import shutil
 
 log = RankedLogger(__name__, rank_zero_only=False)
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -73,6 +76,10 @@ class LhotsePreProcess(LightningDataModule):
         max_duration: float | None = None,
         num_jobs: int = 10,
         shuffle_train_cuts: bool = False,
+        lazy: bool = False,
+        shuffle_buffer_size: int = 100000,
+        num_workers: int = 1,
+        keep_shards: bool = False,
     ):
         """
         output_dir: str
@@ -105,6 +112,23 @@ class LhotsePreProcess(LightningDataModule):
         max_duration: float | None = None
             note: for cutset, max duration, default None, just for train cutset
 
+        lazy: bool = False
+            note: stream the train cuts and cuts filelist in a single pass with constant memory, nothing is made eager,
+                  windowing runs in one process and shuffle_train_cuts shuffles inside a buffer of shuffle_buffer_size cuts
+            note: the train recordings and supervisions are still joined in memory by CutSet.from_manifests
+
+        shuffle_buffer_size: int = 100000
+            note: for lazy, approximate shuffle buffer of the train cuts, default 100000
+
+        num_workers: int = 1
+            note: for train cutset, processes running the lazy process_cuts_for_train on the train cuts files in parallel,
+                  every file is written as a shard, then the shards are merged into the train cutset and a _stats.json
+            note: shuffle_train_cuts follows lazy, the merged file is the same as the one of num_workers = 1
+
+        keep_shards: bool = False
+            note: for num_workers > 1, keep the shard directory after the merge, by default it is removed once the
+                  _stats.json is written
+
         """
         super().__init__()
 
@@ -159,8 +183,18 @@ class LhotsePreProcess(LightningDataModule):
         return simplified_cut
         
 
+    # bound methods instead of lambdas, the lazy filters are pickled to the process pool workers
+    def filter_min_duration(self, cut):
+        return cut.duration >= self.hparams.min_duration
+
+    def filter_max_duration(self, cut):
+        return cut.duration <= self.hparams.max_duration
+
     def process_cuts_for_train(self, cuts: CutSet):
         log.info(f"original cuts: {cuts}")
+        if self.hparams.lazy:
+            return self.process_cuts_for_train_lazy(cuts)
+
         cuts = cuts.to_eager()
         cuts = cuts.map(self.simplify_cut)
         
@@ -171,12 +205,12 @@ class LhotsePreProcess(LightningDataModule):
             log.info(f"cut_into_windows time: {end_time - start_time}")
         if self.hparams.min_duration is not None:
             start_time = time()
-            cuts = cuts.filter(lambda cut: cut.duration >= self.hparams.min_duration)
+            cuts = cuts.filter(self.filter_min_duration)
             end_time = time()
             log.info(f"filter min_duration time: {end_time - start_time}")
         if self.hparams.max_duration is not None:
             start_time = time()
-            cuts = cuts.filter(lambda cut: cut.duration <= self.hparams.max_duration)
+            cuts = cuts.filter(self.filter_max_duration)
             end_time = time()
             log.info(f"filter max_duration time: {end_time - start_time}")
 
@@ -184,6 +218,36 @@ class LhotsePreProcess(LightningDataModule):
         log.info(f"processed cuts: {cuts}")
         return cuts
 
+    def process_cuts_for_train_lazy(self, cuts: CutSet):
+        # the same transforms as process_cuts_for_train, applied cut by cut while the output file is written
+        cuts = cuts.map(self.simplify_cut)
+        if self.hparams.window_size is not None:
+            # num_jobs > 1 splits the cutset into eager parts
+            cuts = cuts.cut_into_windows(duration=self.hparams.window_size, num_jobs=1)
+        if self.hparams.min_duration is not None:
+            cuts = cuts.filter(self.filter_min_duration)
+        if self.hparams.max_duration is not None:
+            cuts = cuts.filter(self.filter_max_duration)
+        return cuts
+
+    def write_cuts_with_stats(self, cuts: CutSet, path: str, desc: str = "write cuts"):
+        """
+            write cuts to path while counting them, a single pass over a lazy cutset
+            return: stats dict
+        """
+        stats = {"num_cuts": 0, "duration": 0.0, "min_duration": None, "max_duration": None}
+        with CutSet.open_writer(path) as writer:
+            for cut in tqdm(cuts, desc=desc):
+                writer.write(cut)
+                stats["num_cuts"] += 1
+                stats["duration"] += cut.duration
+                if stats["min_duration"] is None or cut.duration < stats["min_duration"]:
+                    stats["min_duration"] = cut.duration
+                if stats["max_duration"] is None or cut.duration > stats["max_duration"]:
+                    stats["max_duration"] = cut.duration
+        stats["hours"] = stats["duration"] / 3600
+        return stats
+
     def hparams_check(self):
         if self.hparams.stage == "fit":
             self._train_stage_hparams_check()
@@ -499,8 +563,45 @@ class LhotsePreProcess(LightningDataModule):
 
     # load train dataset
     def _save_train_cutset(self):
-        # train_recordings and train_supervisions
+        if self.hparams.num_workers > 1:
+            self._save_train_cutset_parallel()
+            return
+
         self.train_cuts = CutSet()
+        manifest_cuts = self._get_train_manifest_cuts()
+        if manifest_cuts is not None:
+            self.train_cuts += manifest_cuts
+
+        # train_cuts and train_cuts_filelist
+        # process cuts one by one is faster than process all cuts at once
+        for path, prefix in tqdm(self._get_train_cuts_files(), desc="load train_cuts"):
+            self.train_cuts += self.process_cuts_for_train(self.load_train_cuts_file(path, prefix))
+
+        save_file_name = self._get_train_save_file_name()
+
+        # shuffle cuts
+        if self.hparams.shuffle_train_cuts:
+            log.info(f"shuffle train_cuts start")
+            if self.hparams.lazy:
+                # shuffled in a buffer while it is written
+                self.train_cuts = self.train_cuts.shuffle(
+                    rng=random.Random(666), buffer_size=self.hparams.shuffle_buffer_size
+                )
+            else:
+                self.train_cuts = self.train_cuts.shuffle(rng=random.Random(666))
+            log.info(f"shuffle train_cuts success")
+
+        # the statistics are computed while writing, no extra pass over the cuts
+        stats = self.write_cuts_with_stats(
+            self.train_cuts, os.path.join(self.hparams.output_dir, save_file_name), desc="save train_cuts"
+        )
+        log.info(f"all cuts duration: {stats['duration']}")
+        log.info(f"all cuts num: {stats['num_cuts']}")
+        log.info(f"train_cuts stats: {stats}")
+        log.info(f"save train_cuts to {os.path.join(self.hparams.output_dir, save_file_name)}")
+
+    def _get_train_manifest_cuts(self):
+        # train_recordings and train_supervisions
         self.train_recordings = RecordingSet()
         self.train_supervisions = SupervisionSet()
         if self.hparams.train_recordings_paths is not None:
@@ -548,70 +649,124 @@ class LhotsePreProcess(LightningDataModule):
         if (self.hparams.train_recordings_paths is not None) or (
             self.hparams.train_recordings_filelist is not None
         ):
-
-            self.train_cuts += CutSet.from_manifests(
-                recordings=self.train_recordings, supervisions=self.train_supervisions
+            return self.process_cuts_for_train(
+                CutSet.from_manifests(recordings=self.train_recordings, supervisions=self.train_supervisions)
             )
-            self.train_cuts = self.process_cuts_for_train(self.train_cuts)
+        return None
 
-        # train_cuts
+    def _get_train_cuts_files(self):
+        """
+            return: [(cuts jsonl path, recording path prefix)] of train_cuts_paths and train_cuts_filelist
+        """
+        files = []
         if self.hparams.train_cuts_paths is not None:
             for idx, path in enumerate(self.hparams.train_cuts_paths):
-                tmp_cuts = CutSet.from_jsonl_lazy(path)
-                tmp_cuts = tmp_cuts.resample(self.hparams.sample_rate)
-                if self.hparams.train_cuts_prefix is not None:
-                    prefix = self.hparams.train_cuts_prefix[idx]
-                    if prefix != "":
-                        tmp_cuts = tmp_cuts.with_recording_path_prefix(prefix)
-                tmp_cuts = self.process_cuts_for_train(tmp_cuts)
-                self.train_cuts += tmp_cuts
+                prefix = self.hparams.train_cuts_prefix[idx] if self.hparams.train_cuts_prefix is not None else ""
+                files.append((path, prefix))
 
-        # train_cuts_filelist
         if self.hparams.train_cuts_filelist is not None:
             for idx, path_list in enumerate(
                 self.hparams.train_cuts_paths_list
             ):  # self.hparams.train_cuts_paths_list: [[xxx], [xxx]]
-                tmp_cuts = CutSet()
                 # all cuts in one filelist.txt use the same prefix
                 if self.hparams.train_cuts_filelist_prefix is not None:
                     prefix = self.hparams.train_cuts_filelist_prefix[idx]
                 else:
                     prefix = ""
-                for path in tqdm(path_list, desc="load train_cuts_filelist"):
-                    tmp_tmp_cuts =  CutSet.from_jsonl_lazy(path)
-                    # resample
-                    tmp_tmp_cuts = tmp_tmp_cuts.resample(self.hparams.sample_rate)
-                    if prefix != "":
-                        tmp_tmp_cuts = tmp_tmp_cuts.with_recording_path_prefix(prefix)
-                    # process cuts one by one is faster than process all cuts at once
-                    tmp_tmp_cuts = self.process_cuts_for_train(tmp_tmp_cuts)
-                    tmp_cuts += tmp_tmp_cuts
-                self.train_cuts += tmp_cuts
+                files.extend((path, prefix) for path in path_list)
+        return files
+
+    def load_train_cuts_file(self, path: str, prefix: str):
+        cuts = CutSet.from_jsonl_lazy(path)
+        # resample
+        cuts = cuts.resample(self.hparams.sample_rate)
+        if prefix != "":
+            cuts = cuts.with_recording_path_prefix(prefix)
+        return cuts
 
+    def _get_train_save_file_name(self):
         windows = self.hparams.window_size if self.hparams.window_size is not None else "None"
         min_duration = self.hparams.min_duration if self.hparams.min_duration is not None else "None"
         max_duration = self.hparams.max_duration if self.hparams.max_duration is not None else "None"
         shuffle_train_cuts = "True" if self.hparams.shuffle_train_cuts else "False"
+        return f"train_cuts_windows-{windows}_min_duration-{min_duration}_max_duration-{max_duration}_shuffle-{shuffle_train_cuts}.jsonl.gz"
 
-        save_file_name = f"train_cuts_windows-{windows}_min_duration-{min_duration}_max_duration-{max_duration}_shuffle-{shuffle_train_cuts}.jsonl.gz"
-        all_cuts_duration = 0.0
-        all_cuts_num = 0
-        for cut in tqdm(self.train_cuts, desc="calculate train_cuts duration"):
-            all_cuts_duration += cut.duration
-            all_cuts_num += 1
-        log.info(f"all cuts duration: {all_cuts_duration}")
-        log.info(f"all cuts num: {all_cuts_num}")
-
-        # shuffle cuts
+    def process_train_cuts_shard(self, path: str, prefix: str, shard_path: str):
+        """
+            process one cuts file in a worker process and write it as a shard, the transforms are lazy,
+            the parallelism comes from the pool, so a worker does not start its own windowing jobs
+            return: stats dict of the shard
+        """
+        cuts = self.process_cuts_for_train_lazy(self.load_train_cuts_file(path, prefix))
+        stats = self.write_cuts_with_stats(cuts, shard_path, desc=os.path.basename(path))
+        stats["input_path"] = path
+        return stats
+
+    def _save_train_cutset_parallel(self):
+        save_file_name = self._get_train_save_file_name()
+        shard_dir = os.path.join(self.hparams.output_dir, save_file_name.replace(".jsonl.gz", "_shards"))
+        os.makedirs(shard_dir, exist_ok=True)
+        files = self._get_train_cuts_files()
+        log.info(f"process {len(files)} train cuts files with {self.hparams.num_workers} workers, shards in {shard_dir}")
+
+        start_time = time()
+        shard_paths = []
+        shard_stats = []
+        with ProcessPoolExecutor(self.hparams.num_workers) as pool:
+            futures = []
+            for idx, (path, prefix) in enumerate(files):
+                shard_path = os.path.join(shard_dir, f"shard-{idx:06d}.jsonl.gz")
+                futures.append(pool.submit(self.process_train_cuts_shard, path, prefix, shard_path))
+                shard_paths.append(shard_path)
+
+            # the recordings and supervisions are joined in this process while the workers run
+            manifest_cuts = self._get_train_manifest_cuts()
+            if manifest_cuts is not None:
+                shard_path = os.path.join(shard_dir, "shard-manifests.jsonl.gz")
+                stats = self.write_cuts_with_stats(manifest_cuts, shard_path, desc="save train manifests")
+                stats["input_path"] = "train_recordings + train_supervisions"
+                # first, the same order as the sequential mode
+                shard_paths.insert(0, shard_path)
+                shard_stats.append(stats)
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="process train_cuts shards"):
+                shard_stats.append(future.result())
+        log.info(f"process train_cuts shards time: {time() - start_time}")
+
+        # merge, the shards are streamed into the train cutset
+        self.train_cuts = CutSet.from_files(shard_paths, shuffle_iters=False)
         if self.hparams.shuffle_train_cuts:
-            log.info(f"shuffle train_cuts start")
-            self.train_cuts = self.train_cuts.shuffle(rng=random.Random(666))
-            log.info(f"shuffle train_cuts success")
-
-        self.train_cuts.to_file(
-            os.path.join(self.hparams.output_dir, save_file_name)
-        )
-        log.info(f"save train_cuts to {os.path.join(self.hparams.output_dir, save_file_name)}")
+            if self.hparams.lazy:
+                self.train_cuts = self.train_cuts.shuffle(
+                    rng=random.Random(666), buffer_size=self.hparams.shuffle_buffer_size
+                )
+            else:
+                # the same call on the same lazy chain of cuts as the sequential mode, so both write the same file
+                self.train_cuts = self.train_cuts.shuffle(rng=random.Random(666))
+        save_path = os.path.join(self.hparams.output_dir, save_file_name)
+        stats = self.write_cuts_with_stats(self.train_cuts, save_path, desc="merge train_cuts")
+        stats["num_shards"] = len(shard_paths)
+        stats["num_workers"] = self.hparams.num_workers
+        stats["total_time"] = time() - start_time
+        stats["shards"] = shard_stats
+
+        stats_path = save_path.replace(".jsonl.gz", "_stats.json")
+        with open(stats_path, "w") as f:
+            json.dump(stats, f, indent=2)
+        log.info(f"train_cuts stats: { {key: value for key, value in stats.items() if key != 'shards'} }")
+        log.info(f"save train_cuts to {save_path}, stats to {stats_path}")
+
+        if not self.hparams.keep_shards:
+            shutil.rmtree(shard_dir)
+            log.info(f"remove train_cuts shards {shard_dir}")
+
+    def __getstate__(self):
+        # the process pool workers only need the hparams, not the loaded manifests
+        state = self.__dict__.copy()
+        for split in ["train", "val", "test"]:
+            for name in ["cuts", "recordings", "supervisions"]:
+                state.pop(f"{split}_{name}", None)
+        return state
 
     # load val dataset
     def _save_val_cutset(self):
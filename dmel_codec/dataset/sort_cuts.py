@@ -1,50 +1,175 @@
-from lhotse import CutSet
-import multiprocessing as mp
-from itertools import islice
+import argparse
+import gzip
+import heapq
+import json
+import os
+import resource
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from time import perf_counter
 from tqdm import tqdm
 
-def process_chunk(chunk):
-    """处理单个块：转为eager并返回排序后的块"""
-    chunk = chunk.to_eager()
-    return chunk.sort_by_duration()
-
-def chunked_iterator(cuts, chunk_size=5000):
-    """将CutSet分块生成"""
-    iterator = iter(cuts)
-    while True:
-        chunk = list(islice(iterator, chunk_size))
-        if not chunk:
-            break
-        yield CutSet.from_cuts(chunk)
-
-input_path = "/data0/questar/users/wuzhiyue/emilia/train_cuts_windows-None_min_duration-None_max_duration-40_shuffle-True.jsonl.gz"
-output_path = "/data0/questar/users/wuzhiyue/emilia/sorted_train_cuts.jsonl.gz"
-
-# 参数配置
-chunk_size = 2000  # 根据内存调整块大小
-num_workers = 100     # 根据CPU核心数调整
-
-# 延迟加载原始数据
-cuts = CutSet.from_jsonl_lazy(input_path)
-print('load cuts done')
-
-# 多进程分块处理
-with mp.Pool(num_workers) as pool:
-    # 分块并行处理（排序单个块）
-    chunk_iter = chunked_iterator(cuts, chunk_size=chunk_size)
-    # 计算总块数
-    total_chunks = (len(cuts) + chunk_size - 1) // chunk_size
-    sorted_chunks = pool.imap(
-        process_chunk,
-        chunk_iter,
-        chunksize=100 # 每次提交100个块给worker
-    )
-    # 使用tqdm添加进度条
-    sorted_chunks_with_progress = tqdm(sorted_chunks, total=total_chunks, desc="Processing chunks")
-    # 合并并最终排序
-    final_cuts = CutSet.from_cuts(
-        cut for chunk in sorted_chunks_with_progress for cut in chunk
-    ).sort_by_duration()
-
-# 保存结果
-final_cuts.to_file(output_path)
\ No newline at end of file
+# python overhead of one buffered line, str header and list slot
+LINE_OVERHEAD_BYTES = 100
+
+
+def open_text(path: str, mode: str):
+    if path.endswith(".gz"):
+        # level 1, the runs are read once and the output is written once
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=1 if "w" in mode else 9)
+    return open(path, mode, encoding="utf-8")
+
+
+def read_run(path: str):
+    """
+        yield (duration, cut json line) of a run written by sort_run
+    """
+    with open_text(path, "r") as f:
+        for line in f:
+            duration, cut_line = line.split("\t", 1)
+            yield float(duration), cut_line
+
+
+def sort_run(lines: list[str], path: str, descending: bool = False):
+    """
+        sort the cut json lines of a chunk by duration and write them as "duration\\tline" rows,
+        sorted() is stable, so cuts of equal duration keep the input order like CutSet.sort_by_duration
+        return: (path, number of cuts)
+    """
+    rows = [(json.loads(line)["duration"], line) for line in lines]
+    rows.sort(key=lambda row: row[0], reverse=descending)
+    with open_text(path, "w") as f:
+        for duration, line in rows:
+            f.write(f"{duration!r}\t{line}")
+    return path, len(rows)
+
+
+def merge_runs(run_paths: list[str], write_row, descending: bool = False):
+    """
+        k-way heap merge of sorted runs, ties are taken from the earlier run so the merge stays stable
+    """
+    for row in heapq.merge(*[read_run(path) for path in run_paths], key=lambda row: row[0], reverse=descending):
+        write_row(*row)
+
+
+def read_chunks(input_path: str, chunk_bytes: int):
+    """
+        yield lists of cut json lines whose estimated in memory size stays below chunk_bytes
+    """
+    chunk, size = [], 0
+    with open_text(input_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            chunk.append(line)
+            size += len(line) + LINE_OVERHEAD_BYTES
+            if size >= chunk_bytes:
+                yield chunk
+                chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def external_sort_cuts(
+    input_path: str,
+    output_path: str,
+    max_memory_mb: int = 4096,
+    num_workers: int = 8,
+    merge_fan_in: int = 256,
+    tmp_dir: str | None = None,
+    descending: bool = False,
+):
+    """
+        sort a cut manifest jsonl(.gz) by duration with a bounded memory, the cuts are never parsed into lhotse objects
+        1. the input is read in chunks, every worker sorts a chunk and writes it as a run to tmp_dir
+        2. the runs are k-way merged with a heap, in several passes when there are more than merge_fan_in runs,
+           the last pass streams into output_path
+        max_memory_mb: budget of the buffered lines, split across the chunk being read and the chunks of the workers
+        return: stats dict
+    """
+    # the reader holds one chunk, every worker holds one chunk and its sorted copy
+    chunk_bytes = max(max_memory_mb * 1024 ** 2 // (2 * num_workers + 1), 1024 ** 2)
+    tmp_dir = tempfile.mkdtemp(prefix="sort_cuts_", dir=tmp_dir or os.path.dirname(os.path.abspath(output_path)))
+    stats = {"num_cuts": 0, "num_runs": 0, "merge_passes": 0}
+    start_time = perf_counter()
+    try:
+        # 1. sorted runs
+        run_paths = []
+        with ProcessPoolExecutor(num_workers) as pool, tqdm(desc="Sorting runs", unit="cuts") as progress:
+            pending = set()
+            for i, chunk in enumerate(read_chunks(input_path, chunk_bytes)):
+                pending.add(pool.submit(sort_run, chunk, os.path.join(tmp_dir, f"run-{i:06d}.tsv.gz"), descending))
+                del chunk
+                # bounded submission, the reader waits instead of queueing the whole manifest
+                while len(pending) >= num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        progress.update(future.result()[1])
+            for future in pending:
+                progress.update(future.result()[1])
+            # sorted by name, i.e. by input order, which keeps the merge stable
+            run_paths = sorted(os.path.join(tmp_dir, name) for name in os.listdir(tmp_dir))
+        stats["num_runs"] = len(run_paths)
+        stats["sort_time"] = perf_counter() - start_time
+
+        # 2. intermediate merges until the last pass can open every run
+        while len(run_paths) > merge_fan_in:
+            stats["merge_passes"] += 1
+            merged_paths = []
+            for i in range(0, len(run_paths), merge_fan_in):
+                merged_path = os.path.join(tmp_dir, f"merge-{stats['merge_passes']:02d}-{i // merge_fan_in:06d}.tsv.gz")
+                with open_text(merged_path, "w") as f:
+                    merge_runs(
+                        run_paths[i : i + merge_fan_in],
+                        lambda duration, line: f.write(f"{duration!r}\t{line}"),
+                        descending,
+                    )
+                for path in run_paths[i : i + merge_fan_in]:
+                    os.remove(path)
+                merged_paths.append(merged_path)
+            run_paths = merged_paths
+
+        # 3. final merge into the output manifest
+        stats["merge_passes"] += 1
+        total_duration = 0.0
+        with open_text(output_path, "w") as f, tqdm(desc="Merging runs", unit="cuts") as progress:
+            def write_row(duration, line):
+                nonlocal total_duration
+                f.write(line)
+                total_duration += duration
+                stats["num_cuts"] += 1
+                progress.update(1)
+
+            merge_runs(run_paths, write_row, descending)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    stats["total_time"] = perf_counter() - start_time
+    stats["total_hours"] = total_duration / 3600
+    stats["cuts_per_second"] = stats["num_cuts"] / max(stats["total_time"], 1e-9)
+    stats["input_mb_per_second"] = os.path.getsize(input_path) / 1024 ** 2 / max(stats["total_time"], 1e-9)
+    # ru_maxrss is in KB on linux, workers are reported separately
+    stats["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    stats["peak_worker_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"Sorted {input_path} into {output_path}: {json.dumps(stats, indent=2)}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="external merge sort of a cut manifest by duration")
+    parser.add_argument("--input_path", required=True, help="cuts jsonl or jsonl.gz")
+    parser.add_argument("--output_path", required=True, help="sorted cuts jsonl or jsonl.gz")
+    parser.add_argument("--max_memory_mb", type=int, default=4096, help="budget of the buffered cut lines")
+    parser.add_argument("--num_workers", type=int, default=8, help="processes sorting the runs")
+    parser.add_argument("--merge_fan_in", type=int, default=256, help="max runs opened by one merge")
+    parser.add_argument("--tmp_dir", default=None, help="directory of the runs, defaults to the output directory")
+    parser.add_argument("--descending", action="store_true", help="longest cuts first")
+    args = parser.parse_args()
+    external_sort_cuts(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
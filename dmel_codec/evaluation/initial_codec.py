@@ -1,3 +1,4 @@
+import math
 import hydra
 import torch
 from hydra.utils import instantiate
@@ -13,8 +14,14 @@ class InitialCodec:
         sample_rate: int = 24000,
         num_quantizers: int | None = None,
         config_path: str = None,
+        decode_cache=None,
     ):
+        """
+            decode_cache: None or a dmel_codec.serving.decode_cache.DecodedAudioCache used by rec_audio_from_indices,
+                          dMel only, the codec decodes with its fixed seeded noise so the audio can be cached
+        """
         self.codec_name = codec_name
+        self.decode_cache = decode_cache
         self.ckpt_path = ckpt_path
         self.device = device
         self.sample_rate = sample_rate
@@ -62,6 +69,8 @@ class InitialCodec:
 
         self.codec.to(self.device)
         self.codec.eval()
+        if self.decode_cache is not None:
+            self.codec.fixed_decode_noise = True
 
     def hparams_check(self):
         assert self.codec_name in [
@@ -75,6 +84,8 @@ class InitialCodec:
             assert (
                 self.ckpt_path is not None
             ), "ckpt_path must be provided for dMel codec"
+        else:
+            assert self.decode_cache is None, "decode_cache is only supported for dMel codec"
         if self.codec_name == "mimi":
             assert self.ckpt_path is not None, "ckpt_path must be provided for mimi codec"
         
@@ -196,7 +207,10 @@ class InitialCodec:
         indices: [B, C, L]
         '''
         gen_mel = None
-        if self.codec_name == "dMel":
+        if self.codec_name == "dMel" and self.decode_cache is not None:
+            rec_audios = self.rec_audio_from_indices_with_cache(indices, indices_lengths)
+
+        elif self.codec_name == "dMel":
             rec_audios, gen_mel = self.codec.decode(indices, indices_lengths, return_audios=True)
 
         elif self.codec_name == "speechtokenizer":
@@ -219,6 +233,33 @@ class InitialCodec:
 
         return rec_audios, gen_mel
 
+    def rec_audio_from_indices_with_cache(self, indices: torch.Tensor, indices_lengths: torch.Tensor):
+        '''
+        only the samples missing in decode_cache are decoded, gen_mel is not cached
+        the missing samples are batched by length without padding, so the cached audio does not depend on the batch
+        indices: [B, C, L]
+        return: [B, 1, L * samples_per_frame]
+        '''
+        samples_per_frame = math.prod(self.codec.quantizer.downsample_factor) * self.codec.gt_mel_transform.hop_length
+        lengths = indices_lengths.view(-1).tolist()
+        keys = [self.decode_cache.key(indices[i, :, :lengths[i]]) for i in range(len(lengths))]
+        audios = [self.decode_cache.get(key) for key in keys]
+
+        missing_lengths = {lengths[i] for i, audio in enumerate(audios) if audio is None}
+        for length in missing_lengths:
+            missing = [i for i, audio in enumerate(audios) if audio is None and lengths[i] == length]
+            missing_audios, _ = self.codec.decode(
+                indices[missing, :, :length], indices_lengths.view(-1)[missing], return_audios=True
+            )
+            for j, i in enumerate(missing):
+                audios[i] = missing_audios[j].float().cpu()
+                self.decode_cache.put(keys[i], audios[i])
+
+        rec_audios = torch.zeros(len(lengths), 1, indices.shape[2] * samples_per_frame)
+        for i, audio in enumerate(audios):
+            rec_audios[i, :, :audio.shape[-1]] = audio
+        return rec_audios.to(indices.device)
+
     @torch.inference_mode()
     def rec_audio_from_audio(self, audios: torch.Tensor, audio_lens: torch.Tensor):
         gen_mel = None
@@ -0,0 +1,50 @@
+import hydra
+import torch
+from omegaconf import DictConfig
+import dmel_codec
+from dmel_codec.models.codec_export import (
+    ExportedCodec,
+    benchmark_exported_codec,
+    export_codec,
+    verify_exported_codec,
+)
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+
+dmel_root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+@hydra.main(config_path=f"{dmel_root_path}/config/lm", config_name="export_codec.yaml", version_base=None)
+def main(config: DictConfig) -> None:
+    print_config_tree(config)
+
+    logger.info(f"Instantiating codec model <{config.model.codec_model._target_}>.")
+    codec_model = hydra.utils.instantiate(config.model.codec_model, _convert_="partial")
+    codec_model.load_state_dict(
+        torch.load(config.codec_ckpt_path, map_location="cpu")["state_dict"], strict=False
+    )
+    codec_model.eval()
+    if config.optimize_for_inference:
+        codec_model.optimize_for_inference()
+
+    paths = export_codec(
+        codec_model,
+        config.export_dir,
+        export_format=config.export_format,
+        example_frames=config.example_frames,
+        opset_version=config.opset_version,
+    )
+
+    if config.verify or config.benchmark:
+        exported = ExportedCodec(paths["encode"], paths["decode"], num_threads=config.num_threads)
+        if config.verify:
+            verify_exported_codec(codec_model, exported, num_frames=config.benchmark_frames)
+        if config.benchmark:
+            benchmark_exported_codec(
+                codec_model, exported, num_frames=config.benchmark_frames, num_runs=config.benchmark_runs
+            )
+    logger.info("export_finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import hydra
+import numpy as np
+from lhotse import CutSet
+from omegaconf import DictConfig
+import dmel_codec
+from dmel_codec.dataset.codec_indices_store import SUPPORTED_DTYPES, CodecIndicesStore
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+
+dmel_root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+class AttachCodecIndices:
+    """
+        cut map attaching the indices of a codec indices store as the codec_indices field, picklable for num_jobs > 1
+    """
+    def __init__(self, codec_indices_dir: str):
+        self.store = CodecIndicesStore(codec_indices_dir)
+
+    def __call__(self, cut):
+        indices = self.store[cut.id].numpy().astype(SUPPORTED_DTYPES[self.store.dtype]) # [T, codebook_num]
+        return cut.attach_tensor("codec_indices", indices)
+
+
+@hydra.main(config_path=f"{dmel_root_path}/config/lm", config_name="export_shar.yaml", version_base=None)
+def main(config: DictConfig) -> None:
+    print_config_tree(config)
+
+    # the audio is decoded and resampled once here, training reads it back sequentially
+    cuts = CutSet.from_jsonl_lazy(config.cuts_path).resample(config.sample_rate)
+    fields = {"recording": config.audio_format} if config.audio_format is not None else {}
+    num_jobs = config.num_jobs
+    if config.codec_indices_dir is not None:
+        cuts = cuts.map(AttachCodecIndices(config.codec_indices_dir))
+        fields["codec_indices"] = "numpy"
+        if num_jobs > 1:
+            # num_jobs > 1 splits the cuts through jsonl files, which can not hold the in memory indices
+            logger.warning("The codec indices are attached in memory, the shards are written by a single process")
+            num_jobs = 1
+    if len(fields) == 0:
+        raise ValueError("Nothing to export, set audio_format or codec_indices_dir")
+
+    os.makedirs(config.shar_dir, exist_ok=True)
+    shards = cuts.to_shar(
+        config.shar_dir,
+        fields=fields,
+        shard_size=config.shard_size,
+        num_jobs=num_jobs,
+        fault_tolerant=config.fault_tolerant,
+    )
+    logger.info(f"Wrote {len(shards['cuts'])} shards of {list(shards)} to {config.shar_dir}")
+
+
+if __name__ == "__main__":
+    main()
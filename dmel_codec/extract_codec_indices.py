@@ -0,0 +1,72 @@
+import hydra
+import torch
+from lhotse import CutSet
+from lhotse.dataset import DynamicBucketingSampler
+from omegaconf import DictConfig
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+import dmel_codec
+from dmel_codec.dataset.codec_indices_store import CodecIndicesStoreWriter
+from dmel_codec.dataset.lhotse_tts_dataset import LhotseTTSDataset
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+
+dmel_root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+@hydra.main(config_path=f"{dmel_root_path}/config/lm", config_name="extract_codec_indices.yaml", version_base=None)
+def main(config: DictConfig) -> None:
+    print_config_tree(config)
+    device = config.device
+
+    logger.info(f"Instantiating codec model <{config.model.codec_model._target_}>.")
+    codec_model = hydra.utils.instantiate(config.model.codec_model, _convert_="partial")
+    codec_model.load_state_dict(
+        torch.load(config.model.codec_ckpt_path, map_location="cpu")["state_dict"], strict=False
+    )
+    # same dtype as the frozen codec in MusicLLM, so the indices match the online encoding
+    codec_model = codec_model.to(getattr(torch, config.model.model_dtype)).to(device)
+    codec_model.eval()
+
+    dataset = LhotseTTSDataset()
+    sampler = DynamicBucketingSampler(
+        CutSet.from_jsonl_lazy(config.cuts_path),
+        max_duration=config.max_durations,
+        shuffle=False,
+        drop_last=False,
+    )
+    dataloader = DataLoader(
+        dataset=dataset,
+        sampler=sampler,
+        num_workers=config.num_workers,
+        collate_fn=dataset.collate_fn,
+    )
+
+    writer = None
+    with torch.inference_mode():
+        for batch in tqdm(dataloader):
+            indices, indices_lengths = codec_model.encode(
+                batch["audios"].to(device), batch["audio_lengths"].to(device)
+            )
+            if indices.dim() == 2:
+                indices = indices.unsqueeze(0)
+            indices_lengths = indices_lengths.view(-1).tolist()
+
+            if writer is None:
+                writer = CodecIndicesStoreWriter(
+                    config.codec_indices_dir,
+                    codebook_num=indices.shape[1],
+                    dtype=config.codec_indices_dtype,
+                )
+
+            for i, cut_id in enumerate(batch["cut_ids"]):
+                writer.write(cut_id, indices[i, :, : indices_lengths[i]].T) # shape(T, codebook_num)
+
+    if writer is None:
+        raise ValueError(f"No cuts found in {config.cuts_path}")
+    writer.close()
+    logger.info("extraction_finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import hydra
+from lhotse import CutSet
+from lhotse.dataset import DynamicBucketingSampler
+from omegaconf import DictConfig
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+import dmel_codec
+from dmel_codec.dataset.lhotse_tts_dataset import LhotseTTSDataset
+from dmel_codec.dataset.pcm_store import PCMStoreWriter
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+
+dmel_root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+@hydra.main(config_path=f"{dmel_root_path}/config/lm", config_name="extract_pcm_store.yaml", version_base=None)
+def main(config: DictConfig) -> None:
+    print_config_tree(config)
+
+    # the cuts are decoded once at sample_rate, the dataset reads the store for cuts of the same sampling rate
+    cuts = CutSet.from_jsonl_lazy(config.cuts_path).resample(config.sample_rate)
+    dataset = LhotseTTSDataset(num_load_threads=config.num_load_threads)
+    sampler = DynamicBucketingSampler(
+        cuts,
+        max_duration=config.max_durations,
+        shuffle=False,
+        drop_last=False,
+    )
+    dataloader = DataLoader(
+        dataset=dataset,
+        sampler=sampler,
+        num_workers=config.num_workers,
+        collate_fn=dataset.collate_fn,
+    )
+
+    with PCMStoreWriter(
+        config.pcm_store_dir,
+        sample_rate=config.sample_rate,
+        dtype=config.pcm_dtype,
+        shard_samples=config.shard_samples,
+    ) as writer:
+        for batch in tqdm(dataloader):
+            audio_lengths = batch["audio_lengths"].view(-1).tolist()
+            for i, cut_id in enumerate(batch["cut_ids"]):
+                writer.write(cut_id, batch["audios"][i, 0, : audio_lengths[i]])
+
+    if len(writer.items) == 0:
+        raise ValueError(f"No cuts found in {config.cuts_path}")
+    logger.info("extraction_finished")
+
+
+if __name__ == "__main__":
+    main()
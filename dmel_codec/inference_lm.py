@@ -1,7 +1,9 @@
 import hydra
 import dmel_codec
 from omegaconf import DictConfig
+import torch
 import torchaudio
+from time import time
 from dmel_codec.utils.logger import RankedLogger
 from dmel_codec.utils.print_config import print_config_tree
 from dmel_codec.models.lm_lit_modules import MusicLLM
@@ -18,9 +20,27 @@ def main(config: DictConfig):
     model: MusicLLM = hydra.utils.instantiate(config.model)
     model = model.to(device)
     model.eval()
+    if config.get("optimize_for_inference", False):
+        model.optimize_for_inference()
 
     logger.info("Model set to evaluation mode, ready to inference")
-    predict_audio = model.inference_by_text_prompt(config)
+    if config.get("prompts") is not None:
+        predict_audios = model.inference_by_text_prompts(config)
+        for i, predict_audio in enumerate(predict_audios):
+            torchaudio.save(f"/home/wuzhiyue/dmel_codec-wzy_code/predict_audio_0_5B_{i}.wav", predict_audio, 24000)
+        logger.info(f"Inference done, predict {len(predict_audios)} audios")
+        return
+
+    if config.get("stream", False):
+        start_time = time()
+        predict_audio_chunks = []
+        for predict_audio_chunk in model.inference_by_text_prompt_stream(config):
+            if len(predict_audio_chunks) == 0:
+                logger.info(f"First audio chunk after {time() - start_time:.3f}s")
+            predict_audio_chunks.append(predict_audio_chunk)
+        predict_audio = torch.cat(predict_audio_chunks, dim=1)
+    else:
+        predict_audio = model.inference_by_text_prompt(config)
     torchaudio.save("/home/wuzhiyue/dmel_codec-wzy_code/predict_audio_0_5B.wav", predict_audio, 24000)
     logger.info(f"Inference done, predict_audio shape: {predict_audio.shape}")
 
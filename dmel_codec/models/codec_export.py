@@ -0,0 +1,316 @@
+import math
+import os
+from contextlib import contextmanager
+from itertools import chain
+from time import perf_counter
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from librosa.filters import mel as librosa_mel_fn
+from torch import nn
+
+from dmel_codec.models.codec_lit_modules import VQGAN
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+class ConvLogMelSpectrogram(nn.Module):
+    """
+        LogMelSpectrogram with the stft as a strided conv1d over a windowed dft basis,
+        torch.stft returns complex tensors which the onnx exporter does not support
+    """
+    def __init__(self, mel_transform):
+        super().__init__()
+        spectrogram = mel_transform.spectrogram
+        self.n_fft = spectrogram.n_fft
+        self.hop_length = spectrogram.hop_length
+        self.padding = (spectrogram.n_fft - spectrogram.hop_length) // 2
+
+        # hann window of win_length centered in n_fft, same as torch.stft
+        window = torch.hann_window(spectrogram.win_length, dtype=torch.float64)
+        left = (spectrogram.n_fft - spectrogram.win_length) // 2
+        window = F.pad(window, (left, spectrogram.n_fft - spectrogram.win_length - left))
+
+        n = torch.arange(spectrogram.n_fft, dtype=torch.float64)
+        k = torch.arange(spectrogram.n_fft // 2 + 1, dtype=torch.float64)
+        angle = 2 * math.pi * k[:, None] * n[None, :] / spectrogram.n_fft
+        basis = torch.cat([torch.cos(angle), -torch.sin(angle)], dim=0) * window[None, :]
+        self.register_buffer("dft_basis", basis[:, None, :].float()) # [2 * (n_fft // 2 + 1), 1, n_fft]
+
+        mel_basis = librosa_mel_fn(
+            sr=spectrogram.sample_rate,
+            n_fft=spectrogram.n_fft,
+            n_mels=spectrogram.num_mels,
+            fmin=spectrogram.f_min,
+            fmax=spectrogram.f_max,
+        )
+        self.register_buffer("mel_basis", torch.from_numpy(mel_basis).float()) # [num_mels, n_fft // 2 + 1]
+
+    def forward(self, audio):
+        """
+            audio: [B, T_wav]
+            return: [B, num_mels, T_wav // hop_length]
+        """
+        audio = F.pad(audio[:, None, :], (self.padding, self.padding), mode="reflect")
+        spec = F.conv1d(audio, self.dft_basis, stride=self.hop_length)
+        real, imag = spec.chunk(2, dim=1)
+        spec = torch.sqrt(real.pow(2) + imag.pow(2) + 1e-9)
+        return torch.log(torch.clamp(torch.matmul(self.mel_basis, spec), min=1e-5))
+
+
+class CodecEncodeGraph(nn.Module):
+    """
+        audio -> indices of VQGAN.encode without masks: encode_mel_transform -> encoder -> quantizer.encode
+    """
+    def __init__(self, codec_model: VQGAN):
+        super().__init__()
+        self.mel_transform = ConvLogMelSpectrogram(codec_model.encode_mel_transform)
+        self.encoder = codec_model.encoder
+        self.quantizer = codec_model.quantizer
+        self.dmel_groups = codec_model.dmel_groups
+
+    def forward(self, audio):
+        """
+            audio: [B, T_wav] float32
+            return: indices [B, codebook_num, T_wav // samples_per_frame]
+        """
+        mels = self.mel_transform(audio)
+        if self.dmel_groups > 0:
+            batch_size, num_mels, time_size = mels.shape
+            mels = mels.reshape(batch_size * self.dmel_groups, num_mels // self.dmel_groups, time_size)
+        return self.quantizer.encode(self.encoder(mels))
+
+
+class CodecDecodeGraph(nn.Module):
+    """
+        indices -> audio of VQGAN.decode without masks: quantizer.decode -> decoder -> vocoder,
+        the decoder noise is an input so the exported graph is deterministic
+    """
+    def __init__(self, codec_model: VQGAN):
+        super().__init__()
+        if codec_model.vocoder is None:
+            raise ValueError("Vocoder is not loaded")
+        if codec_model.vocoder.h.get("use_cuda_kernel", False):
+            raise ValueError("The BigVGAN cuda kernel can not be exported, set use_cuda_kernel to false")
+        self.quantizer = codec_model.quantizer
+        self.decoder = codec_model.decoder
+        self.vocoder = codec_model.vocoder
+        with torch.no_grad():
+            quality = torch.full((1, 1), 2.0, device=codec_model.quality_projection.weight.device)
+            self.register_buffer("quality_bias", codec_model.quality_projection(quality)[:, :, None]) # [1, D, 1]
+
+    def forward(self, indices, noise):
+        """
+            indices: [B, codebook_num, T] int64
+            noise: [B, D, T * downsample_factor]
+            return: audio [B, 1, T * samples_per_frame]
+        """
+        z = self.quantizer.decode(indices) + self.quality_bias
+        return self.vocoder(self.decoder(noise, condition=z))
+
+
+def to_export_precision(codec_model: VQGAN):
+    """
+        cast the codec to float32 on cpu in place, the weight normed vocoder can not be deepcopied after a forward
+    """
+    codec_model = codec_model.float().cpu().eval()
+    codec_model.encode_dtype = torch.float32
+    return codec_model
+
+
+@contextmanager
+def export_precision(codec_model: VQGAN):
+    """
+        to_export_precision for the duration of the block, then the dtype and device of every parameter and buffer,
+        encode_dtype and the train mode of the codec are restored, instead of a deepcopy which the vocoder does not allow
+    """
+    states = {
+        name: (tensor.dtype, tensor.device)
+        for name, tensor in chain(codec_model.named_parameters(), codec_model.named_buffers())
+    }
+    encode_dtype, training = codec_model.encode_dtype, codec_model.training
+    try:
+        yield to_export_precision(codec_model)
+    finally:
+        # .float() keeps the parameter objects but replaces the buffers, so both are looked up again by name
+        for name, tensor in chain(codec_model.named_parameters(), codec_model.named_buffers()):
+            dtype, device = states[name]
+            tensor.data = tensor.data.to(dtype=dtype, device=device)
+        codec_model.encode_dtype = encode_dtype
+        codec_model.train(training)
+
+
+@contextmanager
+def build_export_graphs(codec_model: VQGAN):
+    """
+        encode and decode graphs sharing the modules of the codec, which is cast with export_precision for the
+        duration of the block, so the graphs are only valid inside it
+    """
+    with export_precision(codec_model) as codec_model:
+        decode_graph = CodecDecodeGraph(codec_model) if codec_model.vocoder is not None else None
+        yield CodecEncodeGraph(codec_model).eval(), decode_graph.eval() if decode_graph is not None else None
+
+
+def get_example_inputs(codec_model: VQGAN, num_frames: int, seed: int = 0):
+    """
+        return: audio [1, T_wav], indices [1, codebook_num, num_frames], noise [1, D, num_frames * downsample_factor]
+    """
+    generator = torch.Generator().manual_seed(seed)
+    factor = math.prod(codec_model.quantizer.downsample_factor)
+    samples_per_frame = factor * codec_model.encode_mel_transform.hop_length
+    residual_fsq = codec_model.quantizer.residual_fsq
+    codebook_num = residual_fsq.groups * residual_fsq.rvqs[0].num_quantizers
+    codebook_size = residual_fsq.rvqs[0].codebook_size
+
+    audio = torch.randn(1, num_frames * samples_per_frame, generator=generator) * 0.1
+    indices = torch.randint(0, codebook_size, (1, codebook_num, num_frames), generator=generator)
+    noise_channels = codec_model.decoder.input_channels if codec_model.decoder is not None else 1
+    noise = torch.randn(1, noise_channels, num_frames * factor, generator=generator)
+    return audio, indices, noise
+
+
+@torch.no_grad()
+def export_codec(
+    codec_model: VQGAN,
+    export_dir: str,
+    export_format: str = "torchscript",
+    example_frames: int = 100,
+    opset_version: int = 17,
+):
+    """
+        export the encode and decode graphs with dynamic batch and time axes for cpu serving,
+        the codec keeps its dtype and device, see build_export_graphs
+        export_format: torchscript writes encode.pt / decode.pt, onnx writes encode.onnx / decode.onnx
+        return: {"encode": path, "decode": path or None}
+    """
+    if export_format not in ("torchscript", "onnx"):
+        raise ValueError(f"Unknown export format: {export_format}")
+    os.makedirs(export_dir, exist_ok=True)
+    with build_export_graphs(codec_model) as (encode_graph, decode_graph):
+        audio, indices, noise = get_example_inputs(codec_model, example_frames)
+
+        suffix = "pt" if export_format == "torchscript" else "onnx"
+        paths = {"encode": os.path.join(export_dir, f"encode.{suffix}"), "decode": None}
+        # input and output names with their dynamic axes
+        graphs = [("encode", encode_graph, (audio,), {"audio": {0: "batch", 1: "samples"}}, {"indices": {0: "batch", 2: "frames"}})]
+        if decode_graph is not None:
+            paths["decode"] = os.path.join(export_dir, f"decode.{suffix}")
+            graphs.append((
+                "decode",
+                decode_graph,
+                (indices, noise),
+                {"indices": {0: "batch", 2: "frames"}, "noise": {0: "batch", 2: "mel_frames"}},
+                {"audio": {0: "batch", 2: "samples"}},
+            ))
+        else:
+            log.warning("Vocoder is not loaded, only the encode graph is exported")
+
+        for name, graph, inputs, input_axes, output_axes in graphs:
+            if export_format == "torchscript":
+                # the traced sizes stay symbolic, so the batch and time axes of the traced graph are dynamic
+                torch.jit.trace(graph, inputs, check_trace=False).save(paths[name])
+            else:
+                torch.onnx.export(
+                    graph,
+                    inputs,
+                    paths[name],
+                    input_names=list(input_axes),
+                    output_names=list(output_axes),
+                    dynamic_axes={**input_axes, **output_axes},
+                    opset_version=opset_version,
+                    dynamo=False,
+                )
+            log.info(f"Exported {name} graph to {paths[name]}")
+    return paths
+
+
+class ExportedCodec:
+    """
+        runs the exported graphs without the lightning module, torchscript with torch.jit.load and
+        onnx with onnxruntime on cpu, all inputs and outputs are torch tensors
+    """
+    def __init__(self, encode_path: str, decode_path: str | None = None, num_threads: int | None = None):
+        self.sessions = {}
+        for name, path in (("encode", encode_path), ("decode", decode_path)):
+            if path is None:
+                continue
+            if path.endswith(".onnx"):
+                import onnxruntime
+
+                options = onnxruntime.SessionOptions()
+                if num_threads is not None:
+                    options.intra_op_num_threads = num_threads
+                self.sessions[name] = onnxruntime.InferenceSession(
+                    path, options, providers=["CPUExecutionProvider"]
+                )
+            else:
+                if num_threads is not None:
+                    torch.set_num_threads(num_threads)
+                self.sessions[name] = torch.jit.load(path, map_location="cpu").eval()
+
+    def run(self, name, *inputs):
+        session = self.sessions[name]
+        if isinstance(session, torch.jit.ScriptModule):
+            with torch.inference_mode():
+                return session(*inputs)
+        feeds = {arg.name: x.numpy() for arg, x in zip(session.get_inputs(), inputs)}
+        return torch.from_numpy(np.asarray(session.run(None, feeds)[0]))
+
+    def encode(self, audio: torch.Tensor) -> torch.Tensor:
+        """
+            audio: [B, T_wav], return: indices [B, codebook_num, T]
+        """
+        return self.run("encode", audio.float().cpu())
+
+    def decode(self, indices: torch.Tensor, noise: torch.Tensor) -> torch.Tensor:
+        """
+            indices: [B, codebook_num, T], noise: [B, D, T * downsample_factor], return: audio [B, 1, T_wav]
+        """
+        return self.run("decode", indices.long().cpu(), noise.float().cpu())
+
+
+@torch.no_grad()
+def verify_exported_codec(codec_model: VQGAN, exported: ExportedCodec, num_frames: int = 250):
+    """
+        compare the exported graphs with VQGAN.encode / VQGAN.decode of the codec cast with to_export_precision,
+        on a length different from the export example so the dynamic time axis is checked,
+        the codec gets its dtype and device back afterwards, see export_precision
+        return: {"encode_index_match": ratio of equal indices, "decode_max_abs_diff": float or None}
+    """
+    with export_precision(codec_model) as reference:
+        audio, indices, noise = get_example_inputs(reference, num_frames, seed=1)
+
+        ref_indices, _ = reference.encode(audio[:, None, :], torch.tensor([audio.shape[-1]]))
+        result = {
+            "encode_index_match": (exported.encode(audio) == ref_indices).float().mean().item(),
+            "decode_max_abs_diff": None,
+        }
+        if "decode" in exported.sessions:
+            ref_audio, _ = reference.decode(indices, torch.tensor([num_frames]), return_audios=True, noise=noise)
+            result["decode_max_abs_diff"] = (exported.decode(indices, noise) - ref_audio).abs().max().item()
+    log.info(f"Export verification: {result}")
+    return result
+
+
+def benchmark_exported_codec(codec_model: VQGAN, exported: ExportedCodec, num_frames: int = 250, num_runs: int = 10):
+    """
+        mean latency and real time factor of the exported graphs on cpu, one warmup run is not counted
+        return: {name: {"latency": seconds, "rtf": latency / audio seconds}}
+    """
+    audio, indices, noise = get_example_inputs(codec_model, num_frames, seed=2)
+    audio_seconds = audio.shape[-1] / codec_model.sampling_rate
+    inputs = {"encode": (audio,), "decode": (indices, noise)}
+
+    result = {}
+    for name in exported.sessions:
+        run = exported.encode if name == "encode" else exported.decode
+        run(*inputs[name])
+        start_time = perf_counter()
+        for _ in range(num_runs):
+            run(*inputs[name])
+        latency = (perf_counter() - start_time) / num_runs
+        result[name] = {"latency": latency, "rtf": latency / audio_seconds}
+    log.info(f"Export benchmark on {audio_seconds:.2f}s audio: {result}")
+    return result
@@ -15,6 +15,8 @@ from dmel_codec.utils.spectrogram import LogMelSpectrogram
 from dmel_codec.models.modules.bigvgan.bigvgan import BigVGAN
 from dmel_codec.models.modules.discriminator import Discriminator
 from dmel_codec.models.modules.dowmsample_fsq import DownsampleFiniteScalarQuantize
+from dmel_codec.models.modules.dynamic_int8 import quantize_dynamic_int8
+from dmel_codec.models.modules.firefly import ConvNeXtBlock
 from dmel_codec.models.modules.wavenet import WaveNet
 from dmel_codec.utils.utils import avg_with_mask, plot_mel, sequence_mask
 from dmel_codec.utils.logger import RankedLogger
@@ -46,7 +48,14 @@ class VQGAN(L.LightningModule):
         quanlity_linear: int = 768,
         dtype: torch.dtype | str = "bfloat16",
         accumulate_grad: int = 1,
+        fixed_decode_noise: bool = False,
+        decode_noise_seed: int = 0,
     ):
+        """
+            fixed_decode_noise: decode without noise uses a fixed seeded noise buffer sliced to length instead of
+                                torch.randn_like, the decoded audio only depends on the indices and can be cached
+            decode_noise_seed: seed of the fixed noise buffer
+        """
         super().__init__()
         # torch.bfloat16 for str "bfloat16"
         log.info(f"dtype: {dtype}")
@@ -111,6 +120,11 @@ class VQGAN(L.LightningModule):
         self.dmel_groups = dmel_groups
         self.accumulate_grad = accumulate_grad
 
+        self.fixed_decode_noise = fixed_decode_noise
+        self.decode_noise_seed = decode_noise_seed
+        self.decode_noise = None # [D, T], grown block by block by get_decode_noise
+        self.decode_noise_generator = None
+
     def on_save_checkpoint(self, checkpoint):
         # Do not save vocoder
         state_dict = checkpoint["state_dict"]
@@ -465,12 +479,20 @@ class VQGAN(L.LightningModule):
 
         return indices, indices_lengths
 
-    def decode(self, indices, feature_lengths, return_audios=False): # return audios or mel
+    def decode(self, indices, feature_lengths, return_audios=False, noise=None): # return audios or mel
+        """
+            noise: None or the decoder input noise with the same shape as the quantized features [bs, D, T * downsample_factor],
+                   random noise is used if None
+        """
         z, mel_masks_float_conv = self.get_quantized_features_from_indices(indices, feature_lengths)
+        if noise is None and self.fixed_decode_noise:
+            noise = self.get_decode_noise(z.shape[2]).expand(z.shape[0], -1, -1)
+        elif noise is None:
+            noise = torch.randn_like(z)
 
         gen_mel = (
             self.decoder(
-                torch.randn_like(z).to(self.encode_dtype) * mel_masks_float_conv,
+                noise.to(self.encode_dtype) * mel_masks_float_conv,
                 condition=z,
             )
             * mel_masks_float_conv
@@ -482,15 +504,166 @@ class VQGAN(L.LightningModule):
             return self.vocoder(gen_mel), gen_mel
 
         return gen_mel
+
+    def get_decode_noise(self, end, start=0, block_frames=1024):
+        """
+            fixed decoder noise of the mel frames [start, end), the same for every call and every device
+            the noise is drawn on the cpu in blocks of block_frames from one generator seeded with decode_noise_seed,
+            so growing the buffer keeps the frames drawn before
+            return: [1, D, end - start]
+        """
+        if self.decode_noise is None or self.decode_noise.device != self.device:
+            self.decode_noise_generator = torch.Generator().manual_seed(self.decode_noise_seed)
+            self.decode_noise = torch.zeros(self.decoder.input_channels, 0, device=self.device)
+
+        num_blocks = math.ceil(max(end - self.decode_noise.shape[1], 0) / block_frames)
+        if num_blocks > 0:
+            blocks = [
+                torch.randn(self.decoder.input_channels, block_frames, generator=self.decode_noise_generator)
+                for _ in range(num_blocks)
+            ]
+            self.decode_noise = torch.cat([self.decode_noise, torch.cat(blocks, dim=1).to(self.device)], dim=1)
+        return self.decode_noise[None, :, start:end].to(self.encode_dtype)
+
+    def decode_segment(self, indices, segment_start, segment_end, noise=None):
+        """
+            decode a window of indices and only return the audio of the frames [segment_start, segment_end) in the window,
+            the frames out of the segment are the left context and the lookahead of the non causal decoder and vocoder
+            indices: [1, codebook_num, T_window]
+            noise: None or [1, D, T_window * downsample_factor], the same noise must be used for overlapped windows to avoid seams
+            return: [1, 1, (segment_end - segment_start) * samples_per_frame]
+        """
+        feature_lengths = torch.tensor([indices.shape[2]], dtype=torch.long, device=indices.device)
+        wav, _ = self.decode(indices, feature_lengths, return_audios=True, noise=noise)
+        samples_per_frame = math.prod(self.quantizer.downsample_factor) * self.gt_mel_transform.hop_length
+        return wav[:, :, segment_start * samples_per_frame:segment_end * samples_per_frame]
     
+    def decode_chunked(self, indices, chunk_frames=50, context_frames=None, noise=None, generator=None):
+        """
+            decode a long indices sequence window by window with bounded memory, each window adds context_frames
+            of left and right context to a chunk and only keeps the audio of the chunk
+            indices: [1, codebook_num, T]
+            context_frames: None or the context in indices frames, default is decode_receptive_field
+            noise: None or [1, D, T * downsample_factor], the decoder input noise of the whole sequence,
+                   if None the fixed decode noise is used with fixed_decode_noise, else the noise is drawn
+                   window by window with generator and kept for the overlap
+            return: [1, 1, T * samples_per_frame]
+        """
+        if context_frames is None:
+            context_frames = self.decode_receptive_field()
+        factor = math.prod(self.quantizer.downsample_factor)
+        total_frames = indices.shape[2]
+
+        # rolling noise of the frames [noise_start, noise_start + noise_buffer frames)
+        noise_buffer = None
+        noise_start = 0
+        wav_list = []
+        for start in range(0, total_frames, chunk_frames):
+            end = min(total_frames, start + chunk_frames)
+            window_start = max(0, start - context_frames)
+            window_end = min(total_frames, end + context_frames)
+
+            if noise is None and self.fixed_decode_noise:
+                window_noise = self.get_decode_noise(window_end * factor, window_start * factor)
+            elif noise is not None:
+                window_noise = noise[:, :, window_start * factor : window_end * factor]
+            else:
+                buffer_end = noise_start + (noise_buffer.shape[2] // factor if noise_buffer is not None else 0)
+                new_noise = torch.randn(
+                    1, self.decoder.input_channels, (window_end - buffer_end) * factor,
+                    generator=generator, device=indices.device,
+                ) # generator must be on the device of indices
+                noise_buffer = new_noise if noise_buffer is None else torch.cat([noise_buffer, new_noise], dim=2)
+                noise_buffer = noise_buffer[:, :, (window_start - noise_start) * factor :]
+                noise_start = window_start
+                window_noise = noise_buffer
+
+            wav_list.append(
+                self.decode_segment(
+                    indices[:, :, window_start:window_end], start - window_start, end - window_start, noise=window_noise
+                )
+            )
+        return torch.cat(wav_list, dim=-1)
+
+    def decode_receptive_field(self):
+        """
+            one sided receptive field of indices -> audio, in indices frames
+            quantizer upsample + wavenet decoder + vocoder
+        """
+        mel_frames = (
+            self.quantizer.upsample_receptive_field()
+            + self.decoder.receptive_field()
+            + (self.vocoder.receptive_field() if self.vocoder is not None else 0)
+        )
+        return math.ceil(mel_frames / math.prod(self.quantizer.downsample_factor))
+
+    def encode_receptive_field(self):
+        """
+            one sided receptive field of mel -> indices, in indices frames
+            wavenet encoder + quantizer downsample
+        """
+        mel_frames = self.encoder.receptive_field() + self.quantizer.downsample_receptive_field()
+        return math.ceil(mel_frames / math.prod(self.quantizer.downsample_factor))
+
+    def optimize_for_inference(self, fuse_condition_projections=None):
+        """
+            fold the inference graph once after loading, call it before quantize_decode_int8
+            drops the discriminator and the optimizer builders, removes the weight norm of the vocoder,
+            fuses the condition and skip projections of the wavenets and the layer scale of the convnext blocks
+            fuse_condition_projections: see WaveNet.optimize_for_inference, None fuses them on gpu only
+        """
+        if fuse_condition_projections is None:
+            fuse_condition_projections = self.device.type == "cuda"
+        self.discriminator = None
+        self.optimizer_builder = None
+        self.lr_scheduler_builder = None
+        self.eval()
+        self.requires_grad_(False)
+
+        if self.vocoder is not None:
+            self.vocoder.remove_weight_norm()
+        self.encoder.optimize_for_inference(fuse_condition_projections)
+        if self.decoder is not None:
+            self.decoder.optimize_for_inference(fuse_condition_projections)
+        for module in self.quantizer.modules():
+            if isinstance(module, ConvNeXtBlock):
+                module.fuse_layer_scale()
+        return self
+
+    def quantize_decode_int8(self, min_channels=256):
+        """
+            opt-in cpu inference mode of decode, the Conv1d and Linear layers of the decoder and vocoder are replaced
+            with dynamic int8 versions (per channel int8 weights, activations quantized on every call)
+            min_channels: layers with fewer input channels stay in float32, see quantize_dynamic_int8
+            the model is cast to float32, the replacement can not be undone and the model can not be trained after it
+            return: number of replaced layers
+        """
+        if self.device.type != "cpu":
+            raise ValueError(f"Dynamic int8 quantization only runs on cpu, got {self.device}")
+        if self.decoder is None or self.vocoder is None:
+            raise ValueError("Decoder and vocoder are not loaded")
+
+        self.float()
+        self.encode_dtype = torch.float32
+        # the quantized weights are taken from conv.weight, which weight norm only updates in forward
+        self.vocoder.remove_weight_norm()
+        num_replaced = (
+            quantize_dynamic_int8(self.decoder, min_channels) + quantize_dynamic_int8(self.vocoder, min_channels)
+        )
+        log.info(f"Quantized {num_replaced} layers of the decoder and vocoder to dynamic int8")
+        return num_replaced
+
     def encode_unquantized(self, audios, audio_lengths): # return unquantized_features and mel_lengths
         audios = audios.float()
 
         mels = self.encode_mel_transform(audios) # mel must be float32
-        mels = mels.to(self.encode_dtype) 
-
         mel_lengths = audio_lengths // self.encode_mel_transform.hop_length
 
+        return self.encode_mels(mels, mel_lengths), mel_lengths
+
+    def encode_mels(self, mels, mel_lengths): # return unquantized_features
+        mels = mels.to(self.encode_dtype) 
+
         mel_masks = sequence_mask(mel_lengths, mels.shape[2])
         mel_masks_float_conv = mel_masks[:, None, :].to(self.encode_dtype)
 
@@ -510,7 +683,7 @@ class VQGAN(L.LightningModule):
             encoded_mels = mels * mel_masks_float_conv
             encoded_features = self.encoder(encoded_mels) * mel_masks_float_conv
 
-        return encoded_features, mel_lengths
+        return encoded_features
     
     def get_quantized_features_from_indices(self, indices, feature_lengths): # return quantized_features
         factor = math.prod(self.quantizer.downsample_factor)
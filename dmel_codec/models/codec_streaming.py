@@ -0,0 +1,134 @@
+import math
+import torch
+import torch.nn.functional as F
+from dmel_codec.models.codec_lit_modules import VQGAN
+
+
+class StreamingCodecEncoder:
+    def __init__(self, codec_model: VQGAN, chunk_frames: int = 50, context_frames: int | None = None):
+        """
+            Encode a waveform chunk by chunk with bounded memory, the indices are the same as VQGAN.encode of the whole waveform
+            codec_model: VQGAN
+            chunk_frames: indices frames encoded per encoder call
+            context_frames: None or the left and right context in indices frames, default is VQGAN.encode_receptive_field
+        """
+        self.codec_model = codec_model
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames if context_frames is not None else codec_model.encode_receptive_field()
+
+        mel_transform = codec_model.encode_mel_transform
+        self.hop_length = mel_transform.hop_length
+        self.n_fft = mel_transform.n_fft
+        self.padding = (self.n_fft - self.hop_length) // 2
+        self.factor = math.prod(codec_model.quantizer.downsample_factor)
+        self.reset()
+
+    def reset(self):
+        self.audio = None # samples not consumed by the stft yet, with the left reflect padding at the start
+        self.is_start = True
+        self.num_samples = 0
+        self.mels = None # [1, num_mels, T], mel frames from mel_start
+        self.mel_start = 0
+        self.emitted_frames = 0
+
+    @torch.no_grad()
+    def push(self, audio: torch.Tensor) -> torch.Tensor:
+        """
+            audio: [n] or [1, n] or [1, 1, n]
+            return: [1, codebook_num, k], the indices finished by this chunk, k can be 0
+        """
+        self.append_audio(audio.reshape(1, -1).float())
+        return self.encode_available(is_final=False)
+
+    @torch.no_grad()
+    def flush(self) -> torch.Tensor:
+        """
+            encode the rest of the stream and reset, return: [1, codebook_num, k]
+        """
+        if self.audio is not None and self.is_start:
+            self.start_stream()
+        if self.audio is not None:
+            # right reflect padding of the whole waveform, same as LinearSpectrogram
+            self.audio = F.pad(self.audio[:, None], (0, self.padding), mode="reflect")[:, 0]
+            self.compute_mels()
+        indices = self.encode_available(is_final=True)
+        self.reset()
+        return indices
+
+    def append_audio(self, audio):
+        self.num_samples += audio.shape[-1]
+        self.audio = audio if self.audio is None else torch.cat([self.audio, audio], dim=-1)
+        # the left reflect padding needs padding + 1 samples
+        if self.is_start and self.audio.shape[-1] > self.padding:
+            self.start_stream()
+        if not self.is_start:
+            self.compute_mels()
+
+    def start_stream(self):
+        self.audio = F.pad(self.audio[:, None], (self.padding, 0), mode="reflect")[:, 0]
+        self.is_start = False
+
+    def compute_mels(self):
+        num_frames = (self.audio.shape[-1] - self.n_fft) // self.hop_length + 1
+        if num_frames <= 0:
+            return
+        used = (num_frames - 1) * self.hop_length + self.n_fft
+        mels = self.codec_model.encode_mel_transform(self.audio[:, :used], pad_input=False)
+        self.mels = mels if self.mels is None else torch.cat([self.mels, mels], dim=-1)
+        self.audio = self.audio[:, num_frames * self.hop_length :]
+
+    def encode_available(self, is_final):
+        mel_end = self.mel_start + (self.mels.shape[-1] if self.mels is not None else 0)
+        if is_final:
+            # same length as VQGAN.encode: (num_samples // hop_length) // factor
+            end_frame = (self.num_samples // self.hop_length) // self.factor
+        else:
+            # the right context must be real mel frames, not the zero padding of the window end
+            end_frame = mel_end // self.factor - self.context_frames
+            end_frame = self.emitted_frames + (end_frame - self.emitted_frames) // self.chunk_frames * self.chunk_frames
+
+        indices_list = []
+        while self.emitted_frames < end_frame:
+            frames = min(self.chunk_frames, end_frame - self.emitted_frames)
+            indices_list.append(self.encode_window(self.emitted_frames, frames, mel_end))
+            self.emitted_frames += frames
+
+            # drop the mel frames out of the left context of the next chunk
+            keep_start = max(0, (self.emitted_frames - self.context_frames) * self.factor)
+            if keep_start > self.mel_start:
+                self.mels = self.mels[:, :, keep_start - self.mel_start :]
+                self.mel_start = keep_start
+
+        if len(indices_list) == 0:
+            residual_fsq = self.codec_model.quantizer.residual_fsq
+            codebook_num = residual_fsq.groups * residual_fsq.rvqs[0].num_quantizers
+            device = self.codec_model.device
+            return torch.zeros(1, codebook_num, 0, dtype=torch.long, device=device)
+        return torch.cat(indices_list, dim=-1)
+
+    def encode_window(self, start, frames, mel_end):
+        # window in mel frames, aligned to the downsample factor so the strided convs see the same frame pairs
+        window_start = max(0, (start - self.context_frames) * self.factor)
+        window_end = min(mel_end, (start + frames + self.context_frames) * self.factor)
+        mels = self.mels[:, :, window_start - self.mel_start : window_end - self.mel_start]
+
+        mel_lengths = torch.tensor([mels.shape[-1]], device=mels.device)
+        encoded_features = self.codec_model.encode_mels(mels, mel_lengths)
+        indices = self.codec_model.quantizer.encode(encoded_features)
+
+        offset = start - window_start // self.factor
+        return indices[:, :, offset : offset + frames]
+
+
+def streaming_encode(codec_model: VQGAN, audio: torch.Tensor, chunk_samples: int = 24000, chunk_frames: int = 50):
+    """
+        encode a long waveform with StreamingCodecEncoder, audio: [n] or [1, n] or [1, 1, n]
+        return: [1, codebook_num, T]
+    """
+    encoder = StreamingCodecEncoder(codec_model, chunk_frames=chunk_frames)
+    audio = audio.reshape(1, -1)
+    indices_list = [
+        encoder.push(audio[:, i : i + chunk_samples]) for i in range(0, audio.shape[-1], chunk_samples)
+    ]
+    indices_list.append(encoder.flush())
+    return torch.cat(indices_list, dim=-1)
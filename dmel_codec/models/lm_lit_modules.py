@@ -11,13 +11,16 @@ from dmel_codec.models.modules.lm_process_input import ProcessInputs
 from safetensors.torch import load_file
 import torch
 import os
+import math
 from transformers.models.qwen2 import Qwen2Tokenizer
+from transformers.cache_utils import StaticCache
 from torch.nn.utils.rnn import pad_sequence
 from time import time
 from einops import rearrange
-from dmel_codec.utils.utils import sample_one_token_from_logits
+from dmel_codec.utils.utils import sample_tokens_from_logits_batch
 
 SOFTMAX_IGNORE_INDEX = -100
+END_CHECK_INTERVAL = 8 # frames between two <EOM> checks when the inference config does not set it, as lm_inference.yaml
 log = RankedLogger(__name__, rank_zero_only=True)
 
 
@@ -45,7 +48,13 @@ class MusicLLM(pl.LightningModule):
         accumulate_grad_batches: int = 1,
         gradient_clip_val: float = 1.0,
         gradient_clip_algorithm: str = "norm",
+        pack_sequences: bool = False,
+        pack_length: int | None = None,
     ):
+        """
+            pack_sequences: pack several training samples into one row with a block diagonal attention mask instead of right padding
+            pack_length: max length of a packed row, None means the longest sample of the batch
+        """
         super().__init__()
 
         slow_lm_config = Qwen2Config.from_pretrained(slow_lm_config_path)
@@ -57,6 +66,8 @@ class MusicLLM(pl.LightningModule):
         self.accumulate_grad_batches = accumulate_grad_batches
         self.gradient_clip_val = gradient_clip_val
         self.gradient_clip_algorithm = gradient_clip_algorithm
+        self.pack_sequences = pack_sequences
+        self.pack_length = pack_length
 
         model = ChatMusicForCausalLM(
             slow_lm_config=slow_lm_config,
@@ -205,14 +216,14 @@ class MusicLLM(pl.LightningModule):
 
     def get_embeds_from_inputs_ids(self, text_ids, audio_ids):
         """
-            text_ids: [T]
-            audio_ids: [T, codebook_num]
+            text_ids: [T] or [bs, T]
+            audio_ids: [T, codebook_num] or [bs, T, codebook_num]
         """
         text_embeds = self.model.slow_model.embed_tokens(text_ids) # shape = (T, D)
 
         audio_inputs_embeds = self.model.slow_model.slow_lm_audio_emb(audio_ids) # shape = (T, codebook_num, D)
 
-        audio_inputs_embeds = rearrange(audio_inputs_embeds, "s c h -> s (c h)") # shape = (T, codebook_num * D)
+        audio_inputs_embeds = rearrange(audio_inputs_embeds, "... c h -> ... (c h)") # shape = (T, codebook_num * D)
 
         audio_embeds = self.model.slow_model.slow_audio_hiddenstate_projector(
             audio_inputs_embeds
@@ -223,9 +234,15 @@ class MusicLLM(pl.LightningModule):
     def process_all_input_for_train(self, batch):
         inputs_embeds_list = []
         labels_list = []
-        audio_ids_list = self.process_inputs_cls.get_audio_ids_parralel(
-            batch["audios"], batch["audio_lengths"], self.codec_model
-        )
+        if "audio_ids" in batch:
+            # the dataset reads the indices from a codec indices store, the codec encoder is skipped
+            audio_ids_list = self.process_inputs_cls.get_audio_ids_from_store(
+                batch["audio_ids"], self.codec_model.device
+            )
+        else:
+            audio_ids_list = self.process_inputs_cls.get_audio_ids_parralel(
+                batch["audios"], batch["audio_lengths"], self.codec_model
+            )
 
         for i in range(len(batch["text"])):
             item = {
@@ -242,13 +259,73 @@ class MusicLLM(pl.LightningModule):
             )
             inputs_embeds_list.append(input_embeds)
 
+        if self.pack_sequences:
+            return self.pack_inputs_for_train(inputs_embeds_list, labels_list)
+
         inputs_embeds = pad_sequence(
             inputs_embeds_list, batch_first=True, padding_value=0
         ) # shape = (bs, T, D)
         labels = pad_sequence(
             labels_list, batch_first=True, padding_value=SOFTMAX_IGNORE_INDEX
         ) # shape = (bs, T, codebook_num + 1)
-        return inputs_embeds, labels[:, :, 0], labels[:, :, 1:]
+        return inputs_embeds, labels[:, :, 0], labels[:, :, 1:], None, None
+
+    def pack_inputs_for_train(self, inputs_embeds_list, labels_list):
+        """
+            first fit decreasing packing of the samples into rows of at most pack_length tokens
+            inputs_embeds_list: list of [T_i, D]
+            labels_list: list of [T_i, codebook_num + 1]
+            return:
+                inputs_embeds: [rows, T, D]
+                text_labels: [rows, T]
+                audio_labels: [rows, T, codebook_num]
+                attention_mask: [rows, 1, T, T], additive block diagonal causal mask
+                position_ids: [rows, T], restart from 0 at every sample
+        """
+        lengths = [x.shape[0] for x in inputs_embeds_list]
+        pack_length = max(self.pack_length or 0, max(lengths))
+
+        rows, row_lengths = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            for row_idx, row_length in enumerate(row_lengths):
+                if row_length + lengths[i] <= pack_length:
+                    rows[row_idx].append(i)
+                    row_lengths[row_idx] += lengths[i]
+                    break
+            else:
+                rows.append([i])
+                row_lengths.append(lengths[i])
+
+        device = inputs_embeds_list[0].device
+        packed_embeds_list, packed_labels_list, position_ids_list, segment_ids_list = [], [], [], []
+        for segment in rows:
+            labels = torch.cat([labels_list[i] for i in segment], dim=0)
+            # the last token of a sample must not learn to predict the first token of the next one
+            segment_starts = torch.tensor([0] + [lengths[i] for i in segment[:-1]], device=device).cumsum(0)
+            labels[segment_starts] = SOFTMAX_IGNORE_INDEX
+            packed_labels_list.append(labels)
+            packed_embeds_list.append(torch.cat([inputs_embeds_list[i] for i in segment], dim=0))
+            position_ids_list.append(torch.cat([torch.arange(lengths[i], device=device) for i in segment]))
+            segment_ids_list.append(
+                torch.cat([torch.full((lengths[i],), j, device=device) for j, i in enumerate(segment)])
+            )
+
+        inputs_embeds = pad_sequence(packed_embeds_list, batch_first=True, padding_value=0) # shape = (rows, T, D)
+        labels = pad_sequence(
+            packed_labels_list, batch_first=True, padding_value=SOFTMAX_IGNORE_INDEX
+        ) # shape = (rows, T, codebook_num + 1)
+        position_ids = pad_sequence(position_ids_list, batch_first=True, padding_value=0)
+        # the right padding is its own segment, so no attention row is fully masked
+        segment_ids = pad_sequence(segment_ids_list, batch_first=True, padding_value=len(lengths))
+
+        seq_len = inputs_embeds.shape[1]
+        causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=device).tril()
+        visible = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+        attention_mask = torch.zeros(visible.shape, dtype=inputs_embeds.dtype, device=device).masked_fill(
+            ~visible, torch.finfo(inputs_embeds.dtype).min
+        )[:, None] # shape = (rows, 1, T, T)
+
+        return inputs_embeds, labels[:, :, 0], labels[:, :, 1:], attention_mask, position_ids
 
     def _step(self, batch, batch_idx, stage="train"):
         is_train = stage == "train"
@@ -259,14 +336,16 @@ class MusicLLM(pl.LightningModule):
         else:
             self.model.eval()
 
-        inputs_embeds, text_labels, audio_labels = self.process_all_input_for_train(
-            batch
+        inputs_embeds, text_labels, audio_labels, attention_mask, position_ids = (
+            self.process_all_input_for_train(batch)
         )
 
         multimodel_causual_output: MultiModalCausalLMOutputWithPast = self.model(
             inputs_embeds=inputs_embeds,
             text_labels=text_labels,
             audio_labels=audio_labels,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
         )
 
         self.log(
@@ -381,6 +460,17 @@ class MusicLLM(pl.LightningModule):
                     checkpoint["state_dict"].pop(name)
 
     # -------------------------- Inference --------------------------
+    def optimize_for_inference(self):
+        """
+            drop the training only state and fold the codec with VQGAN.optimize_for_inference, call it once after loading
+        """
+        self.optimizer_builder = None
+        self.lr_scheduler_builder = None
+        self.eval()
+        self.requires_grad_(False)
+        self.codec_model.optimize_for_inference()
+        return self
+
     @torch.no_grad()
     @torch.inference_mode()
     def inference_by_audio_prompt(self, inference_config, wav):
@@ -426,6 +516,97 @@ class MusicLLM(pl.LightningModule):
 
     @torch.inference_mode()
     def inference_by_text_prompt(self, inference_config):
+        input_embeds_ar, slow_past_key_values = self.prefill_text_prompt(inference_config)
+
+        self.predict_n_token(input_embeds_ar, slow_past_key_values, inference_config)
+        generation_audio_ids = self.audio_ids[self.text_prompt_length + 6:-1]
+        # deshift audio ids
+        generation_audio_ids = generation_audio_ids - self.codebook_shift
+        decode_chunk_frames = inference_config.get("decode_chunk_frames", None)
+        if decode_chunk_frames is not None:
+            # bounded memory for long generations
+            wav = self.codec_model.decode_chunked(
+                generation_audio_ids.T.unsqueeze(0), chunk_frames=decode_chunk_frames
+            )
+            return wav.float().cpu().squeeze(0)
+
+        wav, _ = self.codec_model.decode(
+            indices=generation_audio_ids.T.unsqueeze(0), # (T, Codebook_num) -> (1, Codebook_num, T)
+            feature_lengths=torch.tensor(generation_audio_ids.shape[0]).to(self.codec_model.device).unsqueeze(0),
+            return_audios=True,
+        )
+        return wav.float().cpu().squeeze(0)
+
+    @torch.inference_mode()
+    def inference_by_text_prompt_stream(self, inference_config):
+        """
+            streaming version of inference_by_text_prompt, yields waveform chunks while the lm is still generating
+            every chunk has inference_config.stream_chunk_frames frames (the last one can be shorter), shape = (1, T_chunk)
+            a chunk is decoded with stream_left_context_frames frames before it and waits for stream_lookahead_frames
+            frames after it, so the non causal decoder and vocoder see enough context to avoid seams,
+            both default to codec_model.decode_receptive_field(), smaller values are rejected since the chunks would
+            differ from the offline decode at every boundary
+        """
+        chunk_frames = inference_config.get("stream_chunk_frames", 10)
+        receptive_field = self.codec_model.decode_receptive_field()
+        left_context_frames = inference_config.get("stream_left_context_frames", None)
+        lookahead_frames = inference_config.get("stream_lookahead_frames", None)
+        if left_context_frames is None:
+            left_context_frames = receptive_field
+        if lookahead_frames is None:
+            lookahead_frames = receptive_field
+        if min(left_context_frames, lookahead_frames) < receptive_field:
+            raise ValueError(
+                f"stream_left_context_frames ({left_context_frames}) and stream_lookahead_frames ({lookahead_frames}) "
+                f"must cover the decode receptive field of {receptive_field} frames"
+            )
+
+        input_embeds_ar, slow_past_key_values = self.prefill_text_prompt(inference_config)
+        generation_start = self.text_prompt_length + 6
+
+        # the same decoder noise is used for the overlapped windows, sliced by the absolute frame index
+        factor = math.prod(self.codec_model.quantizer.downsample_factor)
+        noise_frames = (max(self.max_length, inference_config.max_new_tokens) + 1) * factor
+        if self.codec_model.fixed_decode_noise:
+            stream_noise = self.codec_model.get_decode_noise(noise_frames)
+        else:
+            stream_noise = torch.randn(
+                (1, self.codec_model.quality_projection.out_features, noise_frames),
+                device=self.codec_model.device,
+            )
+
+        def decode_chunk(start, end, available):
+            window_start = max(start - left_context_frames, 0)
+            window_end = min(end + lookahead_frames, available)
+            indices = self.audio_ids[generation_start + window_start:generation_start + window_end] - self.codebook_shift
+            wav = self.codec_model.decode_segment(
+                indices=indices.T.unsqueeze(0), # (1, Codebook_num, T_window)
+                segment_start=start - window_start,
+                segment_end=end - window_start,
+                noise=stream_noise[:, :, window_start * factor:window_end * factor],
+            )
+            return wav.float().cpu().squeeze(0)
+
+        emitted_frames = 0
+        for checked_length in self.predict_n_token_iter(input_embeds_ar, slow_past_key_values, inference_config):
+            # only the frames already checked for <EOM> are known to be audio
+            available_frames = checked_length - generation_start
+            while available_frames - emitted_frames >= chunk_frames + lookahead_frames:
+                yield decode_chunk(emitted_frames, emitted_frames + chunk_frames, available_frames)
+                emitted_frames += chunk_frames
+
+        # flush, the last frame is dropped same as inference_by_text_prompt
+        available_frames = self.audio_ids.shape[0] - 1 - generation_start
+        while emitted_frames < available_frames:
+            end = min(emitted_frames + chunk_frames, available_frames)
+            yield decode_chunk(emitted_frames, end, available_frames)
+            emitted_frames = end
+
+    def prefill_text_prompt(self, inference_config):
+        """
+            build the text prompt, prefill the slow lm and sample the first frame
+            return: input_embeds of the next step and slow_past_key_values
+        """
         text_ids = self.text_inference_input_processor(inference_config) # shape = (1, T)
         self.text_prompt_length = text_ids.shape[1]
         self.audio_prompt_length = 0
@@ -442,12 +623,20 @@ class MusicLLM(pl.LightningModule):
             audio_prompt_length=0,
         ).T  # (S, Codebook_num)
         text_input_ids, audio_input_ids = input_ids[:, 0], input_ids[:, 1:]
-        self.text_ids = text_input_ids
-        self.audio_ids = audio_input_ids
+        self.incremental_generation = inference_config.get("incremental_generation", True)
+        if self.incremental_generation:
+            self.init_generation_buffers(text_input_ids, audio_input_ids)
+        else:
+            self.text_ids = text_input_ids
+            self.audio_ids = audio_input_ids
         input_embeds = self.get_embeds_from_inputs_ids(
             text_input_ids, audio_input_ids
         ).unsqueeze(0)  # (1, S, H)
         slow_past_key_values = None
+        if inference_config.get("static_kv_cache", False):
+            if not self.incremental_generation:
+                raise ValueError("static_kv_cache needs incremental_generation, the full history can not be written into the static cache every step")
+            slow_past_key_values = self.init_slow_static_cache(input_embeds.shape[1])
 
         # prefilling
         next_prefilling_token, slow_past_key_values = (
@@ -459,17 +648,200 @@ class MusicLLM(pl.LightningModule):
             )
         )
         input_embeds_ar = self.process_generation_ids(next_prefilling_token)
+        return input_embeds_ar, slow_past_key_values
+
+    @torch.inference_mode()
+    def inference_by_text_prompts(self, inference_config, prompts=None):
+        """
+            batch version of inference_by_text_prompt, the prompts are left padded and generated together
+            prompts: list of text prompts, default is inference_config.prompts
+            return: list of waveforms, one per prompt, every waveform shape = (1, T)
+        """
+        if prompts is None:
+            prompts = list(inference_config.prompts)
+        text_ids_list = [
+            self.process_inputs_cls.text_tokenizer(prompt, return_tensors="pt")["input_ids"].view(-1).to(self.device)
+            for prompt in prompts
+        ]
+        input_ids, attention_mask = self.process_inputs_cls.process_2d_logits_infer_batch(
+            device=self.device, text_ids_list=text_ids_list
+        ) # (bs, S, Codebook_num + 1), (bs, S)
+        batch_size, prompt_length, _ = input_ids.shape
+
+        # the length limit is counted per sequence without the left padding, same as inference_by_text_prompt
+        max_total_length = min(self.max_length, inference_config.max_new_tokens)
+        pad_lengths = prompt_length - attention_mask.sum(dim=-1) # (bs)
+        buffer_length = max(max_total_length + int(pad_lengths.max()), prompt_length) + 1
+        text_ids = torch.full(
+            (batch_size, buffer_length),
+            self.slow_lm_config.text_modality_mambaout_token_id,
+            dtype=torch.long,
+            device=self.device,
+        )
+        audio_ids = torch.full(
+            (batch_size, buffer_length, self.slow_lm_config.audio_codebook_count),
+            self.slow_lm_config.slow_audio_modality_mambaout_token_id,
+            dtype=torch.long,
+            device=self.device,
+        )
+        text_ids[:, :prompt_length] = input_ids[:, :, 0]
+        audio_ids[:, :prompt_length] = input_ids[:, :, 1:]
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_zeros((batch_size, buffer_length - prompt_length))], dim=1
+        ) # (bs, buffer_length)
+        position_ids = (attention_mask[:, :prompt_length].cumsum(dim=-1) - 1).clamp(min=0) # (bs, S)
+
+        # end_positions is the index of the frame after the last generated one, -1 means not finished
+        end_positions = torch.full((batch_size,), -1, dtype=torch.long, device=self.device)
+        input_embeds = self.get_embeds_from_inputs_ids(
+            input_ids[:, :, 0], input_ids[:, :, 1:]
+        ) # (bs, S, H)
+        slow_past_key_values = None
+        now_time_step = prompt_length
+        end_check_interval = inference_config.get("end_check_interval", END_CHECK_INTERVAL)
+        # the most padded, i.e. shortest, sequence is the last one to reach the length limit, all sequences have ended
+        # at this step, no need to check end_positions on the host
+        last_time_step = max_total_length + int(pad_lengths.max())
+        while True:
+            window_start = max(now_time_step - inference_config.windows_length, 0)
+            next_token, slow_past_key_values = self.predict_one_token_batch(
+                input_embeds=input_embeds,
+                slow_past_key_values=slow_past_key_values,
+                attention_mask=attention_mask[:, :now_time_step],
+                position_ids=position_ids,
+                inference_config=inference_config,
+                # no repetition penalty in prefilling, same as inference_by_text_prompt
+                previous_token=audio_ids[:, window_start:now_time_step] if now_time_step > prompt_length else None,
+            ) # (bs, Codebook_num + 1)
+
+            text_ids[:, now_time_step] = next_token[:, 0]
+            audio_ids[:, now_time_step] = next_token[:, 1:]
+            attention_mask[:, now_time_step] = 1
+            end_positions = torch.where(
+                (end_positions < 0) & (next_token[:, 0] == self.slow_lm_config.end_of_music_id),
+                now_time_step,
+                end_positions,
+            )
+            now_time_step += 1
+            # sequences reaching the length limit drop the last frame, same as inference_by_text_prompt
+            end_positions = torch.where(
+                (end_positions < 0) & (now_time_step - pad_lengths >= max_total_length),
+                now_time_step - 1,
+                end_positions,
+            )
+            if now_time_step >= last_time_step or (
+                (now_time_step - prompt_length) % end_check_interval == 0 and bool((end_positions >= 0).all())
+            ):
+                break
+
+            position_ids = position_ids[:, -1:] + 1
+            input_embeds = self.get_embeds_from_inputs_ids(
+                next_token[:, None, 0], next_token[:, None, 1:]
+            ) # (bs, 1, H)
+
+        # every prompt ends at prompt_length - 1, which is the forced audio silence frame
+        generation_start = prompt_length - 1
+        return self.decode_generation_audio_ids(
+            [audio_ids[i, generation_start:end] for i, end in enumerate(end_positions.tolist())]
+        )
+
+    def decode_generation_audio_ids(self, generation_audio_ids_list):
+        """
+            decode the generated audio ids of several sequences in one codec batch
+            generation_audio_ids_list: list of shifted audio ids, every item shape = (T, Codebook_num)
+            return: list of waveforms, every waveform shape = (1, T_wav)
+        """
+        codebook_shift = (
+            torch.arange(self.slow_lm_config.audio_codebook_count)
+            * self.slow_lm_config.audio_codebook_size
+        ).to(self.codec_model.device)
+        feature_lengths = torch.tensor(
+            [audio_ids.shape[0] for audio_ids in generation_audio_ids_list],
+            dtype=torch.long,
+            device=self.codec_model.device,
+        )
+        # padding frames are masked in decode, just keep them valid codebook ids
+        generation_audio_ids = pad_sequence(
+            [audio_ids.to(self.codec_model.device) - codebook_shift for audio_ids in generation_audio_ids_list],
+            batch_first=True,
+            padding_value=0,
+        ) # (bs, T, Codebook_num)
 
-        self.predict_n_token(input_embeds_ar, slow_past_key_values, inference_config)
-        generation_audio_ids = self.audio_ids[self.text_prompt_length + 6:-1]
-        # deshift audio ids
-        generation_audio_ids = generation_audio_ids - self.codebook_shift
         wav, _ = self.codec_model.decode(
-            indices=generation_audio_ids.T.unsqueeze(0), # (T, Codebook_num) -> (1, Codebook_num, T)
-            feature_lengths=torch.tensor(generation_audio_ids.shape[0]).to(self.codec_model.device).unsqueeze(0),
+            indices=generation_audio_ids.transpose(1, 2), # (bs, Codebook_num, T)
+            feature_lengths=feature_lengths,
             return_audios=True,
+        ) # (bs, 1, T_wav)
+        samples_per_frame = (
+            math.prod(self.codec_model.quantizer.downsample_factor)
+            * self.codec_model.gt_mel_transform.hop_length
         )
-        return wav.float().cpu().squeeze(0)
+        wav = wav.float().cpu()
+        return [
+            wav[i, :, :audio_ids.shape[0] * samples_per_frame]
+            for i, audio_ids in enumerate(generation_audio_ids_list)
+        ]
+
+    def predict_one_token_batch(
+        self,
+        input_embeds,
+        slow_past_key_values,
+        attention_mask,
+        position_ids,
+        inference_config,
+        previous_token=None,
+    ):
+        """
+            input_embeds: [bs, seq_len, H]
+            attention_mask: [bs, past_seq_len + seq_len]
+            position_ids: [bs, seq_len]
+            previous_token: None or [bs, window, Codebook_num]
+            return: next_token [bs, Codebook_num + 1], slow_past_key_values
+        """
+        # repetition penalty history of every codebook, [bs, Codebook_num, window]
+        history = previous_token.transpose(1, 2) if previous_token is not None else None
+        text_output: MultiModalCausalLMOutputWithPast = (
+            self.model.forward_generate_text(
+                input_embeds=input_embeds,
+                use_cache=True,
+                slow_past_key_values=slow_past_key_values,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+        )
+        text_token = sample_tokens_from_logits_batch(
+            logits=text_output.text_logits[:, -1:, :],
+            previous_tokens=None,  # text token ignore windows_penalty
+            temperature=inference_config.temperature,
+            top_k=inference_config.top_k,
+            top_p=inference_config.top_p,
+            repetition_penalty=inference_config.windows_penalty,
+        ) # (bs, 1)
+
+        # the fast lm only decodes the current frame of every sequence, with a per-frame kv cache
+        token_list = [text_token]
+        fast_past_key_values = None
+        for i in range(self.fast_lm_config.codebook_nums):
+            audio_output: MultiModalCausalLMOutputWithPast = (
+                self.model.forward_generate_audio(
+                    slow_hidden_state=text_output.slow_hidden_states[:, -1:, :] if i == 0 else None,
+                    fast_lm_ids=token_list[-1] if i > 0 else None, # (bs, 1)
+                    use_cache=True,
+                    fast_past_key_values=fast_past_key_values,
+                )
+            )
+            fast_past_key_values = audio_output.fast_past_key_values
+            audio_token = sample_tokens_from_logits_batch(
+                logits=audio_output.audio_logits[:, -1:, :],
+                previous_tokens=history[:, i:i+1] if history is not None else None,
+                temperature=inference_config.temperature,
+                top_k=inference_config.top_k,
+                top_p=inference_config.top_p,
+                repetition_penalty=inference_config.windows_penalty,
+            ) # (bs, 1)
+            token_list.append(audio_token)
+
+        return torch.cat(token_list, dim=1), text_output.slow_past_key_values
 
     def predict_one_token(
         self,
@@ -478,6 +850,9 @@ class MusicLLM(pl.LightningModule):
         inference_config,
         previous_token=None,
     ):
+        """
+            previous_token: None or [1, Codebook_num, window], the repetition penalty history of every codebook
+        """
         text_output_dict = self.sample_text_token(
             input_embeds=input_embeds,
             inference_config=inference_config,
@@ -487,36 +862,75 @@ class MusicLLM(pl.LightningModule):
         slow_lm_hidden_state = text_output_dict["slow_hidden_state"]
         text_token = text_output_dict["text_token"]
 
+        if inference_config.get("fast_lm_kv_cache", True):
+            audio_token_generate_list = self.predict_audio_tokens_with_kv_cache(
+                slow_lm_hidden_state=slow_lm_hidden_state,
+                inference_config=inference_config,
+                previous_token=previous_token,
+            )
+            return torch.stack([text_token] + audio_token_generate_list, dim=0), slow_past_key_values
+
         audio_token_generate_list = []
         # audio generation
         for i in range(self.fast_lm_config.codebook_nums):
             if i == 0:  # semantic to first codebook
                 audio_token = self.sample_audio_token(
                     inference_config=inference_config,
-                    previous_token=previous_token[:, i:i+1].squeeze(1) if previous_token is not None else None,
+                    previous_token=previous_token[:, i:i+1] if previous_token is not None else None,
                     slow_lm_hidden_state=slow_lm_hidden_state,
                     fast_lm_ids=None,
                     use_cache=False,
                     fast_past_key_values=None, # don't use kv cache in the fast lm
-                )
+                )["audio_token"]
                 audio_token_generate_list.append(audio_token)
             else:
-                pad_ids_for_inference = self.audio_ids[1:, :i]  # (bs * seq_len - 1, i) # text_output is the next token, so we need to shift the audio ids for alignment
-                audio_generated_ids = torch.tensor(audio_token_generate_list, device=pad_ids_for_inference.device, dtype=pad_ids_for_inference.dtype).unsqueeze(0)  # (1, i)
+                # text_output is the next token, so we need to shift the audio ids for alignment
+                # only the frames that have a slow lm hidden state in this step are used (all frames in prefilling, the last one in incremental generation)
+                pad_ids_for_inference = self.audio_ids[self.audio_ids.shape[0] - slow_lm_hidden_state.shape[1] + 1:, :i]  # (bs * seq_len - 1, i)
+                audio_generated_ids = torch.stack(audio_token_generate_list, dim=1)  # (1, i)
                 audio_generated_ids = torch.cat([pad_ids_for_inference, audio_generated_ids], dim=0)  # (bs * seq_len, i)
 
                 audio_token = self.sample_audio_token(
                     inference_config=inference_config,
-                    previous_token=previous_token[:, i:i+1].squeeze(1) if previous_token is not None else None,
+                    previous_token=previous_token[:, i:i+1] if previous_token is not None else None,
                     slow_lm_hidden_state=slow_lm_hidden_state,
                     fast_lm_ids=audio_generated_ids,
                     use_cache=False,
                     fast_past_key_values=None,
-                )
+                )["audio_token"]
                 audio_token_generate_list.append(audio_token)
 
         return torch.stack([text_token] + audio_token_generate_list, dim=0), slow_past_key_values
 
+    def predict_audio_tokens_with_kv_cache(
+        self,
+        slow_lm_hidden_state,
+        inference_config,
+        previous_token=None,
+    ):
+        """
+            only the current frame goes through the fast lm, the kv cache is kept across the codebook steps
+            slow_lm_hidden_state: [1, seq_len, hidden_size], only the last frame is used
+            previous_token: None or [1, Codebook_num, window]
+            return: list of codebook_num audio tokens, every token shape = (1)
+        """
+        audio_token_generate_list = []
+        fast_past_key_values = None
+        slow_lm_hidden_state = slow_lm_hidden_state[:, -1:, :] # (1, 1, H)
+        for i in range(self.fast_lm_config.codebook_nums):
+            audio_output_dict = self.sample_audio_token(
+                inference_config=inference_config,
+                previous_token=previous_token[:, i:i+1] if previous_token is not None else None,
+                # the slow hidden state is fed in the first step, after that it is in the kv cache
+                slow_lm_hidden_state=slow_lm_hidden_state if i == 0 else None,
+                fast_lm_ids=audio_token_generate_list[-1].view(1, 1) if i > 0 else None, # (1, 1)
+                use_cache=True,
+                fast_past_key_values=fast_past_key_values,
+            )
+            fast_past_key_values = audio_output_dict["fast_past_key_values"]
+            audio_token_generate_list.append(audio_output_dict["audio_token"])
+        return audio_token_generate_list
+
     def prefilling_next_token(
         self,
         input_embeds,
@@ -532,23 +946,32 @@ class MusicLLM(pl.LightningModule):
         )
 
     def predict_n_token(self, input_embeds, slow_past_key_values, inference_config):
-        now_time_step, _ = self.audio_ids.shape
+        for _ in self.predict_n_token_iter(input_embeds, slow_past_key_values, inference_config):
+            pass
 
-        previous_tokens = torch.zeros(
-            (self.max_length, self.slow_lm_config.audio_codebook_count),
-            dtype=torch.long,
-            device=input_embeds.device) # shape = (T, Codebook_num)
-
-        previous_tokens[:now_time_step, :] = self.audio_ids.clone()
+    def predict_n_token_iter(self, input_embeds, slow_past_key_values, inference_config):
+        """
+            same as predict_n_token, but yields after every generated frame the length of the sequence prefix
+            that is already checked for <EOM>
+            <EOM> is checked every end_check_interval frames with one host sync, so the tokens stay on the device in between,
+            the frames generated after the first <EOM> are dropped
+        """
+        now_time_step, _ = self.audio_ids.shape
         input_embeds_ar = input_embeds
+        end_check_interval = inference_config.get("end_check_interval", END_CHECK_INTERVAL)
+        max_time_step = min(self.max_length, inference_config.max_new_tokens)
+        checked_length = now_time_step - 1 # the frame sampled in prefilling is not checked yet
 
-        while self.is_end_of_predict(now_time_step, inference_config) is False:
-            win_size = inference_config.windows_length
+        while True:
+            if now_time_step - checked_length >= end_check_interval or now_time_step >= max_time_step:
+                if self.truncate_at_end_of_music(now_time_step - checked_length):
+                    return
+                checked_length = now_time_step
+            if now_time_step >= max_time_step:
+                return
 
-            if now_time_step < win_size:
-                window = previous_tokens[:now_time_step, :]
-            else:
-                window = previous_tokens[now_time_step - win_size:, :]
+            # the last windows_length frames of every codebook, [1, Codebook_num, window]
+            window = self.audio_ids[-inference_config.windows_length:].T.unsqueeze(0)
 
             next_token, slow_past_key_values = self.predict_one_token(
                 input_embeds=input_embeds_ar,
@@ -558,30 +981,37 @@ class MusicLLM(pl.LightningModule):
             )
 
             now_time_step += 1
-            previous_tokens[now_time_step, :] = next_token[1:, :].squeeze(1).clone() # next_token[0, :] is text token
             input_embeds_ar = self.process_generation_ids(next_token)
+            yield checked_length
 
     def sample_text_token(
         self, input_embeds, inference_config, slow_past_key_values=None
     ):
+        cache_position = None
+        if isinstance(slow_past_key_values, StaticCache):
+            # write the new frames at the cursor of the static cache, the positions are a view of a preallocated tensor
+            cache_position = self.slow_cache_positions[self.slow_cache_cursor:self.slow_cache_cursor + input_embeds.shape[1]]
+            self.slow_cache_cursor += input_embeds.shape[1]
+
         text_output: MultiModalCausalLMOutputWithPast = (
             self.model.forward_generate_text(
                 input_embeds=input_embeds,
                 use_cache=True,
                 slow_past_key_values=slow_past_key_values,
+                cache_position=cache_position,
             )
         )
 
         text_logits = text_output.text_logits
 
-        text_token = sample_one_token_from_logits(
-            logits=text_logits[0, -1, :], # only one token need to sample
-            previous_token=None,  # text token ignore windows_penalty
+        text_token = sample_tokens_from_logits_batch(
+            logits=text_logits[:1, -1:, :], # only one token need to sample
+            previous_tokens=None,  # text token ignore windows_penalty
             temperature=inference_config.temperature,
             top_k=inference_config.top_k,
             top_p=inference_config.top_p,
             repetition_penalty=inference_config.windows_penalty,
-        )[0]
+        )[0] # (1)
         return {
             "text_token": text_token,
             "slow_past_key_values": text_output.slow_past_key_values,
@@ -597,6 +1027,9 @@ class MusicLLM(pl.LightningModule):
         use_cache=False,
         fast_past_key_values=None,
     ):
+        """
+            previous_token: None or [1, 1, window], the repetition penalty history of the current codebook
+        """
         assert (
             slow_lm_hidden_state is not None or fast_lm_ids is not None
         ), "slow_lm_hidden_state and fast_lm_ids cannot be both None"
@@ -609,19 +1042,34 @@ class MusicLLM(pl.LightningModule):
             )
         )
         audio_logits = audio_output.audio_logits  # (bs * seq_len, 1, vocab_size)
-        audio_token = sample_one_token_from_logits(
-            logits=audio_logits[-1, -1, :], # only one token need to sample
-            previous_token=previous_token,
+        audio_token = sample_tokens_from_logits_batch(
+            logits=audio_logits[-1:, -1:, :], # only one token need to sample
+            previous_tokens=previous_token,
             temperature=inference_config.temperature,
             top_k=inference_config.top_k,
             top_p=inference_config.top_p,
             repetition_penalty=inference_config.windows_penalty,
-        )[0]
-        return audio_token
+        )[0] # (1)
+        return {
+            "audio_token": audio_token,
+            "fast_past_key_values": audio_output.fast_past_key_values,
+        }
+
+    def truncate_at_end_of_music(self, check_length):
+        """
+            check the last check_length frames for <EOM>, the sequence is cut after the first <EOM> frame
+            return: True if <EOM> is found
+        """
+        is_end = self.text_ids[-check_length:] == self.slow_lm_config.end_of_music_id
+        if not bool(is_end.any()):
+            return False
 
-    def is_end_of_predict(self, cur_generation_token_nums, inference_config):
-        return (self.text_ids[-1].item() == self.slow_lm_config.end_of_music_id) or \
-                (cur_generation_token_nums >= min(self.max_length, inference_config.max_new_tokens))
+        generation_length = self.text_ids.shape[0] - check_length + int(is_end.int().argmax()) + 1
+        self.text_ids = self.text_ids[:generation_length]
+        self.audio_ids = self.audio_ids[:generation_length]
+        if getattr(self, "incremental_generation", False):
+            self.generation_length = generation_length
+        return True
 
     def text_inference_input_processor(self, inference_config):
         text_logits = self.process_inputs_cls.text_tokenizer(
@@ -639,10 +1087,79 @@ class MusicLLM(pl.LightningModule):
         # input_ids = torch.cat([text_special_token_start, text_logits, text_special_token_middle_list], dim=0)
         return text_logits
 
+    def init_slow_static_cache(self, prompt_length):
+        """
+            the static slow lm kv cache is allocated once and reset for every generation,
+            it is only reallocated when a prompt longer than max_length comes
+        """
+        max_cache_len = max(self.max_length, prompt_length) + 1
+        if getattr(self, "slow_static_cache", None) is None or self.slow_static_cache.max_cache_len < max_cache_len:
+            self.slow_static_cache = StaticCache(
+                config=self.slow_lm_config,
+                max_batch_size=1,
+                max_cache_len=max_cache_len,
+                device=self.device,
+                dtype=self.model.slow_model.dtype,
+            )
+            self.slow_cache_positions = torch.arange(max_cache_len, device=self.device)
+        else:
+            self.slow_static_cache.reset()
+        self.slow_cache_cursor = 0
+        return self.slow_static_cache
+
+    def init_generation_buffers(self, text_input_ids, audio_input_ids):
+        """
+            preallocate the id buffers for generation, every step only writes the new frame in place
+            text_input_ids: [S]
+            audio_input_ids: [S, codebook_num]
+        """
+        prompt_length = text_input_ids.shape[0]
+        buffer_length = max(self.max_length, prompt_length) + 1
+
+        self.text_ids_buffer = torch.full(
+            (buffer_length,),
+            self.slow_lm_config.text_modality_mambaout_token_id,
+            dtype=text_input_ids.dtype,
+            device=text_input_ids.device,
+        )
+        self.audio_ids_buffer = torch.full(
+            (buffer_length, audio_input_ids.shape[1]),
+            self.slow_lm_config.slow_audio_modality_mambaout_token_id,
+            dtype=audio_input_ids.dtype,
+            device=audio_input_ids.device,
+        )
+        self.text_ids_buffer[:prompt_length] = text_input_ids
+        self.audio_ids_buffer[:prompt_length] = audio_input_ids
+        self.generation_length = prompt_length
+
+        # text_ids and audio_ids are views of the buffers, no copy
+        self.text_ids = self.text_ids_buffer[:prompt_length]
+        self.audio_ids = self.audio_ids_buffer[:prompt_length]
+
+    def process_generation_ids_incremental(self, next_token):
+        """
+            next_token: [codebook_num + 1, 1]: codebook_num + 1 means text_token + codebook_num
+            the history is already in the slow lm kv cache, so only the new frame is embedded
+        """
+        self.text_ids_buffer[self.generation_length] = next_token[0, 0]
+        self.audio_ids_buffer[self.generation_length] = next_token[1:, 0]
+        self.generation_length += 1
+
+        self.text_ids = self.text_ids_buffer[:self.generation_length] # shape = (T)
+        self.audio_ids = self.audio_ids_buffer[:self.generation_length] # shape = (T, Codebook_num)
+
+        input_embeds = self.get_embeds_from_inputs_ids(
+            next_token[0], next_token[1:].T
+        ).unsqueeze(0) # shape = (1, 1, H)
+        return input_embeds
+
     def process_generation_ids(self, next_token):
         """
             next_token: [codebook_num + 1, 1]: codebook_num + 1 means text_token + codebook_num
         """
+        if getattr(self, "incremental_generation", False):
+            return self.process_generation_ids_incremental(next_token)
+
         self.text_ids = (
             torch.cat(
                 [self.text_ids, next_token[0]], dim=0
@@ -92,10 +92,11 @@ class LowPassFilter1d(nn.Module):
 
     # Input [B, C, T]
     def forward(self, x):
-        _, C, _ = x.shape
+        B, C, T = x.shape
 
         if self.padding:
             x = F.pad(x, (self.pad_left, self.pad_right), mode=self.padding_mode)
-        out = F.conv1d(x, self.filter.expand(C, -1, -1), stride=self.stride, groups=C)
+        # the same filter for every channel, channels are folded into the batch so the kernel shape is static for onnx
+        out = F.conv1d(x.reshape(B * C, 1, -1), self.filter, stride=self.stride)
 
-        return out
+        return out.view(B, C, -1)
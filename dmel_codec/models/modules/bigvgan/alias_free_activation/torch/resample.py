@@ -27,12 +27,13 @@ class UpSample1d(nn.Module):
 
     # x: [B, C, T]
     def forward(self, x):
-        _, C, _ = x.shape
+        B, C, _ = x.shape
 
         x = F.pad(x, (self.pad, self.pad), mode="replicate")
+        # same as the depthwise conv with the filter expanded to C channels, with a static kernel shape for onnx
         x = self.ratio * F.conv_transpose1d(
-            x, self.filter.expand(C, -1, -1), stride=self.stride, groups=C
-        )
+            x.reshape(B * C, 1, -1), self.filter, stride=self.stride
+        ).view(B, C, -1)
         x = x[..., self.pad_left : -self.pad_right]
 
         return x
@@ -6,6 +6,7 @@
 
 import os
 import json
+import math
 from pathlib import Path
 from typing import Optional, Union, Dict
 
@@ -18,6 +19,7 @@ from dmel_codec.models.modules.bigvgan import activations
 from dmel_codec.models.modules.bigvgan.utils import init_weights, get_padding
 from dmel_codec.models.modules.bigvgan.alias_free_activation.torch.act import Activation1d as TorchActivation1d
 from dmel_codec.models.modules.bigvgan.env import AttrDict
+from dmel_codec.models.modules.dynamic_int8 import DynamicInt8Conv1d
 
 from huggingface_hub import PyTorchModelHubMixin, hf_hub_download
 
@@ -392,6 +394,38 @@ class BigVGAN(
 
         return x
 
+    def receptive_field(self):
+        """
+            one sided receptive field of the vocoder, in mel frames
+        """
+        def chain_receptive_field(module):
+            # in samples of the module input rate, the convs and activations of a block are chained
+            receptive_field = 0
+            for m in module.modules():
+                if isinstance(m, (Conv1d, DynamicInt8Conv1d)):
+                    receptive_field += m.dilation[0] * (m.kernel_size[0] - 1) // 2
+                elif hasattr(m, "upsample") and hasattr(m, "downsample"): # anti-aliased Activation1d
+                    receptive_field += math.ceil(
+                        (m.upsample.kernel_size + m.downsample.kernel_size) / (2 * m.upsample.ratio)
+                    )
+            return receptive_field
+
+        receptive_field = chain_receptive_field(self.conv_pre)
+        samples_per_frame = 1
+        for i in range(self.num_upsamples):
+            up = self.ups[i][0]
+            receptive_field += math.ceil(up.kernel_size[0] / (2 * up.stride[0])) / samples_per_frame
+            samples_per_frame *= up.stride[0]
+            # the resblocks of one stage run in parallel
+            receptive_field += max(
+                chain_receptive_field(self.resblocks[i * self.num_kernels + j]) for j in range(self.num_kernels)
+            ) / samples_per_frame
+
+        receptive_field += (
+            chain_receptive_field(self.activation_post) + chain_receptive_field(self.conv_post)
+        ) / samples_per_frame
+        return math.ceil(receptive_field)
+
     def remove_weight_norm(self):
         try:
             print("Removing weight norm...")
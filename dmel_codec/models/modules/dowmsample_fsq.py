@@ -1,3 +1,4 @@
+import math
 from dataclasses import dataclass
 
 import torch
@@ -25,8 +26,13 @@ class DownsampleFiniteScalarQuantize(nn.Module):
         levels: tuple[int] = (8, 5, 5, 5),  # Approximate 2**10
         downsample_factor: tuple[int] = (2, 2),
         downsample_dims: tuple[int] | None = None,
-        is_dmel: bool = False
+        is_dmel: bool = False,
+        use_decode_table: bool = True,
     ):
+        """
+            use_decode_table: decode without autograd gathers the projected latents from a precomputed
+                              [groups, n_codebooks, codebook_size, dim] table instead of get_output_from_indices
+        """
         super().__init__()
 
         if downsample_dims is None:
@@ -78,11 +84,38 @@ class DownsampleFiniteScalarQuantize(nn.Module):
 
         self.apply(self._init_weights)
 
+        self.use_decode_table = use_decode_table
+        self.decode_table = None
+        self.decode_table_key = None
+
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv1d, nn.Linear)):
             nn.init.kaiming_uniform_(m.weight, mode='fan_in', nonlinearity='leaky_relu')
             nn.init.constant_(m.bias, 0)
 
+    def downsample_receptive_field(self):
+        """
+            one sided receptive field of the strided convs and convnext blocks of encode, in input frames
+            every stage adds a full output frame of context for the stride, so the bound is not tight
+        """
+        receptive_field = 0
+        stride = 1
+        for factor, stage in zip(self.downsample_factor, self.downsample):
+            stride *= factor
+            receptive_field += stage[1].dwconv.padding[0] * stride
+        return receptive_field + stride
+
+    def upsample_receptive_field(self):
+        """
+            one sided receptive field of the transposed convs and convnext blocks of decode, in output frames
+        """
+        receptive_field = 0
+        stride = math.prod(self.downsample_factor)
+        for factor, stage in zip(reversed(self.downsample_factor), self.upsample):
+            stride //= factor
+            receptive_field += stage[1].dwconv.padding[0] * stride
+        return receptive_field + math.prod(self.downsample_factor)
+
     def forward(self, z) -> FSQResult:
         original_shape = z.shape
         
@@ -127,17 +160,61 @@ class DownsampleFiniteScalarQuantize(nn.Module):
         if self.is_dmel:
             z = rearrange(z, "(b g) f t -> b (g f) t", g = self.groups)
             
-        _, indices = self.residual_fsq(z.mT)
+        _, indices = self.residual_fsq(z.transpose(1, 2))
         
         indices = rearrange(indices, "g b l r -> b (g r) l")
         return indices
 
+    def get_decode_table(self):
+        """
+            return: [groups, n_codebooks, codebook_size, dim // groups], the projected latent of every code,
+                    the project_out bias is only in the first codebook so the codebooks can be summed
+            rebuilt when a parameter or buffer of residual_fsq is changed, moved or cast, a change is seen through the
+            tensor version counter, which in place ops and load_state_dict bump, writes through param.data do not,
+            set decode_table to None after them
+            inference tensors, e.g. of a model built under torch.inference_mode, have no version counter, their
+            in place changes are not seen either
+        """
+        tensors = list(self.residual_fsq.parameters()) + list(self.residual_fsq.buffers())
+        key = tuple(
+            (t.data_ptr(), None if t.is_inference() else t._version, t.dtype, t.device) for t in tensors
+        )
+        if self.decode_table is not None and key == self.decode_table_key:
+            return self.decode_table
+
+        tables = []
+        for rvq in self.residual_fsq.rvqs:
+            codes = rvq.codebooks * rvq.scales[:, None, :] # [n_codebooks, codebook_size, d]
+            table = rvq.project_out(codes.to(rvq.scales.dtype))
+            if table.shape[0] > 1:
+                table[1:] = table[1:] - rvq.project_out(torch.zeros_like(codes[:1]))
+            tables.append(table)
+        self.decode_table = torch.stack(tables, dim=0)
+        self.decode_table_key = key
+        return self.decode_table
+
+    def get_output_from_indices_with_table(self, indices: torch.Tensor):
+        """
+            same as residual_fsq.get_output_from_indices with one embedding gather
+            indices: [b, (g r), l]
+            return: [b, (g f), l]
+        """
+        table = self.get_decode_table()
+        groups, n_codebooks, codebook_size, dim = table.shape
+        indices = indices.view(indices.shape[0], groups, n_codebooks, indices.shape[-1])
+        offsets = torch.arange(groups * n_codebooks, device=indices.device).view(1, groups, n_codebooks, 1)
+        z_q = F.embedding(indices + offsets * codebook_size, table.view(-1, dim)) # [b, g, r, l, f]
+        return rearrange(z_q.sum(dim=2), "b g l f -> b (g f) l")
+
     def decode(self, indices: torch.Tensor):
-        indices = rearrange(indices, "b (g r) l -> g b l r", g=self.residual_fsq.groups)
-        z_q = self.residual_fsq.get_output_from_indices(indices)
+        if self.use_decode_table and not torch.is_grad_enabled():
+            z_q = self.get_output_from_indices_with_table(indices)
+        else:
+            indices = rearrange(indices, "b (g r) l -> g b l r", g=self.residual_fsq.groups)
+            z_q = self.residual_fsq.get_output_from_indices(indices).mT
         
         if self.is_dmel:
-            z_q = rearrange(z_q.mT, "b (g f) t -> (b g) f t", g = self.groups)
+            z_q = rearrange(z_q, "b (g f) t -> (b g) f t", g = self.groups)
         
         z_q = self.upsample(z_q)
         
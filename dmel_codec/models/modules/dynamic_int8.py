@@ -0,0 +1,88 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig
+
+
+class DynamicInt8Conv1d(nn.Module):
+    """
+        cpu inference replacement of nn.Conv1d, the conv runs as the int8 dynamic quantized linear of torch.ao
+        on the unfolded input: per output channel int8 weights, the activations are quantized on every call
+    """
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        if conv.groups != 1 or conv.padding_mode != "zeros" or isinstance(conv.padding, str):
+            raise ValueError(
+                f"Only Conv1d with groups=1 and int zero padding can be quantized, got {conv}"
+            )
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+
+        linear = nn.Linear(
+            conv.in_channels * conv.kernel_size[0], conv.out_channels, bias=conv.bias is not None
+        ).to(conv.weight.device)
+        with torch.no_grad():
+            # [C_out, C_in, k] -> [C_out, k * C_in], the same order as the unfolded frames
+            linear.weight.copy_(conv.weight.permute(0, 2, 1).reshape(conv.out_channels, -1))
+            if conv.bias is not None:
+                linear.bias.copy_(conv.bias)
+        linear.qconfig = per_channel_dynamic_qconfig
+        self.linear = DynamicQuantizedLinear.from_float(linear)
+
+    def forward(self, x, padding=None):
+        """
+            x: [B, C_in, T], return: [B, C_out, T_out]
+            padding: None is the padding of the replaced conv, 0 for the unpadded WaveNet.step
+        """
+        padding = self.padding[0] if padding is None else padding
+        if padding > 0:
+            x = F.pad(x, (padding, padding))
+        x = x.transpose(1, 2) # [B, T, C_in]
+
+        kernel_size, dilation, stride = self.kernel_size[0], self.dilation[0], self.stride[0]
+        if kernel_size > 1 or stride > 1:
+            span = (kernel_size - 1) * dilation + 1
+            x = x.unfold(1, span, stride)[..., ::dilation] # [B, T_out, C_in, k]
+            x = x.transpose(2, 3).reshape(x.shape[0], x.shape[1], -1) # [B, T_out, k * C_in]
+
+        return self.linear(x.contiguous()).transpose(1, 2)
+
+    def extra_repr(self):
+        return (
+            f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, stride={self.stride}, "
+            f"padding={self.padding}, dilation={self.dilation}"
+        )
+
+
+def quantize_dynamic_int8(module: nn.Module, min_channels: int = 256):
+    """
+        replace the nn.Linear and nn.Conv1d layers of module in place with dynamic int8 versions
+        min_channels: layers with fewer input channels stay in float32, the int8 gemm and the unfold
+                      are slower than the float32 conv for the narrow high sample rate convs of the vocoder
+        convs with groups or non zero padding and the transposed convs stay in float32
+        weight norm must be removed before, the quantized weights are taken from conv.weight
+        return: number of replaced layers
+    """
+    num_replaced = 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.Linear) and child.in_features >= min_channels:
+            child.qconfig = per_channel_dynamic_qconfig
+            setattr(module, name, DynamicQuantizedLinear.from_float(child))
+            num_replaced += 1
+        elif (
+            type(child) is nn.Conv1d
+            and child.in_channels >= min_channels
+            and child.groups == 1
+            and child.padding_mode == "zeros"
+            and not isinstance(child.padding, str)
+        ):
+            setattr(module, name, DynamicInt8Conv1d(child))
+            num_replaced += 1
+        else:
+            num_replaced += quantize_dynamic_int8(child, min_channels)
+    return num_replaced
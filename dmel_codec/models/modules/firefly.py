@@ -380,6 +380,15 @@ class ConvNeXtBlock(nn.Module):
         )
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
 
+    @torch.no_grad()
+    def fuse_layer_scale(self):
+        # gamma * pwconv2(x) == pwconv2'(x) with the rows of pwconv2 scaled by gamma
+        if self.gamma is None:
+            return
+        self.pwconv2.weight.mul_(self.gamma[:, None])
+        self.pwconv2.bias.mul_(self.gamma)
+        self.gamma = None
+
     def forward(self, x, apply_residual: bool = True):
         input = x
 
@@ -73,14 +73,20 @@ class ChatMusicSlowLMModel(Qwen2Model):
             **kwargs,
         )
 
-    def forward_generate(self, input_embeds, use_cache=True, past_key_values=None):
+    def forward_generate(self, input_embeds, use_cache=True, past_key_values=None, attention_mask=None, position_ids=None, cache_position=None):
         """
             input_embeds: [bs, seq_len, hidden_size]
+            attention_mask: None or [bs, past_seq_len + seq_len], 0 for left padding
+            position_ids: None or [bs, seq_len]
+            cache_position: None or [seq_len], the write position in a static kv cache
         """
         return super().forward(
             inputs_embeds=input_embeds,
             use_cache=use_cache,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
         )
 
 
@@ -106,6 +112,12 @@ class ChatMusicFastLMModel(Qwen2Model):
         )
 
     def forward(self, inp, labels):
+        """
+            return:
+                outputs: fast lm outputs of the kept positions, [N, codebook_num + 1, hidden_size]
+                labels: [bs, seq_len - 1, codebook_num]
+                keep: [bs * (seq_len - 1)], positions with at least one audio label, padding is skipped
+        """
         hidden_states = inp.last_hidden_state  # [bs, seq_len, slow_lm_hidden_size]
 
         # preprocess labels
@@ -142,27 +154,35 @@ class ChatMusicFastLMModel(Qwen2Model):
         )  # [bs, seq_len - 1, codebook_num + 1, hidden_size]
 
         input_embeds = rearrange(input_embeds, "b s c h -> (b s) c h")
+
+        # positions whose audio labels are all ignored add nothing to the audio loss, skip them in the depth transformer
+        keep = (rearrange(labels, "b s c -> (b s) c") != SOFTMAX_IGNORE_INDEX).any(dim=-1)
+        input_embeds = input_embeds[keep]
         outputs = super().forward(inputs_embeds=input_embeds)
 
-        return outputs, labels
+        return outputs, labels, keep
 
     def forward_generate(self, slow_hidden_state = None, fast_lm_ids = None, use_cache=False, fast_past_key_values=None):
         """
-            slow_hidden_state: [1, seq_len(1: T+1), hidden_size]
+            slow_hidden_state: None or [1, seq_len(1: T+1), hidden_size]
             fast_lm_ids: None or [1 * seq_len(1: T+1), now_inference_codebook_num]
+            slow_hidden_state can be None when decoding with kv cache, the slow hidden state is already in fast_past_key_values
         """
         fast_lm_embeds = None
         if fast_lm_ids is not None:
             fast_lm_embeds = self.embed_tokens(fast_lm_ids)
 
-        hidden_states = self.pre_norm(slow_hidden_state)
-        if self.need_project:
+        hidden_states = None
+        if slow_hidden_state is not None:
+            hidden_states = self.pre_norm(slow_hidden_state)
             hidden_states = self.slow_lm_to_fast_lm_dim_projector(
                 hidden_states
             ).unsqueeze(2)  # [bs, seq_len, 1, fast_lm_hidden_size]
-            
-        hidden_states = rearrange(hidden_states, "b s c h -> (b s) c h")
-        if fast_lm_embeds is not None:
+            hidden_states = rearrange(hidden_states, "b s c h -> (b s) c h")
+
+        if hidden_states is None:
+            hidden_states = fast_lm_embeds # [1 * T, now_inference_codebook_num, hidden_size]
+        elif fast_lm_embeds is not None:
             hidden_states = torch.cat([hidden_states, fast_lm_embeds], dim=1) # [1 * T, now_inference_codebook_num + 1, hidden_size]
 
         fast_outputs = super().forward(
@@ -208,10 +228,20 @@ class ChatMusicForCausalLM(nn.Module):
         inputs_embeds: Optional[torch.FloatTensor] = None,
         text_labels: Optional[torch.LongTensor] = None,
         audio_labels: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
         **loss_kwargs,
     ):
-        text_outputs = self.slow_model(inputs_embeds=inputs_embeds)
-        audio_outputs, audio_labels = self.fast_model(text_outputs, audio_labels)
+        """
+            attention_mask: None or [bs, 1, seq_len, seq_len], the block diagonal mask of packed sequences
+            position_ids: None or [bs, seq_len], restart at every packed sequence
+        """
+        text_outputs = self.slow_model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+        )
+        audio_outputs, audio_labels, keep = self.fast_model(text_outputs, audio_labels)
 
         text_hidden_states = text_outputs["last_hidden_state"]
         # Only compute necessary logits, and do not upcast them to float if we are not computing the loss
@@ -219,7 +249,7 @@ class ChatMusicForCausalLM(nn.Module):
 
         audio_hidden_states = audio_outputs["last_hidden_state"]
 
-        audio_logits = self.audio_lm_head(audio_hidden_states)  # [bs * (seq_len - 1), codebook_num + 1, vocab_size]
+        audio_logits = self.audio_lm_head(audio_hidden_states)  # [N, codebook_num + 1, vocab_size], N kept positions
 
         text_loss = None
         audio_loss = None
@@ -234,12 +264,12 @@ class ChatMusicForCausalLM(nn.Module):
             text_loss -= text_loss
             log.info("Loss is nan or inf, setting to 0")
 
-        # audio_logits: [bs * (seq_len - 1), codebook_num + 1, vocab_size]
+        # audio_logits: [N, codebook_num + 1, vocab_size]
         # audio_labels: [bs, (seq_len - 1), codebook_num], concat text shift labels to align timesteps
         tmp_text_labels = text_labels[:, 1:] # [bs, seq_len - 1]
         tmp_text_labels = tmp_text_labels.contiguous().view(-1, 1) # [bs * (seq_len - 1), 1]
         audio_labels = rearrange(audio_labels, "b s c -> (b s) c") # [bs * (seq_len - 1), codebook_num]
-        audio_labels = torch.cat([tmp_text_labels, audio_labels], dim=1) # [bs * (seq_len - 1), codebook_num + 1]
+        audio_labels = torch.cat([tmp_text_labels, audio_labels], dim=1)[keep] # [N, codebook_num + 1]
 
         audio_loss = self.loss_function(
             audio_logits,
@@ -269,14 +299,20 @@ class ChatMusicForCausalLM(nn.Module):
             new_audio_labels=audio_labels,
         )
 
-    def forward_generate_text(self, input_embeds, use_cache=True, slow_past_key_values=None):
+    def forward_generate_text(self, input_embeds, use_cache=True, slow_past_key_values=None, attention_mask=None, position_ids=None, cache_position=None):
         """
-            input_embeds: [1, seq_len, hidden_size]
+            input_embeds: [bs, seq_len, hidden_size]
+            attention_mask: None or [bs, past_seq_len + seq_len], only needed for left padded batches
+            position_ids: None or [bs, seq_len]
+            cache_position: None or [seq_len], needed when slow_past_key_values is a StaticCache
         """
         text_outputs = self.slow_model.forward_generate(
             input_embeds=input_embeds,
             use_cache=use_cache,
             past_key_values=slow_past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
         )
 
         text_logits = self.text_lm_head(text_outputs.last_hidden_state)
@@ -296,9 +332,9 @@ class ChatMusicForCausalLM(nn.Module):
             new_audio_labels=None,
         )
         
-    def forward_generate_audio(self, slow_hidden_state, fast_lm_ids = None, use_cache=False, fast_past_key_values=None):
+    def forward_generate_audio(self, slow_hidden_state = None, fast_lm_ids = None, use_cache=False, fast_past_key_values=None):
         """
-            slow_hidden_state: [1, seq_len(1: T+1), hidden_size]
+            slow_hidden_state: None or [1, seq_len(1: T+1), hidden_size]
             fast_lm_embeds: None or [1 * seq_len(1: T+1), now_inference_codebook_num, hidden_size]
         """
         audio_output = self.fast_model.forward_generate(
@@ -48,6 +48,11 @@ class ProcessInputs:
 
             return audio_ids_list
 
+    def get_audio_ids_from_store(self, audio_ids_list, device):
+        # pre-extracted audio ids, list of [T, codebook_num], same truncation as get_audio_ids_parralel
+        # copy, id_shift works in place and must not change the batch
+        return [audio_ids[:self.max_length].to(device, copy=True) for audio_ids in audio_ids_list]
+
     def get_input_label(self, item, device):
         # input one sample
 
@@ -258,6 +263,43 @@ class ProcessInputs:
             ).to(device)
             return torch.cat([text_modality_tokens, audio_modality_tokens.T], dim=0).to(device)
 
+    def process_2d_logits_infer_batch(self, device, text_ids_list):
+        """
+            batch version of process_2d_logits_infer for text prompts, sequences are left padded
+            text_ids_list: list of text ids, every item shape = (text_length)
+
+            return:
+                input_ids: [bs, T, codebook_num + 1], left padded with the modality mambaout tokens
+                attention_mask: [bs, T], 0 for padding
+        """
+        input_ids_list = [
+            self.process_2d_logits_infer(
+                device=device,
+                text_ids=text_ids.view(1, -1),
+                audio_ids=None,
+                text_prompt_length=text_ids.shape[-1],
+                audio_prompt_length=0,
+            ).T # (T, codebook_num + 1)
+            for text_ids in text_ids_list
+        ]
+        max_length = max(input_ids.shape[0] for input_ids in input_ids_list)
+
+        pad_ids = torch.tensor(
+            [self.config.text_modality_mambaout_token_id]
+            + [self.config.slow_audio_modality_mambaout_token_id] * self.config.audio_codebook_count,
+            dtype=torch.long,
+            device=device,
+        )
+        input_ids = pad_ids.repeat(len(input_ids_list), max_length, 1) # (bs, T, codebook_num + 1)
+        attention_mask = torch.zeros(
+            (len(input_ids_list), max_length), dtype=torch.long, device=device
+        )
+        for i, item in enumerate(input_ids_list):
+            input_ids[i, max_length - item.shape[0]:] = item
+            attention_mask[i, max_length - item.shape[0]:] = 1
+
+        return input_ids, attention_mask
+
     def get_text_special_token_start_middle_end(self, audio_length, device):
         text_special_token_start_list = []
         text_special_token_start_list.append(self.config.start_of_human_id)
@@ -5,6 +5,8 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from dmel_codec.models.modules.dynamic_int8 import DynamicInt8Conv1d
+
 
 class Mish(nn.Module):
     def forward(self, x):
@@ -134,6 +136,39 @@ class ResidualBlock(nn.Module):
 
         return (x + residual) / math.sqrt(2.0), skip
 
+    def step(self, x, condition=None, diffusion_step=None):
+        """
+            forward without padding, used by WaveNet.step
+            x: [B, C, n + 2 * dilation], the frames to compute with dilation frames of context on both sides
+            condition: None or [B, C_cond, n]
+            return: x, skip, [B, C, n]
+        """
+        dilation = self.conv_layer.conv.dilation[0]
+        y = x
+
+        if diffusion_step is not None:
+            diffusion_step = self.diffusion_projection(diffusion_step).unsqueeze(-1)
+            y = y + diffusion_step
+
+        conv = self.conv_layer.conv
+        if isinstance(conv, DynamicInt8Conv1d):
+            # replaced by quantize_decode_int8, there is no float weight
+            y = conv(y, padding=0)
+        else:
+            y = F.conv1d(y, conv.weight, conv.bias, dilation=conv.dilation)
+
+        if condition is not None:
+            condition = self.condition_projection(condition)
+            y = y + condition
+
+        gate, filter = torch.chunk(y, 2, dim=1)
+        y = torch.sigmoid(gate) * torch.tanh(filter)
+
+        y = self.output_projection(y)
+        residual, skip = torch.chunk(y, 2, dim=1)
+
+        return (x[:, :, dilation:x.shape[2] - dilation] + residual) / math.sqrt(2.0), skip
+
 
 class WaveNet(nn.Module):
     def __init__(
@@ -193,6 +228,9 @@ class WaveNet(nn.Module):
                 LinearNorm(residual_channels * 4, residual_channels, False),
             )
 
+        # the condition projections of all residual layers fused by optimize_for_inference
+        self.condition_projection = None
+
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
@@ -201,6 +239,170 @@ class WaveNet(nn.Module):
             if getattr(m, "bias", None) is not None:
                 nn.init.constant_(m.bias, 0)
 
+    def receptive_field(self):
+        # one sided receptive field of the dilated residual layers, in frames
+        return sum(
+            layer.conv_layer.conv.dilation[0] * (layer.conv_layer.conv.kernel_size[0] - 1) // 2
+            for layer in self.residual_layers
+        )
+
+    @torch.no_grad()
+    def optimize_for_inference(self, fuse_condition_projections: bool = True):
+        """
+            fold the inference graph, the outputs are the same up to float rounding and the model can not be trained after it
+            1. fuse_condition_projections: the 1x1 condition projections of all residual layers run as one conv with
+               L * 2C output channels, the condition is the same for every layer. one launch instead of L on gpu,
+               on cpu the L * 2C x T output does not stay in cache and the per layer convs are faster
+            2. skip_projection is folded into the skip half of the 1x1 output projection of every layer,
+               skip_projection(sum(skip) / sqrt(L)) is linear in every skip
+        """
+        layers = self.residual_layers
+        if fuse_condition_projections and self.condition_projection is None and hasattr(layers[0], "condition_projection"):
+            convs = [layer.condition_projection.conv for layer in layers]
+            if any(type(conv) is not nn.Conv1d for conv in convs):
+                raise ValueError("optimize_for_inference must be called before the convs are replaced")
+            self.condition_projection = nn.Conv1d(
+                convs[0].in_channels, sum(conv.out_channels for conv in convs), kernel_size=1
+            ).to(convs[0].weight)
+            self.condition_projection.weight.copy_(torch.cat([conv.weight for conv in convs], dim=0))
+            self.condition_projection.bias.copy_(torch.cat([conv.bias for conv in convs], dim=0))
+            for layer in layers:
+                layer.condition_projection = nn.Identity()
+
+        if isinstance(self.skip_projection, ConvNorm):
+            skip_projection = self.skip_projection.conv
+            if type(skip_projection) is not nn.Conv1d:
+                raise ValueError("optimize_for_inference must be called before the convs are replaced")
+            weight = skip_projection.weight[:, :, 0].float() # [C, C], folded in float32 for bfloat16 models
+            for i, layer in enumerate(layers):
+                conv = layer.output_projection.conv
+                channels = conv.out_channels // 2
+                bias = weight @ conv.bias[channels:].float()
+                if i == 0:
+                    # the skips are summed and divided by sqrt(L) before the bias of skip_projection
+                    bias += skip_projection.bias.float() * math.sqrt(len(layers))
+                conv.weight[channels:, :, 0] = (weight @ conv.weight[channels:, :, 0].float()).to(conv.weight.dtype)
+                conv.bias[channels:] = bias.to(conv.bias.dtype)
+            self.skip_projection = nn.Identity()
+
+    def get_layer_condition(self, condition, i):
+        """
+            condition of residual layer i: the condition frames, or the slice of the fused projection
+        """
+        if condition is None or self.condition_projection is None:
+            return condition
+        channels = condition.shape[1] // len(self.residual_layers)
+        return condition[:, i * channels:(i + 1) * channels]
+
+    def init_state(self):
+        """
+            state of the incremental inference, every residual layer keeps the input frames
+            [next output - dilation, received), i.e. a buffer of 2 * 2 ** (i % dilation_cycle) frames between calls
+            the buffers are queues grown with torch.cat and trimmed by slicing on every step,
+            not preallocated ring buffers, so a step allocates new tensors
+        """
+        return {
+            "inputs": [None for _ in self.residual_layers], # zero left padding is added on the first step
+            "outputs": [0 for _ in self.residual_layers], # next output frame of every layer
+            "condition": None, # condition frames from the next output frame of the last layer
+            "skip": None, # sum of the skip connections from the next output frame of the last layer
+        }
+
+    def step(self, x, state, t=None, condition=None):
+        """
+            incremental forward, feeding N new frames costs O(N * layers)
+            the residual convs look dilation frames ahead, so the output lags the input by receptive_field() frames,
+            call flush at the end of the sequence for the last frames
+            x: [B, C_in, N]
+            condition: None or [B, C_cond, N], the condition frames aligned with x
+            return: [B, C_out, n], the finished frames, n can be 0
+        """
+        return self._step(x, state, t=t, condition=condition, is_final=False)
+
+    def flush(self, state, t=None):
+        """
+            finish the sequence with the zero padding of every residual layer, same as the end of forward
+            return: [B, C_out, n]
+        """
+        return self._step(None, state, t=t, condition=None, is_final=True)
+
+    def _step(self, x, state, t=None, condition=None, is_final=False):
+        if x is not None and self.input_projection is not None:
+            x = self.input_projection(x)
+            x = F.silu(x)
+
+        if t is not None:
+            t = self.diffusion_embedding(t)
+            t = self.mlp(t)
+
+        if condition is not None:
+            if self.condition_projection is not None:
+                condition = self.condition_projection(condition)
+            state["condition"] = (
+                condition if state["condition"] is None else torch.cat([state["condition"], condition], dim=2)
+            )
+
+        last_output = state["outputs"][-1]
+        for i, layer in enumerate(self.residual_layers):
+            dilation = layer.conv_layer.conv.dilation[0]
+            inputs = state["inputs"][i]
+            if inputs is None and x is not None:
+                inputs = F.pad(x[:, :, :0], (dilation, 0))
+            if x is not None:
+                inputs = torch.cat([inputs, x], dim=2)
+            if is_final and inputs is not None:
+                inputs = F.pad(inputs, (0, dilation))
+
+            n = inputs.shape[2] - 2 * dilation if inputs is not None else 0
+            if n <= 0:
+                state["inputs"][i] = inputs
+                x = None
+                continue
+
+            layer_condition = None
+            if state["condition"] is not None:
+                offset = state["outputs"][i] - last_output
+                layer_condition = self.get_layer_condition(state["condition"][:, :, offset:offset + n], i)
+
+            x, skip = layer.step(inputs, layer_condition, t)
+            state["inputs"][i] = inputs[:, :, n:]
+
+            # accumulate the skip connection of the frames [outputs[i], outputs[i] + n)
+            offset = state["outputs"][i] - last_output
+            if state["skip"] is None:
+                state["skip"] = skip.new_zeros(skip.shape[0], skip.shape[1], 0)
+            if state["skip"].shape[2] < offset + n:
+                state["skip"] = F.pad(state["skip"], (0, offset + n - state["skip"].shape[2]))
+            state["skip"][:, :, offset:offset + n] += skip
+            state["outputs"][i] += n
+
+        n = state["outputs"][-1] - last_output
+        if n == 0:
+            out_projection = (
+                self.output_projection.conv if self.output_projection is not None
+                else self.residual_layers[-1].output_projection.conv # skip half, skip_projection may be folded
+            )
+            channels = out_projection.out_channels if self.output_projection is not None else out_projection.out_channels // 2
+            batch_size = state["inputs"][0].shape[0] if state["inputs"][0] is not None else 1
+            if isinstance(out_projection, DynamicInt8Conv1d):
+                # no float weight after quantize_decode_int8, which runs in float32 on cpu
+                return torch.zeros(batch_size, channels, 0)
+            return out_projection.weight.new_zeros(batch_size, channels, 0)
+
+        skip = state["skip"][:, :, :n]
+        state["skip"] = state["skip"][:, :, n:]
+        if state["condition"] is not None:
+            state["condition"] = state["condition"][:, :, n:]
+
+        x = skip / math.sqrt(len(self.residual_layers))
+        x = self.skip_projection(x)
+
+        if self.output_projection is not None:
+            x = F.silu(x)
+            x = self.output_projection(x)
+
+        return x
+
     def forward(self, x, t=None, condition=None):
         if self.input_projection is not None:
             x = self.input_projection(x)
@@ -210,12 +412,15 @@ class WaveNet(nn.Module):
             t = self.diffusion_embedding(t)
             t = self.mlp(t)
 
-        skip = []
-        for layer in self.residual_layers:
-            x, skip_connection = layer(x, condition, t)
-            skip.append(skip_connection)
+        if condition is not None and self.condition_projection is not None:
+            condition = self.condition_projection(condition)
+
+        skip = None
+        for i, layer in enumerate(self.residual_layers):
+            x, skip_connection = layer(x, self.get_layer_condition(condition, i), t)
+            skip = skip_connection if skip is None else skip + skip_connection
 
-        x = torch.sum(torch.stack(skip), dim=0) / math.sqrt(len(self.residual_layers))
+        x = skip / math.sqrt(len(self.residual_layers))
         x = self.skip_projection(x)
 
         if self.output_projection is not None:
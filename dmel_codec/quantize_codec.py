@@ -0,0 +1,103 @@
+import json
+import math
+from time import perf_counter
+
+import hydra
+import numpy as np
+import torch
+import torch.nn.functional as F
+from lhotse import CutSet
+from omegaconf import DictConfig
+import dmel_codec
+from dmel_codec.dataset.lhotse_tts_dataset import LhotseTTSDataset
+from dmel_codec.evaluation.evaluation_utils import calculate_pesq
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+
+dmel_root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+@torch.inference_mode()
+def decode_cuts(codec_model, items):
+    """
+        decode the indices of every item with its noise, return: (audios, decode seconds)
+    """
+    audios = []
+    decode_time = 0
+    for item in items:
+        start_time = perf_counter()
+        audio, _ = codec_model.decode(
+            item["indices"], item["indices_lengths"], return_audios=True, noise=item["noise"]
+        )
+        decode_time += perf_counter() - start_time
+        audios.append(audio)
+    return audios, decode_time
+
+
+def mel_l1(codec_model, rec_audio, gt_audio):
+    return F.l1_loss(codec_model.gt_mel_transform(rec_audio), codec_model.gt_mel_transform(gt_audio)).item()
+
+
+@hydra.main(config_path=f"{dmel_root_path}/config/lm", config_name="quantize_codec.yaml", version_base=None)
+def main(config: DictConfig) -> None:
+    print_config_tree(config)
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    logger.info(f"Instantiating codec model <{config.model.codec_model._target_}>.")
+    codec_model = hydra.utils.instantiate(config.model.codec_model, _convert_="partial")
+    codec_model.load_state_dict(
+        torch.load(config.codec_ckpt_path, map_location="cpu")["state_dict"], strict=False
+    )
+    codec_model = codec_model.float().cpu().eval()
+    if config.optimize_for_inference:
+        codec_model.optimize_for_inference()
+
+    # the indices and the decoder noise are shared by the float32 and int8 decode
+    dataset = LhotseTTSDataset()
+    generator = torch.Generator().manual_seed(config.seed)
+    factor = math.prod(codec_model.quantizer.downsample_factor)
+    samples_per_frame = factor * codec_model.gt_mel_transform.hop_length
+    items = []
+    with torch.inference_mode():
+        for cut in CutSet.from_jsonl_lazy(config.cuts_path).subset(first=config.num_cuts):
+            audio = dataset[CutSet.from_cuts([cut])]["audios"][0][None, None, :]
+            indices, indices_lengths = codec_model.encode(audio, torch.tensor([audio.shape[-1]]))
+            audio = audio[:, :, : indices.shape[-1] * samples_per_frame] # the decoded length
+            noise = torch.randn(1, codec_model.decoder.input_channels, indices.shape[-1] * factor, generator=generator)
+            items.append({"audio": audio, "indices": indices, "indices_lengths": indices_lengths, "noise": noise})
+    if len(items) == 0:
+        raise ValueError(f"No cuts found in {config.cuts_path}")
+    audio_seconds = sum(item["audio"].shape[-1] for item in items) / codec_model.sampling_rate
+
+    float_audios, float_time = decode_cuts(codec_model, items)
+    # dynamic int8, nothing is calibrated on the cuts, they are only decoded for the report
+    codec_model.quantize_decode_int8(min_channels=config.min_channels)
+    int8_audios, int8_time = decode_cuts(codec_model, items)
+
+    gt_audios = [item["audio"] for item in items]
+    report = {
+        "num_cuts": len(items),
+        "audio_seconds": audio_seconds,
+        "float32_rtf": float_time / audio_seconds,
+        "int8_rtf": int8_time / audio_seconds,
+        "speedup": float_time / int8_time,
+        "float32_mel_l1": np.mean([mel_l1(codec_model, r, g) for r, g in zip(float_audios, gt_audios)]).item(),
+        "int8_mel_l1": np.mean([mel_l1(codec_model, r, g) for r, g in zip(int8_audios, gt_audios)]).item(),
+        "int8_float32_mel_l1": np.mean([mel_l1(codec_model, r, g) for r, g in zip(int8_audios, float_audios)]).item(),
+        "float32_pesq": np.mean(
+            [float(calculate_pesq(r[0], g[0], codec_model.sampling_rate)) for r, g in zip(float_audios, gt_audios)]
+        ).item(),
+        "int8_pesq": np.mean(
+            [float(calculate_pesq(r[0], g[0], codec_model.sampling_rate)) for r, g in zip(int8_audios, gt_audios)]
+        ).item(),
+    }
+    logger.info(f"Dynamic int8 decode report: {json.dumps(report, indent=2)}")
+    if config.report_path is not None:
+        with open(config.report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
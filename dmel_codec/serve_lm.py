@@ -0,0 +1,30 @@
+import asyncio
+import hydra
+import dmel_codec
+from omegaconf import DictConfig
+from dmel_codec.utils.logger import RankedLogger
+from dmel_codec.utils.print_config import print_config_tree
+from dmel_codec.models.lm_lit_modules import MusicLLM
+from dmel_codec.serving.lm_server import ContinuousBatchingScheduler, LMServer
+root_path = dmel_codec.__path__[0]
+logger = RankedLogger(__name__, rank_zero_only=True)
+
+@hydra.main(config_path=f"{root_path}/config/lm", config_name="lm_server.yaml")
+def main(config: DictConfig):
+    print_config_tree(config)
+    device = config.device
+    logger.info(f"Using device: {device}")
+
+    # the model is loaded once and shared by all requests
+    model: MusicLLM = hydra.utils.instantiate(config.model)
+    model = model.to(device)
+    model.eval()
+    if config.get("optimize_for_inference", False):
+        model.optimize_for_inference()
+
+    scheduler = ContinuousBatchingScheduler(model, config, max_batch_size=config.max_batch_size)
+    server = LMServer(scheduler, sample_rate=config.sample_rate)
+    asyncio.run(server.serve(host=config.host, port=config.port, unix_socket=config.unix_socket))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import math
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from time import perf_counter
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from dmel_codec.models.codec_lit_modules import VQGAN
+from dmel_codec.serving.decode_cache import DecodedAudioCache
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+@dataclass
+class CodecRequest:
+    kind: str # encode or decode
+    data: torch.Tensor # encode: waveform [T_wav], decode: indices [codebook_num, T]
+    frames: int # length in indices frames, used for bucketing and the batch budget
+    future: asyncio.Future
+    arrival_time: float = field(default_factory=perf_counter)
+
+
+class CodecService:
+    """
+        micro-batching front end of VQGAN.encode / VQGAN.decode for many small concurrent callers
+        requests are grouped by (kind, length bucket), a bucket runs as one batch when its padded frames reach
+        max_batch_frames or when its oldest request waited max_wait_time seconds
+        encode buckets are right padded, the encoder masks the padding with sequence_mask and the indices are
+        cropped back per request, decode buckets hold requests of one exact length: the decoder and the vocoder
+        are not causal, so right padding would leak into the tail of the shorter requests of a batch
+    """
+    def __init__(
+        self,
+        codec_model: VQGAN,
+        max_batch_frames: int = 4096,
+        max_wait_time: float = 0.005,
+        bucket_frames: int = 64,
+        decode_cache: DecodedAudioCache | None = None,
+    ):
+        """
+            max_batch_frames: max padded indices frames of one batch, batch_size * longest request
+            max_wait_time: seconds a request waits for other requests of its bucket
+            bucket_frames: width of an encode length bucket in indices frames
+            decode_cache: None or a DecodedAudioCache in front of decode, needs codec_model.fixed_decode_noise
+        """
+        if decode_cache is not None and not codec_model.fixed_decode_noise:
+            raise ValueError("decode_cache needs a deterministic decode, set fixed_decode_noise of the codec model")
+        self.codec_model = codec_model
+        self.decode_cache = decode_cache
+        self.inflight_decodes = {} # cache key -> task, identical concurrent requests are decoded once
+        self.max_batch_frames = max_batch_frames
+        self.max_wait_time = max_wait_time
+        self.bucket_frames = bucket_frames
+        self.samples_per_frame = (
+            math.prod(codec_model.quantizer.downsample_factor) * codec_model.encode_mel_transform.hop_length
+        )
+        self.buckets = defaultdict(list)
+        self.wakeup = None
+        self.scheduler_task = None
+        self.num_batches = 0
+        self.num_requests = 0
+        self.real_frames = 0
+        self.padded_frames = 0
+
+    async def encode(self, audio: torch.Tensor) -> torch.Tensor:
+        """
+            audio: [T_wav] or [1, T_wav] or [1, 1, T_wav]
+            return: indices [codebook_num, T]
+        """
+        audio = audio.reshape(-1)
+        return await self.submit("encode", audio, audio.shape[0] // self.samples_per_frame)
+
+    async def decode(self, indices: torch.Tensor) -> torch.Tensor:
+        """
+            indices: [codebook_num, T]
+            return: waveform [1, T * samples_per_frame]
+        """
+        if self.decode_cache is None:
+            return await self.submit("decode", indices, indices.shape[-1])
+
+        key = self.decode_cache.key(indices)
+        audio = self.decode_cache.get(key)
+        if audio is not None:
+            return audio
+        if key not in self.inflight_decodes:
+            self.inflight_decodes[key] = asyncio.create_task(self.decode_and_cache(key, indices))
+        return await asyncio.shield(self.inflight_decodes[key])
+
+    async def decode_and_cache(self, key, indices):
+        try:
+            audio = await self.submit("decode", indices, indices.shape[-1])
+            self.decode_cache.put(key, audio)
+            return audio
+        finally:
+            del self.inflight_decodes[key]
+
+    async def submit(self, kind, data, frames):
+        if self.scheduler_task is None:
+            self.start()
+        request = CodecRequest(kind=kind, data=data, frames=frames, future=asyncio.get_running_loop().create_future())
+        self.buckets[self.bucket_key(kind, frames)].append(request)
+        self.wakeup.set()
+        return await request.future
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.scheduler_task = asyncio.create_task(self.run_scheduler())
+
+    async def stop(self):
+        if self.scheduler_task is not None:
+            self.scheduler_task.cancel()
+            self.scheduler_task = None
+
+    def bucket_key(self, kind, frames):
+        if kind == "decode":
+            # no padding, the audio of a request must not depend on the other requests of its batch
+            return (kind, frames)
+        return (kind, frames // self.bucket_frames)
+
+    def bucket_is_full(self, requests):
+        return len(requests) * max(request.frames for request in requests) >= self.max_batch_frames
+
+    def next_batch(self, now):
+        """
+            return: (key, requests) of the bucket to run now, or (None, deadline) of the oldest waiting bucket
+        """
+        deadline = None
+        for key, requests in self.buckets.items():
+            if self.bucket_is_full(requests) or now - requests[0].arrival_time >= self.max_wait_time:
+                return key, self.take_batch(key)
+            bucket_deadline = requests[0].arrival_time + self.max_wait_time
+            deadline = bucket_deadline if deadline is None else min(deadline, bucket_deadline)
+        return None, deadline
+
+    def take_batch(self, key):
+        requests = self.buckets[key]
+        batch = []
+        while requests:
+            frames = max([request.frames for request in batch + requests[:1]])
+            if batch and (len(batch) + 1) * frames > self.max_batch_frames:
+                break
+            batch.append(requests.pop(0))
+        if not requests:
+            del self.buckets[key]
+        return batch
+
+    async def run_scheduler(self):
+        while True:
+            if not self.buckets:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            key, batch = self.next_batch(perf_counter())
+            if key is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(batch - perf_counter(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                # the codec runs in a worker thread, the event loop keeps collecting requests
+                outputs = await asyncio.to_thread(self.run_batch, key[0], batch)
+            except Exception as e:
+                log.error(f"Codec {key[0]} batch failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
+
+    @torch.inference_mode()
+    def run_batch(self, kind, requests):
+        device = self.codec_model.device
+        self.num_batches += 1
+        self.num_requests += len(requests)
+        self.real_frames += sum(request.frames for request in requests)
+        self.padded_frames += len(requests) * max(request.frames for request in requests)
+
+        if kind == "encode":
+            audios = pad_sequence([request.data for request in requests], batch_first=True).to(device)
+            audio_lengths = torch.tensor([request.data.shape[0] for request in requests], device=device)
+            indices, indices_lengths = self.codec_model.encode(audios.unsqueeze(1), audio_lengths)
+            indices_lengths = indices_lengths.view(-1).tolist()
+            return [indices[i, :, :indices_lengths[i]].cpu() for i in range(len(requests))]
+
+        # the requests of a decode bucket have the same length, see bucket_key
+        indices = torch.stack([request.data for request in requests]).to(device)
+        feature_lengths = torch.tensor([request.frames for request in requests], device=device)
+        wav, _ = self.codec_model.decode(indices, feature_lengths, return_audios=True)
+        return [
+            wav[i, :, :request.frames * self.samples_per_frame].float().cpu() for i, request in enumerate(requests)
+        ]
+
+    def metrics(self):
+        metrics = {
+            "batches": self.num_batches,
+            "requests": self.num_requests,
+            "mean_batch_size": self.num_requests / max(self.num_batches, 1),
+            "padding_ratio": 1 - self.real_frames / max(self.padded_frames, 1),
+        }
+        if self.decode_cache is not None:
+            metrics["decode_cache"] = self.decode_cache.metrics()
+        return metrics
+
+
+class InProcessCodecClient:
+    """
+        blocking client of a CodecService running on a background event loop thread,
+        encode / decode can be called from many threads and are batched together
+    """
+    def __init__(self, codec_model: VQGAN, **service_kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.service = CodecService(codec_model, **service_kwargs)
+
+    def encode(self, audio: torch.Tensor) -> torch.Tensor:
+        return asyncio.run_coroutine_threadsafe(self.service.encode(audio), self.loop).result()
+
+    def decode(self, indices: torch.Tensor) -> torch.Tensor:
+        return asyncio.run_coroutine_threadsafe(self.service.decode(indices), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.service.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
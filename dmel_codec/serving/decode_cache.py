@@ -0,0 +1,163 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+class DecodedAudioCache:
+    """
+        content addressed LRU cache of decoded waveforms, keyed by a hash of the codec indices and the model version
+        the memory tier keeps float32 cpu tensors within max_bytes, the least recently used entries are evicted to
+        the optional disk tier, raw float32 pcm files read back whole with np.fromfile on a hit and moved to the
+        memory tier, and dropped from it past max_disk_bytes
+        the codec must decode deterministically, see VQGAN.fixed_decode_noise
+        the returned tensors are shared with the cache and must not be modified in place
+    """
+    def __init__(
+        self,
+        max_bytes: int = 512 * 1024 ** 2,
+        disk_dir: str | None = None,
+        max_disk_bytes: int = 8 * 1024 ** 3,
+        model_version: str = "",
+    ):
+        """
+            max_bytes: byte budget of the memory tier
+            disk_dir: None or the directory of the disk tier, entries of a previous run are reused
+            max_disk_bytes: byte budget of the disk tier
+            model_version: part of every key, e.g. the codec checkpoint path and decode noise seed,
+                           required with disk_dir, so a new checkpoint never reads the audio of an old one
+        """
+        if disk_dir is not None and not model_version:
+            raise ValueError("model_version is required with disk_dir, the disk tier outlives the process")
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.model_version = model_version
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict() # key -> [1, T_wav]
+        self.memory_bytes = 0
+        self.disk = OrderedDict() # key -> bytes
+        self.disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.load_disk_index()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def key(self, indices: torch.Tensor) -> str:
+        """
+            indices: [codebook_num, T] or [1, codebook_num, T], the hash does not depend on the dtype or device
+        """
+        indices = indices.reshape(-1, indices.shape[-1]).to("cpu", torch.int64).contiguous()
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.model_version.encode())
+        digest.update(str(tuple(indices.shape)).encode())
+        digest.update(indices.numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        """
+            return: [1, T_wav] or None
+        """
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return audio
+
+            if key in self.disk:
+                audio = torch.from_numpy(np.fromfile(self.disk_path(key), dtype=np.float32))[None]
+                self.disk.move_to_end(key)
+                self.disk_hits += 1
+                self.put_memory(key, audio)
+                return audio
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, audio: torch.Tensor):
+        """
+            audio: [T_wav] or [1, T_wav] or [1, 1, T_wav]
+        """
+        audio = audio.detach().reshape(1, -1).to("cpu", torch.float32).contiguous()
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.put_memory(key, audio)
+
+    def put_memory(self, key, audio):
+        self.memory[key] = audio
+        self.memory_bytes += audio.numel() * audio.element_size()
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 0:
+            evicted_key, evicted_audio = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_audio.numel() * evicted_audio.element_size()
+            self.evictions += 1
+            if self.disk_dir is not None:
+                self.put_disk(evicted_key, evicted_audio)
+
+    def put_disk(self, key, audio):
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return
+        num_bytes = audio.numel() * audio.element_size()
+        if num_bytes > self.max_disk_bytes:
+            return
+        # write then rename, a reader never sees a partial file
+        path = self.disk_path(key)
+        audio.numpy().tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.disk[key] = num_bytes
+        self.disk_bytes += num_bytes
+        while self.disk_bytes > self.max_disk_bytes:
+            evicted_key, evicted_bytes = self.disk.popitem(last=False)
+            os.remove(self.disk_path(evicted_key))
+            self.disk_bytes -= evicted_bytes
+            self.disk_evictions += 1
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pcm")
+
+    def load_disk_index(self):
+        # least recently written first
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith(".pcm"):
+                entries.append((os.path.getmtime(path), name[: -len(".pcm")], os.path.getsize(path)))
+            elif name.endswith(".tmp"):
+                os.remove(path)
+        for _, key, num_bytes in sorted(entries):
+            self.disk[key] = num_bytes
+            self.disk_bytes += num_bytes
+        if len(entries) > 0:
+            log.info(f"Found {len(entries)} decoded audios ({self.disk_bytes} bytes) in {self.disk_dir}")
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / max(lookups, 1),
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "entries": len(self.memory),
+                "bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
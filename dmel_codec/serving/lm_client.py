@@ -0,0 +1,40 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+
+from dmel_codec.serving.lm_server import send_request
+
+
+async def main(args):
+    async def generate(i, prompt):
+        status, response = await send_request(
+            "POST", "/generate", {"prompt": prompt},
+            host=args.host, port=args.port, unix_socket=args.unix_socket,
+        )
+        if status != 200:
+            print(f"[{i}] failed: {response['error']}")
+            return
+        with open(os.path.join(args.output_dir, f"{i}.wav"), "wb") as f:
+            f.write(base64.b64decode(response["audio"]))
+        print(
+            f"[{i}] frames {response['generated_frames']}, queue {response['queue_latency']:.3f}s, "
+            f"generation {response['generation_latency']:.3f}s, total {response['total_latency']:.3f}s"
+        )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    # all prompts are sent at once to exercise the continuous batching
+    await asyncio.gather(*[generate(i, prompt) for i, prompt in enumerate(args.prompts)])
+    _, metrics = await send_request("GET", "/metrics", host=args.host, port=args.port, unix_socket=args.unix_socket)
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local test client of the lm server")
+    parser.add_argument("prompts", nargs="+")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", default=None)
+    parser.add_argument("--output_dir", default="lm_server_outputs")
+    asyncio.run(main(parser.parse_args()))
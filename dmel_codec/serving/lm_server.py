@@ -0,0 +1,442 @@
+import asyncio
+import base64
+import io
+import json
+import wave
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import count
+from time import perf_counter
+
+import numpy as np
+import torch
+from transformers.cache_utils import DynamicCache
+
+from dmel_codec.models.lm_lit_modules import MusicLLM
+from dmel_codec.utils.logger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+@dataclass
+class GenerationRequest:
+    request_id: int
+    prompt: str
+    arrival_time: float = field(default_factory=perf_counter)
+    admit_time: float | None = None
+    finish_time: float | None = None
+    generated_frames: int = 0
+
+    def latency(self):
+        return {
+            "queue_latency": self.admit_time - self.arrival_time,
+            "generation_latency": self.finish_time - self.admit_time,
+            "total_latency": self.finish_time - self.arrival_time,
+            "generated_frames": self.generated_frames,
+        }
+
+
+@dataclass
+class RunningSequence:
+    request: GenerationRequest
+    prompt_length: int # without left padding
+    audio_frames: list # audio ids from the forced silence frame, every item shape = (Codebook_num)
+    finished: bool = False
+
+
+def left_pad(tensor, length, dim, value=0):
+    pad_length = length - tensor.shape[dim]
+    if pad_length <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = pad_length
+    return torch.cat([tensor.new_full(pad_shape, value), tensor], dim=dim)
+
+
+def merge_left_padded_caches(cache_a, attention_mask_a, cache_b, attention_mask_b):
+    """
+        concat two left padded slow lm caches in the batch dimension, the shorter one is left padded
+        cache: DynamicCache, every layer shape = (bs, kv_heads, T, head_dim)
+        attention_mask: [bs, T]
+    """
+    length = max(attention_mask_a.shape[1], attention_mask_b.shape[1])
+    cache = DynamicCache()
+    for key_a, value_a, key_b, value_b in zip(
+        cache_a.key_cache, cache_a.value_cache, cache_b.key_cache, cache_b.value_cache
+    ):
+        cache.key_cache.append(torch.cat([left_pad(key_a, length, 2), left_pad(key_b, length, 2)], dim=0))
+        cache.value_cache.append(torch.cat([left_pad(value_a, length, 2), left_pad(value_b, length, 2)], dim=0))
+    cache._seen_tokens = length
+    attention_mask = torch.cat(
+        [left_pad(attention_mask_a, length, 1), left_pad(attention_mask_b, length, 1)], dim=0
+    )
+    return cache, attention_mask
+
+
+def wav_to_bytes(wav, sample_rate):
+    """
+        wav: [1, T] float waveform
+        return: 16 bit pcm wav file bytes
+    """
+    pcm = (wav.squeeze(0).clamp(-1, 1).numpy() * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+class ServerMetrics:
+    def __init__(self, max_history: int = 1000):
+        self.completed_requests = 0
+        self.failed_requests = 0
+        self.generated_frames = 0
+        self.steps = 0
+        self.history = deque(maxlen=max_history)
+
+    def record(self, request: GenerationRequest):
+        self.completed_requests += 1
+        self.generated_frames += request.generated_frames
+        self.history.append(request.latency())
+
+    def summary(self, waiting: int = 0, running: int = 0):
+        summary = {
+            "completed_requests": self.completed_requests,
+            "failed_requests": self.failed_requests,
+            "generated_frames": self.generated_frames,
+            "steps": self.steps,
+            "waiting_requests": waiting,
+            "running_requests": running,
+        }
+        for key in ["queue_latency", "generation_latency", "total_latency"]:
+            values = np.array([latency[key] for latency in self.history])
+            if len(values) == 0:
+                continue
+            summary[key] = {
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+            }
+        return summary
+
+
+class ContinuousBatchingScheduler:
+    """
+        iteration level scheduler for MusicLLM text prompt generation
+        every step admits waiting requests into the running batch, decodes one frame for all running
+        sequences and evicts the finished ones, the running batch is kept left padded
+
+        batch state between two steps, the last sampled frame is not in the slow lm kv cache yet:
+            slow_past_key_values: DynamicCache, every layer shape = (bs, kv_heads, T, head_dim)
+            attention_mask: [bs, T]
+            position_ids: [bs, 1], position of the last sampled frame
+            input_embeds: [bs, 1, H], embedding of the last sampled frame
+            previous_tokens: [bs, windows_length, Codebook_num], windows for the repetition penalty
+    """
+    def __init__(self, model: MusicLLM, inference_config, max_batch_size: int = 8):
+        self.model = model
+        self.inference_config = inference_config
+        self.max_batch_size = max_batch_size
+        self.max_total_length = min(model.max_length, inference_config.max_new_tokens)
+        self.waiting = deque()
+        self.running: list[RunningSequence] = []
+        self.metrics = ServerMetrics()
+        self.request_id_counter = count()
+        self.reset_batch_state()
+
+    def reset_batch_state(self):
+        self.running = []
+        self.admitting = []
+        self.slow_past_key_values = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.input_embeds = None
+        self.previous_tokens = None
+
+    def add_request(self, prompt: str) -> GenerationRequest:
+        request = GenerationRequest(request_id=next(self.request_id_counter), prompt=prompt)
+        self.waiting.append(request)
+        return request
+
+    def has_work(self):
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def abort_all(self):
+        """
+            drop the waiting and running requests, used when a step raises
+        """
+        requests = [sequence.request for sequence in self.running] + self.admitting + list(self.waiting)
+        self.waiting.clear()
+        self.reset_batch_state()
+        self.metrics.failed_requests += len(requests)
+        return requests
+
+    @torch.inference_mode()
+    def step(self):
+        """
+            return: list of (request, waveform) of the finished requests, waveform shape = (1, T_wav)
+        """
+        if len(self.running) > 0:
+            self.decode_one_frame()
+        # the new sequences sample their first frame in prefilling, so they join after the running ones stepped
+        self.admit()
+        return self.evict()
+
+    def decode_one_frame(self):
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((self.attention_mask.shape[0], 1))], dim=1
+        )
+        next_token, self.slow_past_key_values = self.model.predict_one_token_batch(
+            input_embeds=self.input_embeds,
+            slow_past_key_values=self.slow_past_key_values,
+            attention_mask=attention_mask,
+            position_ids=self.position_ids,
+            inference_config=self.inference_config,
+            previous_token=self.previous_tokens,
+        ) # (bs, Codebook_num + 1)
+        self.metrics.steps += 1
+        self.attention_mask = attention_mask
+        self.position_ids, self.input_embeds, self.previous_tokens = self.sampled_state(
+            next_token, self.position_ids + 1, self.previous_tokens
+        )
+        self.append_frames(self.running, next_token)
+
+    def sampled_state(self, next_token, position_ids, previous_tokens):
+        """
+            next_token: [bs, Codebook_num + 1]
+            return: position_ids, input_embeds and previous_tokens for the next step
+        """
+        input_embeds = self.model.get_embeds_from_inputs_ids(
+            next_token[:, None, 0], next_token[:, None, 1:]
+        ) # (bs, 1, H)
+        previous_tokens = torch.cat([previous_tokens[:, 1:], next_token[:, None, 1:]], dim=1)
+        return position_ids, input_embeds, previous_tokens
+
+    def append_frames(self, sequences, next_token):
+        text_tokens = next_token[:, 0].tolist()
+        for i, sequence in enumerate(sequences):
+            sequence.audio_frames.append(next_token[i, 1:])
+            sequence.finished = (
+                text_tokens[i] == self.model.slow_lm_config.end_of_music_id
+                or sequence.prompt_length + len(sequence.audio_frames) - 1 >= self.max_total_length
+            )
+
+    def admit(self):
+        admit_num = min(self.max_batch_size - len(self.running), len(self.waiting))
+        if admit_num <= 0:
+            return
+        requests = [self.waiting.popleft() for _ in range(admit_num)]
+        self.admitting = requests
+        admit_time = perf_counter()
+        for request in requests:
+            request.admit_time = admit_time
+
+        # prefill the new requests as one left padded batch
+        text_ids_list = [
+            self.model.process_inputs_cls.text_tokenizer(request.prompt, return_tensors="pt")["input_ids"].view(-1).to(self.model.device)
+            for request in requests
+        ]
+        input_ids, attention_mask = self.model.process_inputs_cls.process_2d_logits_infer_batch(
+            device=self.model.device, text_ids_list=text_ids_list
+        ) # (bs, S, Codebook_num + 1), (bs, S)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        previous_tokens = left_pad(
+            input_ids[:, -self.inference_config.windows_length:, 1:],
+            self.inference_config.windows_length,
+            1,
+            self.model.slow_lm_config.slow_audio_modality_mambaout_token_id,
+        )
+        next_token, slow_past_key_values = self.model.predict_one_token_batch(
+            input_embeds=self.model.get_embeds_from_inputs_ids(input_ids[:, :, 0], input_ids[:, :, 1:]),
+            slow_past_key_values=DynamicCache(), # a Cache object is returned as is, None returns the legacy tuples
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            inference_config=self.inference_config,
+            previous_token=None, # no repetition penalty in prefilling, same as inference_by_text_prompt
+        )
+        self.metrics.steps += 1
+
+        # the forced audio silence frame is the first frame of the generated audio
+        sequences = [
+            RunningSequence(request=request, prompt_length=prompt_length, audio_frames=[input_ids[i, -1, 1:]])
+            for i, (request, prompt_length) in enumerate(zip(requests, attention_mask.sum(dim=-1).tolist()))
+        ]
+        self.append_frames(sequences, next_token)
+        new_state = self.sampled_state(next_token, position_ids[:, -1:] + 1, previous_tokens)
+
+        if len(self.running) == 0:
+            self.slow_past_key_values, self.attention_mask = slow_past_key_values, attention_mask
+            self.position_ids, self.input_embeds, self.previous_tokens = new_state
+        else:
+            self.slow_past_key_values, self.attention_mask = merge_left_padded_caches(
+                self.slow_past_key_values, self.attention_mask, slow_past_key_values, attention_mask
+            )
+            self.position_ids, self.input_embeds, self.previous_tokens = [
+                torch.cat([old, new], dim=0)
+                for old, new in zip([self.position_ids, self.input_embeds, self.previous_tokens], new_state)
+            ]
+        self.running.extend(sequences)
+        self.admitting = []
+        log.info(f"Admit {len(requests)} requests, running {len(self.running)}, waiting {len(self.waiting)}")
+
+    def evict(self):
+        finished = [sequence for sequence in self.running if sequence.finished]
+        if len(finished) == 0:
+            return []
+
+        keep = [i for i, sequence in enumerate(self.running) if not sequence.finished]
+        if len(keep) == 0:
+            self.reset_batch_state()
+        else:
+            keep_indices = torch.tensor(keep, device=self.attention_mask.device)
+            self.slow_past_key_values.batch_select_indices(keep_indices)
+            self.attention_mask = self.attention_mask[keep_indices]
+            self.position_ids = self.position_ids[keep_indices]
+            self.input_embeds = self.input_embeds[keep_indices]
+            self.previous_tokens = self.previous_tokens[keep_indices]
+            self.running = [self.running[i] for i in keep]
+
+            # drop the left padding columns that no running sequence needs anymore
+            first_column = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0])
+            if first_column > 0:
+                self.attention_mask = self.attention_mask[:, first_column:]
+                self.slow_past_key_values.key_cache = [key[:, :, first_column:] for key in self.slow_past_key_values.key_cache]
+                self.slow_past_key_values.value_cache = [value[:, :, first_column:] for value in self.slow_past_key_values.value_cache]
+                self.slow_past_key_values._seen_tokens = self.attention_mask.shape[1]
+
+        # the <EOM> frame or the frame over the length limit is dropped, same as inference_by_text_prompt
+        wavs = self.model.decode_generation_audio_ids(
+            [torch.stack(sequence.audio_frames[:-1]) for sequence in finished]
+        )
+        finish_time = perf_counter()
+        outputs = []
+        for sequence, wav in zip(finished, wavs):
+            sequence.request.finish_time = finish_time
+            sequence.request.generated_frames = len(sequence.audio_frames) - 1
+            self.metrics.record(sequence.request)
+            outputs.append((sequence.request, wav))
+        return outputs
+
+
+class LMServer:
+    """
+        asyncio http front end of ContinuousBatchingScheduler
+        POST /generate {"prompt": str} -> {"request_id", "sample_rate", "audio": base64 wav, latency metrics}
+        GET /metrics -> scheduler metrics
+    """
+    def __init__(self, scheduler: ContinuousBatchingScheduler, sample_rate: int = 24000):
+        self.scheduler = scheduler
+        self.sample_rate = sample_rate
+        self.futures = {}
+        self.wakeup = asyncio.Event()
+
+    async def generate(self, prompt: str):
+        request = self.scheduler.add_request(prompt)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request.request_id] = future
+        self.wakeup.set()
+        wav = await future
+        return request, wav
+
+    async def run_scheduler(self):
+        while True:
+            if not self.scheduler.has_work():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                # model steps run in a worker thread, the event loop keeps accepting requests
+                finished = await asyncio.to_thread(self.scheduler.step)
+            except Exception as e:
+                log.error(f"Scheduler step failed: {e}")
+                for request in self.scheduler.abort_all():
+                    self.futures.pop(request.request_id).set_exception(e)
+                continue
+            for request, wav in finished:
+                self.futures.pop(request.request_id).set_result(wav)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode().split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "POST" and path == "/generate":
+                request, wav = await self.generate(json.loads(body)["prompt"])
+                status, payload = 200, {
+                    "request_id": request.request_id,
+                    "sample_rate": self.sample_rate,
+                    "audio": base64.b64encode(wav_to_bytes(wav, self.sample_rate)).decode(),
+                    **request.latency(),
+                }
+            elif method == "GET" and path == "/metrics":
+                status, payload = 200, self.scheduler.metrics.summary(
+                    waiting=len(self.scheduler.waiting), running=len(self.scheduler.running)
+                )
+            else:
+                status, payload = 404, {"error": f"unknown route {method} {path}"}
+        except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, unix_socket: str | None = None):
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            log.info(f"Serving on unix socket {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            log.info(f"Serving on http://{host}:{port}")
+        scheduler_task = asyncio.create_task(self.run_scheduler())
+        async with server:
+            await server.serve_forever()
+        scheduler_task.cancel()
+
+
+async def send_request(method, path, payload=None, host="127.0.0.1", port=8000, unix_socket=None):
+    """
+        minimal http client for LMServer
+        return: status code, json response
+    """
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+    status = int((await reader.readline()).decode().split(" ")[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode().split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    response = json.loads(await reader.readexactly(int(headers["content-length"])))
+    writer.close()
+    return status, response
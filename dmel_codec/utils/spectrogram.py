@@ -38,7 +38,11 @@ class LinearSpectrogram(nn.Module):
     def dynamic_range_compression_torch(self, x: Tensor, C=1, clip_val=1e-5) -> Tensor:
         return torch.log(torch.clamp(x, min=clip_val) * C)
 
-    def forward(self, y: Tensor) -> Tensor:
+    def forward(self, y: Tensor, pad_input: bool = True) -> Tensor:
+        """
+            pad_input: reflect pad (n_fft - hop_length) // 2 on both sides, False when the caller already
+                       provides the context samples, e.g. a chunk of a longer waveform
+        """
         device = y.device
         key = f"{self.n_fft}_{self.num_mels}_{self.sample_rate}_{self.hop_length}_{self.win_length}_{self.f_min}_{self.f_max}_{device}"
         if key not in self.mel_basis_cache:
@@ -55,11 +59,14 @@ class LinearSpectrogram(nn.Module):
         mel_basis = self.mel_basis_cache[key]
         hann_window = self.hann_window_cache[key]
 
-        padding = (self.n_fft - self.hop_length) // 2
+        if pad_input:
+            padding = (self.n_fft - self.hop_length) // 2
 
-        y = torch.nn.functional.pad(
-            y.unsqueeze(1) if y.ndim == 2 else y, (padding, padding), mode=self.mode
-        ).squeeze(1)
+            y = torch.nn.functional.pad(
+                y.unsqueeze(1) if y.ndim == 2 else y, (padding, padding), mode=self.mode
+            ).squeeze(1)
+        elif y.ndim == 3:
+            y = y.squeeze(1)
 
         spec = torch.stft(
             y,
@@ -117,11 +124,11 @@ class LogMelSpectrogram(nn.Module):
         )
 
     def forward(
-        self, x: Tensor, return_linear: bool = False, sample_rate: int = None
+        self, x: Tensor, return_linear: bool = False, sample_rate: int = None, pad_input: bool = True
     ) -> Tensor:
         if sample_rate is not None and sample_rate != self.sample_rate:
             x = F.resample(x, orig_freq=sample_rate, new_freq=self.sample_rate)
 
-        x = self.spectrogram(x)
+        x = self.spectrogram(x, pad_input=pad_input)
 
         return x
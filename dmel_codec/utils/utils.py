@@ -79,58 +79,77 @@ def open_filelist(filelist_path, file_num=None):
     return audio_path_list
 
 
-def sample_one_token_from_logits(
-    logits: Optional[torch.Tensor] = None,
-    previous_token: Optional[
-        torch.Tensor
-    ] = None,  # for audio logits, text_previous_token is None
+def multinomial_sample_one_no_sync(probs_sort):
+    # argmax(p / q) with q ~ Exp(1) samples from p like torch.multinomial, without a device sync
+    q = torch.empty_like(probs_sort).exponential_(1)
+    return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.long)
+
+def sample_tokens_from_logits_batch(
+    logits: torch.Tensor,
+    previous_tokens: Optional[torch.Tensor] = None,
     temperature=0.7,
     top_k=50,
     top_p=0.7,
     repetition_penalty=1.2,
-):
-    probs = logits_to_probs(
+) -> torch.Tensor:
+    """
+        sample one token per codebook, the device side sampler used by the lm inference
+        logits: [bs, codebook_num, vocab_size]
+        previous_tokens: None or [bs, codebook_num, window], the history for the repetition penalty
+        return: [bs, codebook_num]
+    """
+    probs, candidate_indices = logits_to_probs_batch(
         logits,
-        previous_tokens=previous_token,
+        previous_tokens=previous_tokens,
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
         repetition_penalty=repetition_penalty,
     )
-    idx_next = multinomial_sample_one_no_sync(probs)
-    return idx_next, probs
+    idx_next = multinomial_sample_one_no_sync(probs) # (..., 1)
+    if candidate_indices is not None:
+        idx_next = torch.gather(candidate_indices, dim=-1, index=idx_next)
+    return idx_next.squeeze(-1)
 
 
-def logits_to_probs(
+def logits_to_probs_batch(
     logits: torch.Tensor,
     previous_tokens: Optional[torch.Tensor] = None,
     temperature: float = 1.0,
     top_k: int = 50,
     top_p: float = 1.0,
     repetition_penalty: float = 1.0,
-) -> torch.Tensor:
+):
+    """
+        order: repetition penalty, top-k, top-p on the untempered logits, temperature
+        when top_k > 0 only the k survivors of top-k are sorted for top-p, instead of the full vocabulary
+        logits: [..., vocab_size]
+        previous_tokens: None or [..., window]
+        return:
+            probs: [..., vocab_size] or [..., top_k] when top_k > 0
+            candidate_indices: None or [..., top_k], the vocabulary index of every probs column
+    """
     # Apply repetition penalty
-    if previous_tokens is not None:
+    if previous_tokens is not None and repetition_penalty != 1.0:
         previous_tokens = previous_tokens.long()
         score = torch.gather(logits, dim=-1, index=previous_tokens)
         score = torch.where(
             score < 0, score * repetition_penalty, score / repetition_penalty
         )
-        logits.scatter_(dim=-1, index=previous_tokens, src=score)
-
-    # Step 1: Apply top-k filtering
-    if top_k > 0:
-        top_k_logits, _ = torch.topk(logits, top_k, dim=-1)
-        min_top_k_logits = top_k_logits[..., -1, None]
-        logits = torch.where(
-            logits < min_top_k_logits,
-            torch.full_like(logits, -float("Inf")),
-            logits,
-        )
-
-    # Step 2: Apply top-p filtering
-    if top_p < 1.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        logits = logits.scatter(dim=-1, index=previous_tokens, src=score)
+
+    candidate_indices = None
+    if 0 < top_k < logits.shape[-1]:
+        # topk returns the survivors already sorted, top-p works on them directly
+        logits, candidate_indices = torch.topk(logits, top_k, dim=-1)
+        if top_p < 1.0:
+            cum_probs = torch.cumsum(torch.nn.functional.softmax(logits, dim=-1), dim=-1)
+            indices_to_remove = cum_probs > top_p
+            indices_to_remove[..., 0] = False  # keep at least one option
+            logits = logits.masked_fill(indices_to_remove, -float("Inf"))
+
+    elif top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
         cum_probs = torch.cumsum(
             torch.nn.functional.softmax(sorted_logits, dim=-1), dim=-1
         )
@@ -143,19 +162,4 @@ def logits_to_probs(
 
     logits = logits / max(temperature, 1e-5)
     probs = torch.nn.functional.softmax(logits, dim=-1)
-
-    # 确保传入的是一个概率分布
-    assert torch.all(probs >= 0), "Probabilities must be non-negative"
-
-    # # 确保概率分布的和为1
-    # assert torch.isclose(
-    #     probs.sum(), torch.tensor(1.0, device=probs.device, dtype=probs.dtype)
-    # ), "Probabilities must sum to 1"
-
-    return probs
-
-
-def multinomial_sample_one_no_sync(probs_sort):
-    # 使用 torch.multinomial 进行采样
-    idx_next = torch.multinomial(probs_sort, 1)
-    return idx_next.to(dtype=torch.long)
\ No newline at end of file
+    return probs, candidate_indices
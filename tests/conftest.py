@@ -0,0 +1,73 @@
+import pytest
+import torch
+from lightning_utilities.core.rank_zero import rank_zero_only
+
+from dmel_codec.models.codec_lit_modules import VQGAN
+from dmel_codec.models.modules.bigvgan.bigvgan import BigVGAN
+from dmel_codec.models.modules.bigvgan.env import AttrDict
+from dmel_codec.models.modules.dowmsample_fsq import DownsampleFiniteScalarQuantize
+from dmel_codec.models.modules.wavenet import WaveNet
+from dmel_codec.utils.spectrogram import LogMelSpectrogram
+
+# RankedLogger needs a rank outside of a lightning run
+rank_zero_only.rank = 0
+
+# small random weight models with the shapes of the dMel configs, 24kHz, hop 256, 1024 samples per indices frame
+VOCODER_CONFIG = dict(
+    resblock="1",
+    num_mels=100,
+    upsample_initial_channel=32,
+    upsample_rates=[4, 4, 4, 4],
+    upsample_kernel_sizes=[8, 8, 8, 8],
+    resblock_kernel_sizes=[3, 7, 11],
+    resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+    activation="snakebeta",
+    snake_logscale=True,
+    use_tanh_at_final=False,
+    use_bias_at_final=False,
+)
+
+
+def build_mel_transform():
+    return LogMelSpectrogram(
+        sample_rate=24000, n_fft=1024, hop_length=256, win_length=1024, n_mels=100, f_min=0, f_max=12000
+    )
+
+
+@pytest.fixture(scope="session")
+def vocoder_ckpt_path(tmp_path_factory):
+    torch.manual_seed(0)
+    path = tmp_path_factory.mktemp("vocoder") / "vocoder.pt"
+    torch.save({"generator": BigVGAN(h=AttrDict(dict(VOCODER_CONFIG))).state_dict()}, path)
+    return str(path)
+
+
+@pytest.fixture
+def build_codec(vocoder_ckpt_path):
+    def build(decoder_layers: int = 4, dtype: str = "float32", **codec_kwargs):
+        torch.manual_seed(0)
+        vocoder = BigVGAN(h=AttrDict(dict(VOCODER_CONFIG)), ckpt_path=vocoder_ckpt_path)
+        codec = VQGAN(
+            encoder=WaveNet(input_channels=10, residual_channels=70, residual_layers=4, dilation_cycle=4),
+            quantizer=DownsampleFiniteScalarQuantize(
+                input_dim=700, n_codebooks=1, n_groups=10, levels=[7, 5, 5], is_dmel=True, downsample_factor=[2, 2]
+            ),
+            vocoder=vocoder,
+            encode_mel_transform=build_mel_transform(),
+            gt_mel_transform=build_mel_transform(),
+            decoder=WaveNet(
+                input_channels=700,
+                output_channels=100,
+                residual_channels=700,
+                residual_layers=decoder_layers,
+                dilation_cycle=4,
+                condition_channels=700,
+            ),
+            dmel_groups=10,
+            quanlity_linear=700,
+            dtype=dtype,
+            **codec_kwargs,
+        )
+        return codec.eval()
+
+    return build
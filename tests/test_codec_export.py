@@ -0,0 +1,25 @@
+import torch
+
+from dmel_codec.models.codec_export import ExportedCodec, export_codec, verify_exported_codec
+
+
+def test_export_and_verify_restore_the_codec(build_codec, tmp_path):
+    codec = build_codec(fixed_decode_noise=True)
+    # a precision the export and the verification cast to float32 and have to restore
+    codec.to(torch.bfloat16).train()
+    codec.encode_dtype = torch.bfloat16
+    dtypes = {name: tensor.dtype for name, tensor in codec.state_dict().items()}
+
+    def assert_restored():
+        assert {name: tensor.dtype for name, tensor in codec.state_dict().items()} == dtypes
+        assert codec.encode_dtype == torch.bfloat16
+        assert codec.training
+
+    paths = export_codec(codec, str(tmp_path), "torchscript", example_frames=20)
+    assert_restored()
+
+    exported = ExportedCodec(paths["encode"], paths["decode"])
+    result = verify_exported_codec(codec, exported, num_frames=30)
+    assert result["encode_index_match"] == 1.0
+    assert result["decode_max_abs_diff"] < 1e-3
+    assert_restored()
@@ -0,0 +1,62 @@
+import pickle
+
+import pytest
+import torch
+
+from dmel_codec.dataset.codec_indices_store import CodecIndicesStore, CodecIndicesStoreWriter
+
+
+@pytest.mark.parametrize("dtype, max_value", [("uint8", 255), ("uint16", 65535)])
+def test_round_trip(tmp_path, dtype, max_value):
+    torch.manual_seed(0)
+    codebook_num = 10
+    written = {
+        f"cut-{i}": torch.randint(0, max_value + 1, (length, codebook_num))
+        for i, length in enumerate([17, 1, 0, 250, 33])
+    }
+    with CodecIndicesStoreWriter(str(tmp_path), codebook_num, dtype=dtype) as writer:
+        for cut_id, indices in written.items():
+            writer.write(cut_id, indices)
+
+    store = CodecIndicesStore(str(tmp_path))
+    assert store.dtype == dtype
+    assert len(store) == len(written)
+    assert store.num_frames == sum(len(indices) for indices in written.values())
+
+    offset = 0
+    for cut_id, indices in written.items():
+        assert cut_id in store
+        assert store.items[cut_id] == [offset, len(indices)]
+        offset += len(indices)
+        read = store[cut_id]
+        assert read.dtype == torch.long
+        assert torch.equal(read, indices)
+
+    # reopen, and reopen through pickle as a dataloader worker does
+    for reopened in [CodecIndicesStore(str(tmp_path)), pickle.loads(pickle.dumps(store))]:
+        assert reopened._indices is None
+        for cut_id, indices in written.items():
+            assert torch.equal(reopened[cut_id], indices)
+
+    with pytest.raises(KeyError):
+        store["missing"]
+
+
+@pytest.mark.parametrize("dtype, out_of_range", [("uint8", 256), ("uint8", -1), ("uint16", 65536)])
+def test_out_of_range_indices(tmp_path, dtype, out_of_range):
+    with CodecIndicesStoreWriter(str(tmp_path), 2, dtype=dtype) as writer:
+        writer.write("in-range", torch.zeros(3, 2, dtype=torch.long))
+        with pytest.raises(ValueError):
+            writer.write("out-of-range", torch.tensor([[0, out_of_range]]))
+        with pytest.raises(ValueError):
+            writer.write("in-range", torch.zeros(3, 2, dtype=torch.long))
+
+    # the rejected cut is not written, the store stays consistent
+    store = CodecIndicesStore(str(tmp_path))
+    assert "out-of-range" not in store
+    assert torch.equal(store["in-range"], torch.zeros(3, 2, dtype=torch.long))
+
+
+def test_unsupported_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        CodecIndicesStoreWriter(str(tmp_path), 2, dtype="int32")
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from dmel_codec.serving.codec_service import InProcessCodecClient
+
+
+def test_batched_requests_equal_unbatched(build_codec):
+    codec = build_codec(fixed_decode_noise=True)
+    generator = torch.Generator().manual_seed(0)
+    audio_lengths = [9000, 20000, 20480, 33333, 40960, 8192]
+    audios = [torch.randn(length, generator=generator) * 0.3 for length in audio_lengths]
+    # two lengths share a decode bucket, the others are alone in theirs
+    indices = [torch.randint(0, 175, (10, frames), generator=generator) for frames in [6, 9, 9, 14, 3, 14]]
+
+    client = InProcessCodecClient(codec, max_batch_frames=4096, max_wait_time=0.05)
+    try:
+        with ThreadPoolExecutor(len(audios)) as pool:
+            batched_indices = list(pool.map(client.encode, audios))
+            batched_audios = list(pool.map(client.decode, indices))
+        metrics = client.service.metrics()
+    finally:
+        client.close()
+    assert metrics["mean_batch_size"] > 1
+
+    with torch.inference_mode():
+        for audio, output in zip(audios, batched_indices):
+            reference, _ = codec.encode(audio[None, None], torch.tensor([audio.shape[0]]))
+            assert torch.equal(output, reference[0])
+        for request_indices, output in zip(indices, batched_audios):
+            frames = request_indices.shape[-1]
+            reference, _ = codec.decode(request_indices[None], torch.tensor([frames]), return_audios=True)
+            assert output.shape == (1, frames * 1024)
+            torch.testing.assert_close(output, reference[0], rtol=0, atol=1e-5)
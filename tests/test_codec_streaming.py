@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from dmel_codec.models.codec_streaming import StreamingCodecEncoder
+
+
+# (chunk_frames, push_size): small and large encoder chunks, pushes shorter than a hop, not aligned to a frame,
+# and longer than the whole waveform
+@pytest.mark.parametrize("chunk_frames, push_size", [(1, 100), (3, 1000), (7, 4097), (16, 20000), (50, 100000)])
+def test_streaming_encode_equals_encode(build_codec, chunk_frames, push_size):
+    codec = build_codec().eval()
+    audio = torch.randn(45678, generator=torch.Generator().manual_seed(0)) * 0.3
+    with torch.inference_mode():
+        reference, _ = codec.encode(audio[None, None], torch.tensor([audio.shape[0]]))
+
+    encoder = StreamingCodecEncoder(codec, chunk_frames=chunk_frames)
+    indices = [encoder.push(audio[start:start + push_size]) for start in range(0, audio.shape[0], push_size)]
+    indices.append(encoder.flush())
+    assert torch.equal(torch.cat(indices, dim=-1), reference)
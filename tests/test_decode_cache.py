@@ -0,0 +1,80 @@
+import os
+
+import pytest
+import torch
+
+from dmel_codec.serving.decode_cache import DecodedAudioCache
+
+AUDIO_BYTES = 1000 * 4 # one float32 audio of 1000 samples
+
+
+def make_entries(cache, num_entries):
+    generator = torch.Generator().manual_seed(0)
+    entries = []
+    for _ in range(num_entries):
+        indices = torch.randint(0, 175, (10, 8), generator=generator)
+        entries.append((cache.key(indices), torch.randn(1, 1000, generator=generator)))
+    return entries
+
+
+def test_memory_tier_evicts_to_disk(tmp_path):
+    cache = DecodedAudioCache(max_bytes=2 * AUDIO_BYTES, disk_dir=str(tmp_path), model_version="v1")
+    entries = make_entries(cache, 4)
+    for key, audio in entries:
+        cache.put(key, audio)
+
+    metrics = cache.metrics()
+    assert metrics["entries"] == 2 and metrics["disk_entries"] == 2 and metrics["evictions"] == 2
+    assert list(cache.disk) == [entries[0][0], entries[1][0]]
+    # the least recently used entries went to disk, every value reads back unchanged,
+    # a disk hit moves the entry back to memory, which evicts the other two to disk
+    for key, audio in entries:
+        assert torch.equal(cache.get(key), audio)
+    assert cache.metrics()["disk_hits"] == 4
+    assert cache.get(cache.key(torch.zeros(10, 8, dtype=torch.long))) is None
+
+
+def test_disk_tier_drops_entries_past_max_disk_bytes(tmp_path):
+    cache = DecodedAudioCache(
+        max_bytes=AUDIO_BYTES, disk_dir=str(tmp_path), max_disk_bytes=2 * AUDIO_BYTES, model_version="v1"
+    )
+    entries = make_entries(cache, 5)
+    for key, audio in entries:
+        cache.put(key, audio)
+
+    metrics = cache.metrics()
+    assert metrics["disk_entries"] == 2 and metrics["disk_bytes"] <= 2 * AUDIO_BYTES
+    assert metrics["disk_evictions"] == 2
+    assert len(os.listdir(tmp_path)) == 2
+    # the oldest entries are gone, the newest is in memory, the two before it on disk
+    assert list(cache.memory) == [entries[4][0]]
+    assert list(cache.disk) == [entries[2][0], entries[3][0]]
+    assert cache.get(entries[0][0]) is None and cache.get(entries[1][0]) is None
+    assert torch.equal(cache.get(entries[4][0]), entries[4][1])
+    assert torch.equal(cache.get(entries[3][0]), entries[3][1])
+
+
+def test_disk_tier_is_reused_after_restart(tmp_path):
+    cache = DecodedAudioCache(max_bytes=0, disk_dir=str(tmp_path), model_version="v1")
+    entries = make_entries(cache, 3)
+    for key, audio in entries:
+        cache.put(key, audio)
+    # a partial write of a killed process is removed on startup
+    (tmp_path / "partial.pcm.tmp").write_bytes(b"\0" * 16)
+
+    restarted = DecodedAudioCache(max_bytes=AUDIO_BYTES * 3, disk_dir=str(tmp_path), model_version="v1")
+    assert restarted.metrics()["disk_entries"] == 3
+    assert not (tmp_path / "partial.pcm.tmp").exists()
+    for key, audio in entries:
+        assert torch.equal(restarted.get(key), audio)
+    assert restarted.metrics()["disk_hits"] == 3 and restarted.metrics()["misses"] == 0
+
+    # the same indices under another model version are a miss
+    other_version = DecodedAudioCache(disk_dir=str(tmp_path), model_version="v2")
+    generator = torch.Generator().manual_seed(0)
+    assert other_version.get(other_version.key(torch.randint(0, 175, (10, 8), generator=generator))) is None
+
+
+def test_disk_tier_requires_model_version(tmp_path):
+    with pytest.raises(ValueError):
+        DecodedAudioCache(disk_dir=str(tmp_path))
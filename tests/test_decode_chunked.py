@@ -0,0 +1,24 @@
+import math
+
+import pytest
+import torch
+
+
+@pytest.mark.parametrize("fixed_decode_noise", [False, True])
+def test_decode_chunked_equals_decode(build_codec, fixed_decode_noise):
+    codec = build_codec(fixed_decode_noise=fixed_decode_noise).eval()
+    receptive_field = codec.decode_receptive_field()
+    generator = torch.Generator().manual_seed(0)
+    num_frames = 3 * receptive_field + 5
+    indices = torch.randint(0, 175, (1, 10, num_frames), generator=generator)
+    factor = math.prod(codec.quantizer.downsample_factor)
+    # the fixed decode noise when it is on, else the same drawn noise for both
+    noise = None if fixed_decode_noise else torch.randn(1, codec.decoder.input_channels, num_frames * factor, generator=generator)
+
+    with torch.inference_mode():
+        reference, _ = codec.decode(indices, torch.tensor([num_frames]), return_audios=True, noise=noise)
+        # chunks smaller than, equal to and larger than the receptive field
+        for chunk_frames in [receptive_field // 3, receptive_field, 2 * receptive_field + 1]:
+            output = codec.decode_chunked(indices, chunk_frames=chunk_frames, noise=noise)
+            assert output.shape == reference.shape
+            torch.testing.assert_close(output, reference, atol=1e-6, rtol=0)
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from dmel_codec.models.modules.dowmsample_fsq import DownsampleFiniteScalarQuantize
+
+
+def reference_decode(quantizer, indices):
+    # the get_output_from_indices path, taken when autograd is enabled
+    with torch.enable_grad():
+        return quantizer.decode(indices).detach()
+
+
+@pytest.mark.parametrize(
+    "quantizer_kwargs",
+    [
+        dict(input_dim=700, n_codebooks=1, n_groups=10, levels=[7, 5, 5], is_dmel=True, downsample_factor=[2, 2]),
+        dict(input_dim=64, n_codebooks=3, n_groups=2, levels=[8, 5, 5, 5], downsample_factor=[2]),
+    ],
+)
+@torch.no_grad()
+def test_decode_table(quantizer_kwargs):
+    torch.manual_seed(0)
+    quantizer = DownsampleFiniteScalarQuantize(**quantizer_kwargs).eval()
+    residual_fsq = quantizer.residual_fsq
+    codebook_num = residual_fsq.groups * residual_fsq.rvqs[0].num_quantizers
+    codebook_size = residual_fsq.rvqs[0].codebook_size
+    indices = torch.randint(0, codebook_size, (2, codebook_num, 13), generator=torch.Generator().manual_seed(1))
+
+    torch.testing.assert_close(quantizer.decode(indices), reference_decode(quantizer, indices))
+    table = quantizer.decode_table
+    quantizer.decode(indices)
+    assert quantizer.decode_table is table # cached
+
+    # in place change of the output projection, the table must be rebuilt
+    project_out = residual_fsq.rvqs[0].project_out
+    if isinstance(project_out, torch.nn.Identity):
+        pytest.skip("no output projection to change")
+    project_out.weight.mul_(1.5)
+    output = quantizer.decode(indices)
+    assert quantizer.decode_table is not table
+    torch.testing.assert_close(output, reference_decode(quantizer, indices))
+
+    # load_state_dict copies in place as well
+    table = quantizer.decode_table
+    state_dict = {name: value * 0.5 for name, value in quantizer.state_dict().items()}
+    quantizer.load_state_dict(state_dict)
+    output = quantizer.decode(indices)
+    assert quantizer.decode_table is not table
+    torch.testing.assert_close(output, reference_decode(quantizer, indices))
+
+
+def test_decode_table_of_inference_tensors():
+    with torch.inference_mode():
+        quantizer = DownsampleFiniteScalarQuantize(
+            input_dim=700, n_codebooks=1, n_groups=10, levels=[7, 5, 5], is_dmel=True, downsample_factor=[2, 2]
+        ).eval()
+        indices = torch.randint(0, 175, (2, 10, 13), generator=torch.Generator().manual_seed(1))
+        output = quantizer.decode(indices)
+        quantizer.use_decode_table = False
+        reference = quantizer.decode(indices)
+    torch.testing.assert_close(output, reference)
@@ -0,0 +1,34 @@
+import pytest
+import torch
+from torch import nn
+
+from dmel_codec.models.modules.dynamic_int8 import DynamicInt8Conv1d
+
+
+def relative_error(output, reference):
+    return ((output - reference).norm() / reference.norm()).item()
+
+
+@pytest.mark.parametrize(
+    "kernel_size, dilation, padding, stride",
+    [(1, 1, 0, 1), (3, 1, 1, 1), (3, 4, 4, 1), (3, 2, 0, 1), (5, 3, 2, 2), (4, 1, 1, 3)],
+)
+@torch.no_grad()
+def test_int8_conv_equals_conv(kernel_size, dilation, padding, stride):
+    torch.manual_seed(0)
+    conv = nn.Conv1d(64, 48, kernel_size, stride=stride, padding=padding, dilation=dilation)
+    x = torch.randn(2, 64, 37)
+    reference = conv(x)
+    output = DynamicInt8Conv1d(conv)(x)
+    assert output.shape == reference.shape
+    # per channel int8 weights and per tensor int8 activations
+    assert relative_error(output, reference) < 0.02
+
+
+@torch.no_grad()
+def test_int8_conv_without_padding():
+    torch.manual_seed(0)
+    conv = nn.Conv1d(64, 48, 3, padding=2, dilation=2)
+    x = torch.randn(2, 64, 37)
+    reference = nn.functional.conv1d(x, conv.weight, conv.bias, dilation=2)
+    assert relative_error(DynamicInt8Conv1d(conv)(x, padding=0), reference) < 0.02
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+import dmel_codec
+from dmel_codec.models.lm_lit_modules import MusicLLM
+from dmel_codec.models.modules.config_lm import Qwen2Config
+from dmel_codec.models.modules.lm_process_input import ProcessInputs
+
+AUDIO_SILENCE_ID = [0, 0, 29, 174, 0, 6, 0, 146, 146, 6]
+
+
+class StubTokenizer:
+    # every character is one token
+    def __call__(self, text, return_tensors="pt"):
+        return {"input_ids": torch.arange(len(text))[None]}
+
+
+class StubLM:
+    """
+        the generation loop of MusicLLM around a sampler which never emits <EOM>
+    """
+    inference_by_text_prompts = MusicLLM.inference_by_text_prompts
+    inference_by_text_prompt_stream = MusicLLM.inference_by_text_prompt_stream
+
+    def __init__(self, max_length, codec_model=None, generated_codes=None):
+        self.slow_lm_config = Qwen2Config.from_pretrained(
+            os.path.join(dmel_codec.__path__[0], "config/lm/slow_lm_0.5B.json")
+        )
+        self.process_inputs_cls = ProcessInputs(
+            config=self.slow_lm_config,
+            max_length=max_length,
+            silence_length=3,
+            audio_silence_id=AUDIO_SILENCE_ID,
+            text_tokenizer=StubTokenizer(),
+        )
+        self.max_length = max_length
+        self.device = torch.device("cpu")
+        self.codebook_shift = torch.arange(10) * self.slow_lm_config.audio_codebook_size
+        self.codec_model = codec_model
+        self.generated_codes = generated_codes # [T, Codebook_num], the frames "sampled" by the stream
+
+    def prefill_text_prompt(self, inference_config):
+        # 6 frames of special tokens, then the forced silence frame, which is the first generated frame
+        self.text_prompt_length = 4
+        self.audio_ids = torch.full((self.text_prompt_length + 6, 10), self.slow_lm_config.slow_audio_modality_mambaout_token_id)
+        self.audio_ids = torch.cat([self.audio_ids, self.generated_codes[:1] + self.codebook_shift])
+        return None, None
+
+    def predict_n_token_iter(self, input_embeds, slow_past_key_values, inference_config):
+        # the checked prefix grows by end_check_interval frames, like MusicLLM.predict_n_token_iter
+        checked_length = self.audio_ids.shape[0] - 1
+        for codes in self.generated_codes[1:]:
+            self.audio_ids = torch.cat([self.audio_ids, codes[None] + self.codebook_shift])
+            if self.audio_ids.shape[0] - checked_length >= inference_config.end_check_interval:
+                checked_length = self.audio_ids.shape[0]
+            yield checked_length
+
+    def get_embeds_from_inputs_ids(self, text_ids, audio_ids):
+        return torch.zeros(*text_ids.shape, 1)
+
+    def predict_one_token_batch(self, input_embeds, slow_past_key_values, attention_mask, position_ids, inference_config, previous_token=None):
+        batch_size = input_embeds.shape[0]
+        step = attention_mask.shape[1]
+        text_token = torch.zeros(batch_size, 1, dtype=torch.long)
+        audio_token = (self.codebook_shift + step % 175).repeat(batch_size, 1)
+        return torch.cat([text_token, audio_token], dim=1), slow_past_key_values
+
+    def decode_generation_audio_ids(self, generation_audio_ids_list):
+        return generation_audio_ids_list
+
+
+def test_batched_generation_without_end_of_music():
+    lm = StubLM(max_length=4096)
+    config = OmegaConf.create({"max_new_tokens": 40, "windows_length": 16, "end_check_interval": 8})
+    prompts = ["a", "a longer prompt", "abc"]
+    outputs = lm.inference_by_text_prompts(config, prompts)
+
+    for prompt, audio_ids in zip(prompts, outputs):
+        # prompt length without padding, its last frame is the forced silence which starts the generated ids
+        prompt_length = lm.process_inputs_cls.process_2d_logits_infer(
+            device=lm.device,
+            text_ids=torch.arange(len(prompt))[None],
+            text_prompt_length=len(prompt),
+        ).shape[1]
+        assert audio_ids.shape[0] == config.max_new_tokens - prompt_length
+        codes = audio_ids - lm.codebook_shift
+        # no mambaout fill frame, every id is a valid codebook index
+        assert bool(((codes >= 0) & (codes < 175)).all())
+
+
+def stream_config(**kwargs):
+    return OmegaConf.create({"max_new_tokens": 4096, "end_check_interval": 8, "stream_chunk_frames": 5, **kwargs})
+
+
+def test_streamed_chunks_equal_decode(build_codec):
+    codec = build_codec(fixed_decode_noise=True).eval()
+    generated_codes = torch.randint(0, 175, (61, 10), generator=torch.Generator().manual_seed(0))
+    lm = StubLM(max_length=4096, codec_model=codec, generated_codes=generated_codes)
+
+    chunks = list(lm.inference_by_text_prompt_stream(stream_config()))
+    assert len(chunks) > 2
+    # the last frame is dropped, same as inference_by_text_prompt
+    indices = generated_codes[:-1].T[None]
+    with torch.inference_mode():
+        reference, _ = codec.decode(indices, torch.tensor([indices.shape[2]]), return_audios=True)
+    # a context shorter than the receptive field is off by a few 1e-6 on this codec
+    torch.testing.assert_close(torch.cat(chunks, dim=-1), reference.float()[0], atol=5e-7, rtol=0)
+
+
+def test_stream_context_shorter_than_receptive_field(build_codec):
+    codec = build_codec(fixed_decode_noise=True).eval()
+    lm = StubLM(max_length=4096, codec_model=codec, generated_codes=torch.zeros(20, 10, dtype=torch.long))
+    with pytest.raises(ValueError):
+        next(lm.inference_by_text_prompt_stream(stream_config(stream_lookahead_frames=codec.decode_receptive_field() - 1)))
@@ -0,0 +1,154 @@
+import asyncio
+import base64
+import io
+import os
+import wave
+
+import torch
+from omegaconf import OmegaConf
+from torch import nn
+from transformers import Qwen2Config as HFQwen2Config
+from transformers import Qwen2Model
+
+import dmel_codec
+from dmel_codec.models.modules.config_lm import Qwen2Config
+from dmel_codec.models.modules.lm_process_input import ProcessInputs
+from dmel_codec.serving.lm_server import ContinuousBatchingScheduler, LMServer, send_request
+
+AUDIO_SILENCE_ID = [0, 0, 29, 174, 0, 6, 0, 146, 146, 6]
+PROMPTS = ["a", "a much longer prompt", "abc", "medium prompt", "xy", "another long prompt here"]
+
+
+class StubTokenizer:
+    # every character is one token
+    def __call__(self, text, return_tensors="pt"):
+        return {"input_ids": torch.tensor([[ord(char) for char in text]])}
+
+
+class StubLM(nn.Module):
+    """
+        a tiny float64 qwen2 with the MusicLLM interface used by the scheduler, deterministic, so a sequence only depends
+        on its own kv cache, attention mask, positions and repetition window, which the scheduler has to keep per row
+    """
+    def __init__(self, max_length=4096):
+        super().__init__()
+        torch.manual_seed(0)
+        self.slow_lm_config = Qwen2Config.from_pretrained(
+            os.path.join(dmel_codec.__path__[0], "config/lm/slow_lm_0.5B.json")
+        )
+        self.process_inputs_cls = ProcessInputs(
+            config=self.slow_lm_config,
+            max_length=max_length,
+            silence_length=3,
+            audio_silence_id=AUDIO_SILENCE_ID,
+            text_tokenizer=StubTokenizer(),
+        )
+        self.max_length = max_length
+        self.device = torch.device("cpu")
+        self.codebook_shift = torch.arange(10) * self.slow_lm_config.audio_codebook_size
+        self.lm = Qwen2Model(
+            HFQwen2Config(
+                vocab_size=1, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+                num_key_value_heads=2, attn_implementation="sdpa", # the default of the slow lm, it unmasks the padding rows
+            )
+        ).double().eval()
+        self.text_embedding = nn.Embedding(1000, 32).double()
+        self.audio_embedding = nn.Embedding(2000, 32).double()
+        # 1 in 12 frames ends with <EOM> on average, the others run into the length limit
+        self.text_head = nn.Linear(32, 12).double()
+
+    def get_embeds_from_inputs_ids(self, text_ids, audio_ids):
+        return self.text_embedding(text_ids % 1000) + self.audio_embedding(audio_ids).sum(dim=-2)
+
+    def predict_one_token_batch(self, input_embeds, slow_past_key_values, attention_mask, position_ids, inference_config, previous_token=None):
+        output = self.lm(
+            inputs_embeds=input_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=slow_past_key_values,
+            use_cache=True,
+        )
+        hidden = output.last_hidden_state[:, -1]
+        text_token = torch.where(
+            self.text_head(hidden).argmax(dim=-1) == 0, self.slow_lm_config.end_of_music_id, 0
+        )
+        # fine grained codes of the hidden state, a wrong key or position in the cache changes them
+        codes = (hidden[:, :10] * 1e6).floor().long() % 175
+        if previous_token is not None:
+            codes = (codes + previous_token.sum(dim=1)) % 175
+        return torch.cat([text_token[:, None], codes + self.codebook_shift], dim=1), output.past_key_values
+
+    def decode_generation_audio_ids(self, generation_audio_ids_list):
+        return [(audio_ids - self.codebook_shift).double().view(1, -1) / 200 for audio_ids in generation_audio_ids_list]
+
+
+def inference_config():
+    return OmegaConf.create({"max_new_tokens": 60, "windows_length": 4})
+
+
+def run_alone(model, prompt):
+    scheduler = ContinuousBatchingScheduler(model, inference_config(), max_batch_size=1)
+    scheduler.add_request(prompt)
+    while True:
+        finished = scheduler.step()
+        if finished:
+            return finished[0][1]
+
+
+def test_continuous_batching_equals_requests_alone():
+    model = StubLM()
+    scheduler = ContinuousBatchingScheduler(model, inference_config(), max_batch_size=4)
+    requests = [scheduler.add_request(prompt) for prompt in PROMPTS[:2]]
+    outputs = {}
+    admitted_while_running = evicted_while_running = False
+    step = 0
+    while scheduler.has_work() or len(requests) < len(PROMPTS):
+        # the other requests arrive in pairs while the first ones are generating
+        if step in (2, 6) and len(requests) < len(PROMPTS):
+            requests += [scheduler.add_request(prompt) for prompt in PROMPTS[len(requests):len(requests) + 2]]
+        running = len(scheduler.running)
+        waiting = len(scheduler.waiting)
+        finished = scheduler.step()
+        admitted_while_running |= running > 0 and waiting > 0 and len(scheduler.waiting) < waiting
+        evicted_while_running |= len(finished) > 0 and len(scheduler.running) > 0
+        outputs.update({request.request_id: wav for request, wav in finished})
+        step += 1
+
+    assert admitted_while_running and evicted_while_running
+    lengths = set()
+    for request in requests:
+        reference = run_alone(model, request.prompt)
+        assert torch.equal(outputs[request.request_id], reference), request.prompt
+        lengths.add(reference.shape[1])
+    # the requests finish at different steps
+    assert len(lengths) > 1
+    assert scheduler.metrics.completed_requests == len(PROMPTS)
+
+
+def test_server_on_unix_socket(tmp_path):
+    model = StubLM()
+    server = LMServer(ContinuousBatchingScheduler(model, inference_config(), max_batch_size=2), sample_rate=24000)
+    unix_socket = str(tmp_path / "lm.sock")
+
+    async def run():
+        serve_task = asyncio.create_task(server.serve(unix_socket=unix_socket))
+        while not os.path.exists(unix_socket):
+            await asyncio.sleep(0.01)
+        responses = await asyncio.gather(
+            *[send_request("POST", "/generate", {"prompt": prompt}, unix_socket=unix_socket) for prompt in PROMPTS[:3]]
+        )
+        metrics = await send_request("GET", "/metrics", unix_socket=unix_socket)
+        not_found = await send_request("GET", "/unknown", unix_socket=unix_socket)
+        bad_request = await send_request("POST", "/generate", {"text": "no prompt"}, unix_socket=unix_socket)
+        serve_task.cancel()
+        return responses, metrics, not_found, bad_request
+
+    responses, metrics, not_found, bad_request = asyncio.run(run())
+    for prompt, (status, response) in zip(PROMPTS, responses):
+        assert status == 200
+        with wave.open(io.BytesIO(base64.b64decode(response["audio"])), "rb") as f:
+            assert f.getframerate() == 24000
+            assert f.getnframes() == run_alone(model, prompt).shape[1]
+    assert metrics[0] == 200 and metrics[1]["completed_requests"] == 3
+    assert not_found[0] == 404
+    assert bad_request[0] == 400
@@ -0,0 +1,107 @@
+import pickle
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+from lhotse import CutSet, Recording, SupervisionSegment
+
+from dmel_codec.dataset.lhotse_tts_dataset import LhotseTTSDataset
+from dmel_codec.dataset.pcm_store import INT16_SCALE, PCMStore, PCMStoreWriter
+
+SAMPLE_RATE = 16000
+
+
+def random_audios(lengths):
+    generator = np.random.default_rng(0)
+    audios = {f"cut-{i}": generator.uniform(-1, 1, length).astype(np.float32) for i, length in enumerate(lengths)}
+    # out of range samples are clipped by the int16 store
+    audios["cut-0"][:2] = [1.5, -1.5]
+    return audios
+
+
+def write_store(store_dir, audios, dtype, shard_samples):
+    with PCMStoreWriter(str(store_dir), SAMPLE_RATE, dtype=dtype, shard_samples=shard_samples) as writer:
+        for cut_id, audio in audios.items():
+            writer.write(cut_id, audio)
+    return writer
+
+
+@pytest.mark.parametrize("dtype", ["int16", "float16"])
+def test_round_trip(tmp_path, dtype):
+    audios = random_audios([5000, 0, 7000, 1, 2500, 400])
+    # the writer takes both numpy arrays and tensors
+    writer = write_store(tmp_path, {**audios, "cut-2": torch.from_numpy(audios["cut-2"])}, dtype, shard_samples=4000)
+
+    # a cut never spans shards, a cut longer than a shard gets a shard of its own and no shard is left empty
+    assert writer.shards == [5000, 7000, 2901]
+    with pytest.raises(ValueError):
+        writer.write("cut-0", audios["cut-0"])
+
+    store = PCMStore(str(tmp_path))
+    assert store.dtype == dtype and store.sample_rate == SAMPLE_RATE
+    assert len(store) == len(audios) and store.shards == writer.shards
+
+    if dtype == "int16":
+        tolerance = 0.5 / INT16_SCALE + 1e-7
+    else:
+        # half of the float16 spacing in [0.5, 1)
+        tolerance = 2.0 ** -12
+    for reopened in [store, PCMStore(str(tmp_path)), pickle.loads(pickle.dumps(store))]:
+        for cut_id, audio in audios.items():
+            assert cut_id in reopened
+            read = reopened[cut_id]
+            assert read.dtype == torch.float32 and read.shape == (len(audio),)
+            expected = np.clip(audio, -1.0, 1.0) if dtype == "int16" else audio
+            assert np.abs(read.numpy() - expected).max(initial=0) <= tolerance
+
+    pcm = store.get_pcm("cut-2", start=100, length=50)
+    assert pcm.shape == (50,)
+    np.testing.assert_array_equal(pcm, store.get_pcm("cut-2")[100:150])
+    assert store.get_pcm("cut-2", start=6990, length=50).shape == (10,)
+
+    with pytest.raises(KeyError):
+        store["missing"]
+
+
+def test_unsupported_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        PCMStoreWriter(str(tmp_path), SAMPLE_RATE, dtype="float32")
+
+
+def make_cuts(audio_dir, audios):
+    cuts = []
+    for cut_id, audio in audios.items():
+        path = audio_dir / f"{cut_id}.wav"
+        sf.write(path, audio * 0.5, SAMPLE_RATE)
+        cut = Recording.from_file(path, recording_id=cut_id).to_cut()
+        cut.id = cut_id
+        cut.supervisions = [
+            SupervisionSegment(id=cut_id, recording_id=cut_id, start=0, duration=cut.duration, text=cut_id)
+        ]
+        cuts.append(cut)
+    return CutSet.from_cuts(cuts)
+
+
+@pytest.mark.parametrize("num_load_threads", [1, 4])
+def test_load_audios(tmp_path, num_load_threads):
+    audios = random_audios([3000, 1600, 4800, 800, 2400])
+    cuts = make_cuts(tmp_path, audios)
+    decoded = LhotseTTSDataset().load_audios(cuts)
+
+    # every cut except the last is stored, negated to tell the stored audio from the decoded one
+    store_dir = tmp_path / "pcm"
+    write_store(store_dir, {cut_id: -audio for cut_id, audio in zip(list(audios)[:-1], decoded)}, "int16", 5000)
+    dataset = LhotseTTSDataset(pcm_store_dir=str(store_dir), num_load_threads=num_load_threads)
+
+    loaded = dataset.load_audios(cuts)
+    assert len(loaded) == len(decoded)
+    for audio, reference in zip(loaded[:-1], decoded[:-1]):
+        assert audio.shape == reference.shape
+        assert (audio + reference).abs().max() <= 0.5 / INT16_SCALE + 1e-7
+    # the missing cut is still decoded
+    assert torch.equal(loaded[-1], decoded[-1])
+    assert (dataset._executor is not None) == (num_load_threads > 1)
+
+    # the thread pool is not pickled to dataloader workers
+    assert pickle.loads(pickle.dumps(dataset)).load_audios(cuts)[0].shape == decoded[0].shape
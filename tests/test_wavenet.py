@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from dmel_codec.models.modules.dynamic_int8 import quantize_dynamic_int8
+from dmel_codec.models.modules.wavenet import WaveNet
+
+
+def build_wavenet(with_condition):
+    torch.manual_seed(0)
+    wavenet = WaveNet(
+        input_channels=10,
+        output_channels=16,
+        residual_channels=32,
+        residual_layers=8,
+        dilation_cycle=4,
+        condition_channels=24 if with_condition else None,
+    ).eval()
+    # the default init is too small to show a wrong frame
+    for param in wavenet.parameters():
+        param.data.normal_(0, 0.2)
+    return wavenet
+
+
+def run_steps(wavenet, x, condition, chunk_size):
+    state = wavenet.init_state()
+    outputs = []
+    for start in range(0, x.shape[2], chunk_size):
+        outputs.append(
+            wavenet.step(
+                x[:, :, start:start + chunk_size],
+                state,
+                condition=None if condition is None else condition[:, :, start:start + chunk_size],
+            )
+        )
+    outputs.append(wavenet.flush(state))
+    return torch.cat(outputs, dim=2)
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+@pytest.mark.parametrize("with_condition", [False, True])
+@torch.no_grad()
+def test_step_equals_forward(with_condition, optimize):
+    wavenet = build_wavenet(with_condition)
+    if optimize:
+        wavenet.optimize_for_inference()
+    receptive_field = wavenet.receptive_field()
+    generator = torch.Generator().manual_seed(1)
+    num_frames = 101
+    x = torch.randn(2, 10, num_frames, generator=generator)
+    condition = torch.randn(2, 24, num_frames, generator=generator) if with_condition else None
+
+    reference = wavenet(x, condition=condition)
+    # one frame, odd, larger than the receptive field, the whole sequence at once
+    for chunk_size in [1, 7, receptive_field + 3, num_frames]:
+        output = run_steps(wavenet, x, condition, chunk_size)
+        assert output.shape == reference.shape
+        torch.testing.assert_close(output, reference, rtol=1e-4, atol=1e-5)
+
+
+@torch.no_grad()
+def test_optimized_forward_equals_forward():
+    wavenet = build_wavenet(with_condition=True)
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, 10, 50, generator=generator)
+    condition = torch.randn(2, 24, 50, generator=generator)
+    reference = wavenet(x, condition=condition)
+    wavenet.optimize_for_inference()
+    torch.testing.assert_close(wavenet(x, condition=condition), reference, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("with_condition", [False, True])
+@torch.no_grad()
+def test_int8_step_equals_int8_forward(with_condition):
+    wavenet = build_wavenet(with_condition)
+    wavenet.optimize_for_inference()
+    assert quantize_dynamic_int8(wavenet, min_channels=0) > 0
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, 10, 50, generator=generator)
+    condition = torch.randn(2, 24, 50, generator=generator) if with_condition else None
+    reference = wavenet(x, condition=condition)
+    for chunk_size in [1, 7]:
+        output = run_steps(wavenet, x, condition, chunk_size)
+        # the activation scales of a step differ from the ones of the whole sequence
+        assert ((output - reference).norm() / reference.norm()).item() < 0.05